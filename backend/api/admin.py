@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Subject, Note, NoteRequest, Comment, Download, Bookmark
+from .models import User, Subject, Tag, Note, NoteRequest, Comment, Download, Bookmark, Job
 
 
 @admin.register(User)
@@ -20,6 +20,12 @@ class SubjectAdmin(admin.ModelAdmin):
     search_fields = ['name']
 
 
+@admin.register(Tag)
+class TagAdmin(admin.ModelAdmin):
+    list_display = ['name']
+    search_fields = ['name']
+
+
 @admin.register(Note)
 class NoteAdmin(admin.ModelAdmin):
     list_display = ['title', 'subject', 'uploaded_by', 'downloads_count', 'views_count', 'is_approved', 'created_at']
@@ -51,4 +57,11 @@ class DownloadAdmin(admin.ModelAdmin):
 @admin.register(Bookmark)
 class BookmarkAdmin(admin.ModelAdmin):
     list_display = ['note', 'user', 'created_at']
-    list_filter = ['created_at']
\ No newline at end of file
+    list_filter = ['created_at']
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'run_at', 'created_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['locked_by', 'locked_until', 'last_error']
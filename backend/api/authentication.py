@@ -0,0 +1,194 @@
+"""
+Token authentication with the token lookup cached.
+
+DRF's ``TokenAuthentication`` joins ``Token`` and ``User`` on every request.
+``CachedTokenAuthentication`` keeps the result for ``TOKEN_CACHE_TTL``
+seconds in ``TOKEN_CACHE_BACKEND``, a ``CACHES`` alias that must be shared
+between workers (e.g. Redis) so an invalidation reaches all of them. A
+process-local cache there is refused. Without a backend tokens are not
+cached, except in the LRU of ``TOKEN_CACHE_SIZE`` entries that
+``TOKEN_CACHE_LOCAL`` enables for a deployment with a single process.
+
+Entries hold the token and the user's fields, but not the password hash.
+Users are rebuilt with ``password`` deferred: reading it loads it from the
+database, and ``save()`` leaves it alone.
+
+The signals in api/signals.py invalidate a token when it is deleted (logout)
+and all of a user's tokens when the user is saved, which covers password and
+``is_active`` changes. Invalidation leaves a short-lived tombstone, so a
+request that read the old row just before cannot put it back. Code changing
+users with ``QuerySet.update()`` must call ``invalidate_user`` itself.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from . import caching
+
+TTL = getattr(settings, 'TOKEN_CACHE_TTL', 300)
+SIZE = getattr(settings, 'TOKEN_CACHE_SIZE', 10000)
+BACKEND = getattr(settings, 'TOKEN_CACHE_BACKEND', None)
+LOCAL = getattr(settings, 'TOKEN_CACHE_LOCAL', False)
+TOMBSTONE_TTL = 30
+
+REVOKED = 'revoked'
+
+if BACKEND and not caching.is_shared(BACKEND):
+    raise ImproperlyConfigured(
+        f'TOKEN_CACHE_BACKEND {BACKEND!r} is private to each process, revoked tokens would stay valid in '
+        'the other workers. Use a shared cache, or TOKEN_CACHE_LOCAL=1 with a single process'
+    )
+
+User = get_user_model()
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+TOKEN_FIELDS = [field.attname for field in Token._meta.concrete_fields]
+
+
+class LocalCache:
+    """Per-process LRU with a TTL per entry"""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def add(self, key, value, timeout):
+        """Store ``value`` unless the key holds a live entry (e.g. a tombstone)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return
+            self._entries[key] = (now + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = self.misses = self.invalidations = 0
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': BACKEND or ('local' if LOCAL else None),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class NoCache:
+    def get(self, key):
+        return None
+
+    def add(self, key, value, timeout):
+        pass
+
+    def set(self, key, value, timeout):
+        pass
+
+    def clear(self):
+        pass
+
+
+token_cache = caches[BACKEND] if BACKEND else LocalCache(SIZE) if LOCAL else NoCache()
+metrics = Metrics()
+
+
+def cache_key(key):
+    # Hashed, so raw tokens never end up in a shared cache's key space
+    return 'auth:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def to_entry(token):
+    return ([getattr(token, name) for name in TOKEN_FIELDS],
+            [getattr(token.user, name) for name in USER_FIELDS])
+
+
+def from_entry(entry):
+    """New instances for each request, views may modify request.user"""
+    token_values, user_values = entry
+    token = Token.from_db(DEFAULT_DB_ALIAS, TOKEN_FIELDS, token_values)
+    token.user = User.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, user_values)
+    return token
+
+
+def lookup(key):
+    """The ``Token`` for ``key`` with its user loaded, or None"""
+    name = cache_key(key)
+    cached = token_cache.get(name)
+    if cached is not None and cached != REVOKED:
+        metrics.count('hits')
+        return from_entry(cached)
+
+    metrics.count('misses')
+    token = Token.objects.select_related('user').filter(key=key).first()
+    if token is not None and cached is None:
+        token_cache.add(name, to_entry(token), TTL)
+    return token
+
+
+def invalidate(*keys):
+    for key in keys:
+        token_cache.set(cache_key(key), REVOKED, TOMBSTONE_TTL)
+        metrics.count('invalidations')
+
+
+def invalidate_user(user_id):
+    invalidate(*Token.objects.filter(user_id=user_id).values_list('key', flat=True))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        token = lookup(key)
+        if token is None:
+            raise AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
@@ -0,0 +1,497 @@
+"""
+Endpoint benchmarks against a generated dataset.
+
+``generate`` fills the database with ``bulk_create`` in batches: users,
+subjects, tags, notes, downloads, bookmarks, requests, nested comment threads
+and notifications, in whatever volume is asked for. ``run`` then requests
+every route in api/urls.py (one or more ``CASES`` each). For each it records
+latency percentiles, the number of queries and the peak memory allocated
+while serving. Every request runs in a transaction that is rolled back, so
+all repetitions of a write see the same data. ``payloads`` renders the
+heaviest list responses with each JSON renderer and compresses them with
+each encoding, for the time taken and the bytes sent.
+
+``manage.py benchmark`` runs both against a throwaway database. It writes the
+results as JSON and compares them with a stored baseline.
+"""
+import hashlib
+import io
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from . import compression, renderers, search, storage, threads, uploads, urls
+from .models import (
+    Bookmark, Comment, Download, Note, NoteRequest, Notification, Subject, Tag, UploadSession, User,
+)
+
+PASSWORD = 'Benchmark-password-1'
+NEW_PASSWORD = 'Benchmark-password-2'
+SUBJECTS = ['Mathematics', 'Physics', 'Chemistry', 'Biology', 'Computer Science',
+            'English', 'History', 'Economics', 'Psychology', 'Engineering']
+TAGS = 200
+DESCRIPTION = 'Lecture notes covering definitions, worked examples and past exam questions. ' * 4
+PDF = b'%PDF-1.4\n' + b'0' * 64 * 1024
+CHUNK = 256 * 1024
+CHUNK_DATA = b'1' * CHUNK
+
+# Routes that cannot be measured request by request
+SKIPPED = {
+    'notification-stream': 'holds the connection open until the client leaves',
+}
+
+
+# ==================== DATASET ====================
+
+def insert(model, rows, batch_size, log, returning=False):
+    """bulk_create ``rows`` (any iterable) in batches, returns the new primary keys or the row count"""
+    ids = []
+    count = 0
+    batch = []
+    start = time.perf_counter()
+
+    def flush():
+        nonlocal count
+        with transaction.atomic():
+            created = model.objects.bulk_create(batch)
+        if returning:
+            ids.extend(obj.pk for obj in created)
+        count += len(batch)
+        batch.clear()
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    elapsed = time.perf_counter() - start
+    log(f'{count} {model._meta.verbose_name_plural} in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f}/s)')
+    return ids if returning else count
+
+
+def pairs(count, notes, users, offset=0):
+    """``count`` distinct (note, user) pairs, for the unique_together tables"""
+    count = min(count, len(notes) * len(users))
+    for k in range(count):
+        note_index, round_ = k % len(notes), k // len(notes)
+        yield notes[note_index], users[(round_ + note_index * 7 + offset) % len(users)]
+
+
+def generate(users=2000, notes=20000, downloads=100000, requests=5000, threads=200, thread_depth=6,
+             branching=2, notifications=10000, batch_size=5000, seed=1, log=print):
+    rng = random.Random(seed)
+    password = make_password(PASSWORD)  # One hash for everyone, hashing 100k passwords would dominate
+
+    user_ids = insert(User, (
+        User(email=f'user{i}@benchmark.example', full_name=f'Student {i}', password=password,
+             college=f'College {i % 40}', course='B.Sc.', year=str(1 + i % 4))
+        for i in range(max(users, 2))
+    ), batch_size, log, returning=True)
+    subject_ids = insert(Subject, (Subject(name=name, description=f'Notes for {name}') for name in SUBJECTS),
+                         batch_size, log, returning=True)
+    tag_names = [f'topic-{i}' for i in range(TAGS)]
+    tag_ids = insert(Tag, (Tag(name=name) for name in tag_names), batch_size, log, returning=True)
+
+    note_tags = []
+
+    def note_rows():
+        for i in range(max(notes, 1)):
+            picked = rng.sample(range(TAGS), 2)
+            note_tags.append(picked)
+            yield Note(
+                title=f'Lecture notes {i}', description=DESCRIPTION, file=f'notes/benchmark/{i}.pdf',
+                subject_id=subject_ids[i % len(subject_ids)], uploaded_by_id=rng.choice(user_ids),
+                is_approved=rng.random() > 0.05, tags=','.join(tag_names[t] for t in picked),
+                thumbnail_status='unsupported',
+            )
+
+    note_ids = insert(Note, note_rows(), batch_size, log, returning=True)
+    insert(Note.tag_set.through, (
+        Note.tag_set.through(note_id=note_id, tag_id=tag_ids[t])
+        for note_id, picked in zip(note_ids, note_tags) for t in picked
+    ), batch_size, log)
+
+    insert(Download, (Download(note_id=n, user_id=u) for n, u in pairs(downloads, note_ids, user_ids)),
+           batch_size, log)
+    insert(Bookmark, (Bookmark(note_id=n, user_id=u) for n, u in pairs(downloads // 5, note_ids, user_ids, 3)),
+           batch_size, log)
+    insert(NoteRequest, (
+        NoteRequest(title=f'Looking for notes {i}', description='Anyone have the slides?',
+                    subject_id=subject_ids[i % len(subject_ids)], requested_by_id=rng.choice(user_ids),
+                    status=rng.choice(['open', 'open', 'fulfilled', 'closed']))
+        for i in range(requests)
+    ), batch_size, log)
+
+    # Threads level by level, each comment with `branching` replies down to `thread_depth`
+    level = [(note_ids[t % len(note_ids)], None, None) for t in range(threads)]
+    for depth in range(thread_depth + 1):
+        rows = [
+            Comment(content_type='note', note_id=note_id, user_id=rng.choice(user_ids),
+                    text='Question' if depth == 0 else 'Reply', parent_id=parent, root_id=root, depth=depth)
+            for note_id, parent, root in level
+            for _ in range(1 if depth == 0 else branching)
+        ]
+        ids = insert(Comment, rows, batch_size, log, returning=True)
+        level = [(row.note_id, pk, row.root_id or pk) for row, pk in zip(rows, ids)]
+
+    insert(Notification, (
+        Notification(user_id=rng.choice(user_ids), title='New comment', message='Someone replied to you',
+                     is_read=rng.random() < 0.7)
+        for _ in range(notifications)
+    ), batch_size, log)
+
+    # bulk_create skips the signals that maintain these
+    call_command('reconcile_stats', stdout=io.StringIO())
+    for model in (Note, NoteRequest):
+        search.rebuild_index(model)
+    log('Counters and search index rebuilt')
+
+
+def context():
+    """Rows the cases point at, preparing the few that need real files"""
+    root = Comment.objects.filter(depth=0, note__isnull=False).order_by('id').first()
+    user = User.objects.order_by('id').first()
+    User.objects.filter(pk=user.pk).update(is_staff=True)  # For auth/cache-stats
+    note = root.note
+    note.file = storage.blob_storage.save('notes/benchmark.pdf', ContentFile(PDF))
+    note.is_approved = True
+    note.save(update_fields=['file', 'is_approved'])
+    reply = Comment.objects.filter(root=root).order_by('depth', 'id').first() or root
+    reply.attachment = storage.blob_storage.save('comment_attachments/benchmark.pdf', ContentFile(PDF))
+    reply.save(update_fields=['attachment'])
+    upload, _ = UploadSession.objects.get_or_create(
+        user=user, filename='benchmark.pdf', status='pending',
+        defaults=dict(size=CHUNK, chunk_size=CHUNK, title='Benchmark upload', description='Chunked',
+                      subject=note.subject),
+    )
+    # Every chunk in place, so finalize gets as far as queueing the assembly
+    uploads.write_chunk(upload, 0, io.BytesIO(CHUNK_DATA), CHUNK, hashlib.sha256(CHUNK_DATA).hexdigest())
+    return {
+        'user': user.pk,
+        'email': user.email,
+        'token': Token.objects.get_or_create(user=user)[0].key,
+        'subject': note.subject_id,
+        'note': note.pk,
+        'comment': root.pk,
+        'reply': reply.pk,
+        'more_replies': threads.encode_token(root),
+        'request': NoteRequest.objects.order_by('id').values_list('id', flat=True).first(),
+        'notification': Notification.objects.filter(user=user).values_list('id', flat=True).first()
+        or Notification.objects.create(user=user, title='Hello', message='Welcome').pk,
+        'upload': upload.pk,
+    }
+
+
+# ==================== CASES ====================
+
+class Case:
+    """One request to measure: a route name from api/urls.py plus how to call it"""
+
+    def __init__(self, route, method='get', kwargs=None, query='', data=None, format=None,
+                 content_type=None, headers=None):
+        self.route = route
+        self.method = method
+        self.kwargs = kwargs
+        self.query = query
+        self.data = data
+        self.format = format
+        self.content_type = content_type
+        self.headers = headers
+
+    @property
+    def label(self):
+        return f'{self.method.upper()} {self.route}{self.query}'
+
+    def url(self, ctx):
+        kwargs = {name: ctx.get(value, value) for name, value in (self.kwargs or {}).items()}
+        return reverse(self.route, kwargs=kwargs) + self.query.format(**ctx)
+
+    def request(self, client, ctx):
+        options = {}
+        if self.data is not None:
+            options['data'] = self.data(ctx) if callable(self.data) else self.data
+        if self.format:
+            options['format'] = self.format
+        if self.content_type:
+            options['content_type'] = self.content_type
+        if self.headers:
+            options.update(self.headers(ctx))
+        return getattr(client, self.method)(self.url(ctx), **options)
+
+
+def note_upload(ctx):
+    return {'title': 'Benchmark upload', 'description': 'Uploaded while benchmarking', 'tags': 'topic-1',
+            'subject_id': ctx['subject'], 'file': SimpleUploadedFile('benchmark.pdf', PDF)}
+
+
+def chunk_checksum(ctx):
+    return {'HTTP_X_CHUNK_SHA256': hashlib.sha256(CHUNK_DATA).hexdigest()}
+
+
+PK = {'pk': 'note'}
+REQUEST_PK = {'pk': 'request'}
+COMMENT_PK = {'pk': 'comment'}
+NOTIFICATION_PK = {'pk': 'notification'}
+UPLOAD_PK = {'pk': 'upload'}
+
+CASES = [
+    Case('api-root'),
+    Case('register', 'post', format='json', data={
+        'email': 'new@benchmark.example', 'full_name': 'New Student',
+        'password': NEW_PASSWORD, 'password_confirm': NEW_PASSWORD,
+    }),
+    Case('login', 'post', format='json', data=lambda ctx: {'email': ctx['email'], 'password': PASSWORD}),
+    Case('profile'),
+    Case('auth-cache-stats'),
+    Case('subject-list'),
+    Case('subject-detail', kwargs={'pk': 'subject'}),
+    Case('tags'),
+    Case('tags', query='?subject={subject}'),
+    Case('note-list'),
+    Case('note-list', query='?subject={subject}'),
+    Case('note-list', query='?tag=topic-1'),
+    Case('note-list', query='?search=lecture'),
+    Case('note-list', query='?my_notes=1'),
+    Case('note-list', query='?compact=1'),
+    Case('note-list', query='?fields=id,title,thumbnails'),
+    Case('note-list', 'post', data=note_upload, format='multipart'),
+    Case('note-detail', kwargs=PK),
+    Case('note-detail', 'patch', kwargs=PK, format='json', data=lambda ctx: {
+        'title': 'Renamed', 'subject_id': ctx['subject'],  # NoteSerializer.validate wants a subject on PATCH too
+    }),
+    Case('note-detail', 'put', kwargs=PK, data=note_upload, format='multipart'),
+    Case('note-detail', 'delete', kwargs=PK),
+    Case('note-bookmark', 'post', kwargs=PK),
+    Case('note-batch', query='?ids={note},{request},{comment}'),
+    Case('note-bulk-bookmark', 'post', format='json', data=lambda ctx: {'add': [ctx['note']]}),
+    Case('note-comments', kwargs=PK),
+    Case('note-download', 'post', kwargs=PK),
+    Case('note-file', kwargs=PK),
+    Case('upload-list', 'post', format='json', data=lambda ctx: {
+        'filename': 'benchmark.pdf', 'size': CHUNK, 'title': 'Benchmark upload', 'description': 'Chunked',
+        'subject_id': ctx['subject'],
+    }),
+    Case('upload-detail', kwargs=UPLOAD_PK),
+    Case('upload-chunk', 'put', kwargs={'pk': 'upload', 'index': 0}, data=CHUNK_DATA,
+         content_type='application/octet-stream', headers=chunk_checksum),
+    # Queues the assembly job, which is rolled back with the request
+    Case('upload-finalize', 'post', kwargs=UPLOAD_PK),
+    Case('upload-detail', 'delete', kwargs=UPLOAD_PK),
+    Case('noterequest-list'),
+    Case('noterequest-list', query='?status=open'),
+    Case('noterequest-list', 'post', format='json', data=lambda ctx: {
+        'title': 'Need notes', 'description': 'Week 3 please', 'subject_id': ctx['subject'],
+    }),
+    Case('noterequest-detail', kwargs=REQUEST_PK),
+    Case('noterequest-detail', 'patch', kwargs=REQUEST_PK, data={'title': 'Renamed'}, format='json'),
+    Case('noterequest-detail', 'put', kwargs=REQUEST_PK, format='json', data=lambda ctx: {
+        'title': 'Need notes', 'description': 'Week 4 please', 'subject_id': ctx['subject'],
+    }),
+    Case('noterequest-detail', 'delete', kwargs=REQUEST_PK),
+    Case('noterequest-comments', kwargs=REQUEST_PK),
+    Case('noterequest-fulfill', 'post', kwargs=REQUEST_PK, data=lambda ctx: {'note_id': ctx['note']}, format='json'),
+    Case('comment-list', query='?note={note}'),
+    Case('comment-list', query='?note={note}&compact=1'),
+    Case('comment-list', 'post', format='json', data=lambda ctx: {
+        'content_type': 'note', 'note_id': ctx['note'], 'text': 'Thanks!', 'parent': ctx['comment'],
+    }),
+    Case('comment-more-replies', query='?token={more_replies}'),
+    Case('comment-detail', kwargs=COMMENT_PK),
+    Case('comment-detail', 'patch', kwargs=COMMENT_PK, data={'text': 'Edited'}, format='json'),
+    Case('comment-detail', 'put', kwargs=COMMENT_PK, format='json', data=lambda ctx: {
+        'content_type': 'note', 'note_id': ctx['note'], 'text': 'Edited',
+    }),
+    Case('comment-detail', 'delete', kwargs=COMMENT_PK),
+    Case('comment-attachment', kwargs={'pk': 'reply'}),
+    Case('notification-list'),
+    Case('notification-list', query='?unread=1'),
+    Case('notification-unread-count'),
+    Case('notification-mark-all-read', 'post'),
+    Case('notification-mark-read', 'post', format='json', data=lambda ctx: {'ids': [ctx['notification']]}),
+    Case('notification-detail', kwargs=NOTIFICATION_PK),
+    Case('notification-detail', 'patch', kwargs=NOTIFICATION_PK, data={'is_read': True}, format='json'),
+    Case('notification-detail', 'put', kwargs=NOTIFICATION_PK, format='json',
+         data={'title': 'Note', 'message': 'Edited', 'is_read': True}),
+    Case('notification-detail', 'delete', kwargs=NOTIFICATION_PK),
+    Case('my-bookmarks'),
+    Case('my-downloads'),
+    Case('dashboard'),
+    # Last: these save the user, which evicts the token from the auth cache for a while
+    Case('profile', 'put', data={'bio': 'Benchmarking'}, format='json'),
+    Case('change-password', 'post', format='json', data={
+        'old_password': PASSWORD, 'new_password': NEW_PASSWORD, 'confirm_new_password': NEW_PASSWORD,
+    }),
+    Case('logout', 'post'),
+]
+
+
+def route_names(patterns=None):
+    names = []
+    for pattern in urls.urlpatterns if patterns is None else patterns:
+        if isinstance(pattern, URLResolver):
+            names.extend(route_names(pattern.url_patterns))
+        elif pattern.name and pattern.name not in names:
+            names.append(pattern.name)
+    return names
+
+
+def uncovered():
+    """Routes in api/urls.py with neither a case nor a reason to skip them"""
+    covered = {case.route for case in CASES} | set(SKIPPED)
+    return [name for name in route_names() if name not in covered]
+
+
+# ==================== MEASUREMENT ====================
+
+def send(client, case, ctx):
+    with transaction.atomic():
+        response = case.request(client, ctx)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        response.close()
+        transaction.set_rollback(True)
+    return response
+
+
+def measure(client, case, ctx, repeat):
+    send(client, case, ctx)  # Warm up caches and lazy imports
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        send(client, case, ctx)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    # Queries and memory on a separate pass, tracing slows everything down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    with CaptureQueriesContext(connection) as queries:
+        response = send(client, case, ctx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'route': case.route,
+        'method': case.method.upper(),
+        'url': case.url(ctx),
+        'status': response.status_code,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries': len(queries),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def run(ctx, repeat=20, only=None, log=print):
+    client = APIClient(raise_request_exception=False)  # A failing case shows up as its status code
+    client.credentials(HTTP_AUTHORIZATION='Token ' + ctx['token'])
+    results = {}
+    for case in CASES:
+        if only and not any(part in case.label for part in only):
+            continue
+        results[case.label] = result = measure(client, case, ctx, max(repeat, 1))
+        log(format_row(case.label, result))
+    return results
+
+
+def format_row(label, result):
+    return (f'{label:<48} {result["status"]:>4} {result["p50_ms"]:>9.2f} {result["p95_ms"]:>9.2f} '
+            f'{result["queries"]:>7} {result["peak_kib"]:>10.1f}')
+
+
+HEADER = f'{"case":<48} {"code":>4} {"p50 ms":>9} {"p95 ms":>9} {"queries":>7} {"peak KiB":>10}'
+
+
+# ==================== PAYLOADS ====================
+
+PAYLOAD_CASES = [
+    Case('note-list'),
+    Case('note-list', query='?compact=1'),
+    Case('my-bookmarks'),
+    Case('note-comments', kwargs=PK),
+    Case('note-comments', kwargs=PK, query='?compact=1'),
+]
+
+
+def median_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def payloads(ctx, repeat=20, only=None, log=print):
+    """Render time per JSON renderer, then size and time per compression, of each PAYLOAD_CASES response"""
+    client = APIClient(raise_request_exception=False)
+    client.credentials(HTTP_AUTHORIZATION='Token ' + ctx['token'])
+    repeat = max(repeat, 1)
+    results = {}
+    for case in PAYLOAD_CASES:
+        if only and not any(part in case.label for part in only):
+            continue
+        response = send(client, case, ctx)
+        data = response.data
+        body = JSONRenderer().render(data)
+        result = {
+            'url': case.url(ctx),
+            'status': response.status_code,
+            'bytes': len(body),
+            'json_ms': median_ms(lambda: JSONRenderer().render(data), repeat),
+            'orjson_ms': None,
+        }
+        if renderers.orjson is not None:
+            result['orjson_ms'] = median_ms(lambda: renderers.FastJSONRenderer().render(data), repeat)
+        for encoding in ('gzip', 'br'):
+            result[f'{encoding}_bytes'] = result[f'{encoding}_ms'] = None
+            if encoding in compression.ENCODINGS:
+                result[f'{encoding}_bytes'] = len(compression.compress(body, encoding))
+                result[f'{encoding}_ms'] = median_ms(lambda: compression.compress(body, encoding), repeat)
+        results[case.label] = result
+        log(format_payload_row(case.label, result))
+    return results
+
+
+def format_payload_row(label, result):
+    def cell(value, unit=1):
+        return '-' if value is None else f'{value / unit:.{1 if unit > 1 else 2}f}'
+    return (f'{label:<48} {result["status"]:>4} {cell(result["bytes"], 1024):>8} {cell(result["json_ms"]):>8} '
+            f'{cell(result["orjson_ms"]):>10} {cell(result["gzip_bytes"], 1024):>9} {cell(result["gzip_ms"]):>8} '
+            f'{cell(result["br_bytes"], 1024):>7} {cell(result["br_ms"]):>6}')
+
+
+PAYLOAD_HEADER = (f'{"payload":<48} {"code":>4} {"KiB":>8} {"json ms":>8} {"orjson ms":>10} {"gzip KiB":>9} '
+                  f'{"gzip ms":>8} {"br KiB":>7} {"br ms":>6}')
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against ``baseline`` results: more queries, or time or memory beyond ``tolerance``"""
+    regressions = []
+    for label, result in results.items():
+        before = baseline.get(label)
+        if before is None:
+            continue
+        if result['status'] != before['status']:
+            regressions.append(f'{label}: status {before["status"]} -> {result["status"]}')
+        if result['queries'] > before['queries']:
+            regressions.append(f'{label}: {before["queries"]} -> {result["queries"]} queries')
+        # Small absolute floors keep timer and allocator noise out
+        if result['p50_ms'] > before['p50_ms'] * (1 + tolerance) and result['p50_ms'] - before['p50_ms'] > 1:
+            regressions.append(f'{label}: p50 {before["p50_ms"]:.2f} -> {result["p50_ms"]:.2f} ms')
+        if result['peak_kib'] > before['peak_kib'] * (1 + tolerance) and result['peak_kib'] - before['peak_kib'] > 64:
+            regressions.append(f'{label}: peak {before["peak_kib"]:.0f} -> {result["peak_kib"]:.0f} KiB')
+    return regressions
@@ -0,0 +1,18 @@
+"""
+Whether a cache is shared between worker processes.
+
+Invalidations written to a per-process cache only reach the process that
+made them, so the caches of api/authentication.py, api/catalog.py and
+api/replicas.py must be shared as soon as there is more than one worker.
+"""
+from django.conf import settings
+
+PROCESS_LOCAL_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+def is_shared(alias='default'):
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    return backend is not None and backend not in PROCESS_LOCAL_BACKENDS
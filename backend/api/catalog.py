@@ -0,0 +1,79 @@
+"""
+Cached subject catalog.
+
+The app loads the subject list at start and it rarely changes, so rendered
+list responses are cached under a version number. Adding, editing or
+removing a subject bumps the version, including a subject created on the fly
+by ``get_or_create`` when a note or request names a new one. The next read
+then renders afresh. The version lives in the default Django cache, and each
+process also keeps the rendered pages in memory. A cache hit costs one small
+cache read and no database query.
+
+A bumped version only reaches the other workers through a shared cache. With
+a per-process one (the LocMem default without ``CACHE_REDIS_URL``) they would
+serve the old list until it expires. So nothing is cached then, unless
+``SUBJECT_CATALOG_LOCAL`` says there is a single process.
+
+``notes_count`` changes with every upload, so it does not bump the version.
+It may lag by up to ``SUBJECT_CATALOG_TTL`` seconds.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from . import caching
+
+TTL = getattr(settings, 'SUBJECT_CATALOG_TTL', 60)
+ENABLED = caching.is_shared() or getattr(settings, 'SUBJECT_CATALOG_LOCAL', False)
+VERSION_KEY = 'subjects:catalog:version'
+MEMORY_ENTRIES = 32
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+
+
+def version():
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        current = cache.get(VERSION_KEY, 1)
+    return current
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, timeout=None)
+    with _lock:
+        _memory.clear()
+
+
+def cached(request, render):
+    """Return ``render()`` for this URL from memory or the cache, rendering it on a miss"""
+    if not ENABLED:
+        return render()
+    url = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    key = f'subjects:catalog:{version()}:{url}'
+    now = time.monotonic()
+
+    with _lock:
+        entry = _memory.get(key)
+        if entry and entry[0] > now:
+            _memory.move_to_end(key)
+            return entry[1]
+
+    data = cache.get(key)
+    if data is None:
+        data = render()
+        cache.set(key, data, TTL)
+
+    with _lock:
+        _memory[key] = (now + TTL, data)
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+    return data
@@ -0,0 +1,68 @@
+"""
+Compact list responses.
+
+A note list repeats the full uploader and subject on every item, though a
+page usually names only a few of each. With ``?compact=1`` the serializers
+in api/serializers.py return these references as ids, and each referenced
+object is serialized once into an ``included`` map next to ``results``::
+
+    {"next": ..., "results": [{"id": 7, "uploaded_by": 3, "subject": 2, ...}],
+     "included": {"users": {"3": {...}}, "subjects": {"2": {...}}}}
+
+Long text fields such as ``description`` are cut to an excerpt of
+``COMPACT_EXCERPT_LENGTH`` characters; the detail endpoint has the full text.
+"""
+from django.conf import settings
+
+EXCERPT_LENGTH = getattr(settings, 'COMPACT_EXCERPT_LENGTH', 160)
+
+TRUE = {'1', 'true', 'yes', 'on'}
+
+
+def requested(request):
+    return request.method == 'GET' and request.query_params.get('compact', '').lower() in TRUE
+
+
+def excerpt(text, length=EXCERPT_LENGTH):
+    """``text`` cut at a word boundary to at most ``length`` characters plus an ellipsis"""
+    if not text or len(text) <= length:
+        return text
+    cut = text[:length]
+    if not text[length].isspace() and ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip(' \n\t.,;:') + '…'
+
+
+class Included:
+    """The objects referenced by one response, each serialized once"""
+
+    def __init__(self):
+        self.data = {}
+
+    def add(self, kind, obj, serializer):
+        objects = self.data.setdefault(kind, {})
+        if obj.pk not in objects:
+            objects[obj.pk] = serializer.to_representation(obj)
+        return obj.pk
+
+
+class CompactResponseMixin:
+    """Serves ``compact_actions`` in the compact form when asked with ``?compact=1``"""
+    compact_actions = ('list',)
+    included = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.action in self.compact_actions and requested(request):
+            self.included = Included()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.included is not None:
+            context['included'] = self.included
+        return context
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.included is not None and response.status_code == 200 and isinstance(response.data, dict):
+            response.data['included'] = self.included.data
+        return super().finalize_response(request, response, *args, **kwargs)
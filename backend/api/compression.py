@@ -0,0 +1,160 @@
+"""
+Response compression negotiated from ``Accept-Encoding``.
+
+Brotli (when the ``brotli`` package is installed) is preferred over gzip at
+equal ``q`` values. Only ``COMPRESSION_CONTENT_TYPES`` are compressed, so
+note files, which are PDFs and images that are compressed already and may
+be served in ranges, pass through untouched. Bodies under
+``COMPRESSION_MIN_SIZE`` are not worth the CPU and headers. Streaming
+responses are compressed chunk by chunk, each chunk flushed so the client
+gets it at once; the notification event stream is ``text/event-stream``
+and is left alone for the same reason.
+
+The default levels suit responses compressed on every request: brotli's
+maximum quality 11 is meant for static files compressed once.
+"""
+import gzip
+import re
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # pip install brotli
+    brotli = None
+
+MIN_SIZE = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+CONTENT_TYPES = tuple(getattr(settings, 'COMPRESSION_CONTENT_TYPES', ('application/json', 'text/html')))
+BROTLI_QUALITY = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5)
+GZIP_LEVEL = getattr(settings, 'COMPRESSION_GZIP_LEVEL', 6)
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+token_re = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def choose_encoding(accept_encoding):
+    """The supported encoding the client ranks highest, None for none"""
+    ranks = {}
+    for part in accept_encoding.lower().split(','):
+        match = token_re.match(part)
+        if match:
+            try:
+                ranks[match[1]] = float(match[2]) if match[2] else 1.0
+            except ValueError:
+                continue
+    best, best_q = None, 0
+    for encoding in ENCODINGS:
+        q = ranks.get(encoding, ranks.get('*', 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Compresses a stream chunk by chunk, ``process`` returns what is ready to send"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, chunk):
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_sequence(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def compress_async_sequence(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    async for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compressible(response):
+    content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+    return (
+        response.status_code == 200
+        and content_type in CONTENT_TYPES
+        and not response.has_header('Content-Encoding')
+        and 'no-transform' not in response.get('Cache-Control', '')
+    )
+
+
+class CompressionMiddleware:
+    """Compresses responses with the best encoding the client accepts, see the module docstring"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if not compressible(response):
+            return response
+        # Vary even when this client gets it uncompressed, caches must not serve it to the next one
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = compress_async_sequence(response.streaming_content, encoding)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            if len(response.content) < MIN_SIZE:
+                return response
+            compressed = compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # The ETag names the uncompressed body, the compressed one is only semantically equal
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,193 @@
+"""
+Write-behind buffering for hot counters such as ``Note.views_count``.
+
+With ``COUNTER_FLUSH_INTERVAL`` set, increments are collected in memory and
+written periodically by a background thread as one ``F()`` update per
+(field, amount) group, so the read path no longer takes the database write
+lock. A flush first takes the pending increments out of the buffer and puts
+them back only if the write fails. The default of 0 writes each increment
+through: buffering suits server processes, which notesharing/asgi.py and
+wsgi.py turn it on for. A short-lived process (a management command, the
+tests) would otherwise start a flusher thread for nothing.
+
+On shutdown the buffer is flushed. If that fails, the increments are spooled
+to a file and replayed by the next flush. A process that is killed outright
+(SIGKILL, out of memory) loses the increments of its last interval at most.
+Each spool file is claimed with a rename and recorded in ``CounterBatch`` in
+the same transaction as its update, so it is applied exactly once. A claim
+left behind by a crashed process is taken over after ``STALE_CLAIM`` seconds.
+The record is dropped with the file, and records older than ``BATCH_RETENTION``
+seconds are pruned on replay.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+STALE_CLAIM = 3600
+BATCH_RETENTION = 24 * 3600
+
+
+class CounterBuffer:
+    """Buffers counter increments per (model, field, pk) and flushes them in batches"""
+
+    def __init__(self, flush_interval, spool_dir):
+        self.flush_interval = flush_interval
+        self.spool_dir = Path(spool_dir)
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._pid = None
+        self._stop = None
+
+    def increment(self, obj, field, amount=1):
+        """
+        Count ``amount`` against ``obj.field`` and add the pending total to the
+        in-memory value, so the caller sees its own increment right away.
+        """
+        key = (obj._meta.label, field, obj.pk)
+        if not self.flush_interval:
+            self._write({key: amount})
+            setattr(obj, field, getattr(obj, field) + amount)
+            return
+
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[key] += amount
+            pending = self._pending[key]
+        setattr(obj, field, getattr(obj, field) + pending)
+
+    def flush(self):
+        """Write buffered increments and any spooled batches, returns rows updated"""
+        updated = self.replay_spool()
+        with self._lock:
+            claimed, self._pending = self._pending, defaultdict(int)
+        if not claimed:
+            return updated
+        try:
+            updated += self._write(claimed)
+        except DatabaseError:
+            logger.exception('Counter flush failed, keeping %d increments buffered', len(claimed))
+            with self._lock:
+                for key, amount in claimed.items():
+                    self._pending[key] += amount
+        return updated
+
+    def _write(self, deltas):
+        # One UPDATE per (model, field, amount) covers every row with that delta.
+        groups = defaultdict(list)
+        for (label, field, pk), amount in deltas.items():
+            groups[(label, field, amount)].append(pk)
+
+        updated = 0
+        with transaction.atomic():
+            for (label, field, amount), pks in groups.items():
+                model = apps.get_model(label)
+                updated += model._base_manager.filter(pk__in=pks).update(**{field: F(field) + amount})
+        return updated
+
+    def spool(self):
+        """Move buffered increments to a spool file, used when the last flush fails"""
+        with self._lock:
+            claimed, self._pending = self._pending, defaultdict(int)
+        if not claimed:
+            return None
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        batch = uuid.uuid4().hex
+        path = self.spool_dir / f'{batch}.json'
+        tmp_path = self.spool_dir / f'{batch}.tmp'
+        tmp_path.write_text(json.dumps([[label, field, pk, amount] for (label, field, pk), amount in claimed.items()]))
+        os.replace(tmp_path, path)
+        return path
+
+    def replay_spool(self):
+        if not self.spool_dir.is_dir():
+            return 0
+
+        from .models import CounterBatch
+
+        updated = 0
+        stale = time.time() - STALE_CLAIM
+        abandoned = [path for path in self.spool_dir.glob('*.claimed') if path.stat().st_mtime < stale]
+        for path in sorted(self.spool_dir.glob('*.json')) + abandoned:
+            batch = path.name.split('.')[0]
+            claimed_path = self.spool_dir / f'{batch}.{uuid.uuid4().hex[:8]}.claimed'
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                continue  # Another process claimed it first
+            os.utime(claimed_path)  # Claimed now, it is abandoned STALE_CLAIM seconds from here
+            deltas = {(label, field, pk): amount for label, field, pk, amount in json.loads(claimed_path.read_text())}
+            try:
+                with transaction.atomic():
+                    _, created = CounterBatch.objects.get_or_create(batch=batch)
+                    if created:
+                        updated += self._write(deltas)
+            except DatabaseError:
+                os.rename(claimed_path, self.spool_dir / f'{batch}.json')
+                raise
+            claimed_path.unlink(missing_ok=True)
+            CounterBatch.objects.filter(batch=batch).delete()
+
+        CounterBatch.objects.filter(applied_at__lt=timezone.now() - timedelta(seconds=BATCH_RETENTION)).delete()
+        return updated
+
+    def _ensure_flusher(self):
+        # Started lazily, and again in forked workers which do not inherit threads.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = defaultdict(int)
+            self._stop = threading.Event()
+            thread = threading.Thread(target=self._run, args=(self._stop,), name='counter-flusher', daemon=True)
+            thread.start()
+            atexit.register(self.shutdown)
+
+    def _run(self, stop):
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Counter flusher error')
+            finally:
+                connection.close()
+
+    def shutdown(self):
+        if self._stop is not None:
+            self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Final counter flush failed')
+        if self._pending:
+            self.spool()
+
+
+buffer = CounterBuffer(
+    flush_interval=getattr(settings, 'COUNTER_FLUSH_INTERVAL', 0),
+    spool_dir=getattr(settings, 'COUNTER_SPOOL_DIR', settings.BASE_DIR / 'counter_spool'),
+)
+
+
+def increment(obj, field, amount=1):
+    buffer.increment(obj, field, amount)
+
+
+def flush():
+    return buffer.flush()
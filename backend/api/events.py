@@ -0,0 +1,249 @@
+"""
+Real-time notification push over Server-Sent Events.
+
+Each ASGI process keeps one ``Hub`` mapping user ids to the queues of that
+user's open streams. A stream is an async generator waiting on its queue, so
+an idle connection costs a coroutine and no thread.
+
+Notifications reach the hub through a fan-out backend, chosen with
+``NOTIFICATION_PUBSUB_BACKEND``. Each process runs one listener task for it,
+however many clients are connected:
+
+* ``DatabaseBackend`` (default) polls for notification rows created since
+  the last poll, in a single query per interval per process. It needs
+  nothing but the database, so it works for a single node with
+  ``runworker`` in its own process.
+* ``RedisBackend`` publishes each new notification to a Redis channel that
+  every process subscribes to, for deployments with many processes or
+  nodes. It needs the ``redis`` package.
+
+Rows do not become visible in id or ``created_at`` order. On PostgreSQL a
+transaction that took id 7 can commit after the one that took id 8. A poll
+for ids above the last one seen would then skip 7 for good. So each poll goes
+``NOTIFICATION_POLL_OVERLAP`` seconds back past the newest ``created_at`` it
+has seen, and skips ids it has already dispatched. Streams drop repeated ids
+in the same way. A reconnecting client also gets the notifications from that
+window again, so it sees late rows too. Clients should ignore an event id they
+already have.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Notification
+from .serializers import NotificationSerializer
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = getattr(settings, 'NOTIFICATION_POLL_INTERVAL', 2)
+HEARTBEAT_INTERVAL = getattr(settings, 'NOTIFICATION_HEARTBEAT_INTERVAL', 15)
+# Longer than any transaction that creates notifications stays open
+OVERLAP = timedelta(seconds=getattr(settings, 'NOTIFICATION_POLL_OVERLAP', 30))
+QUEUE_SIZE = 100
+
+
+def serialize(notification):
+    return json.dumps(NotificationSerializer(notification).data, cls=DjangoJSONEncoder)
+
+
+class Hub:
+    """In-process pub/sub from user id to the event queues of that user's streams"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._listener = None
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(user_id, {})[queue] = loop
+            if self._listener is None or self._listener.done():
+                self._listener = loop.create_task(backend.listen(self))
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id, {})
+            queues.pop(queue, None)
+            if not queues:
+                self._subscribers.pop(user_id, None)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def is_subscribed(self, user_id):
+        return user_id in self._subscribers
+
+    def dispatch(self, user_id, event_id, data):
+        """Hand an event to every stream of ``user_id``, callable from any thread"""
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, {}).items())
+        for queue, loop in queues:
+            loop.call_soon_threadsafe(self._put, queue, (event_id, data))
+
+    @staticmethod
+    def _put(queue, event):
+        if queue.full():
+            queue.get_nowait()  # A client this far behind gets the newest events
+        queue.put_nowait(event)
+
+
+class DatabaseBackend:
+    """Fans out by polling the notification table, the rows themselves are the messages"""
+    batch_size = 500
+    # Ids kept beyond this are forgotten first handled first, such a row is sent again and dropped by the streams
+    max_seen = 5000
+
+    def __init__(self):
+        self.since = None
+        self.seen = {}  # id: created_at, of the rows handled within the overlap window, in the order handled
+
+    def publish(self, notification):
+        pass
+
+    @sync_to_async
+    def fetch(self, hub):
+        """The events of rows not handled yet, and how many rows were new"""
+        if self.since is None or not hub.has_subscribers():
+            # Nobody to deliver to: only keep up with the clock
+            self.since, self.seen = timezone.now(), {}
+            return [], 0
+        # A range of notification_created_idx, without the rows already handled
+        rows = list(
+            Notification.objects.filter(created_at__gte=self.since - OVERLAP).exclude(pk__in=list(self.seen))
+            .order_by('created_at', 'id')[:self.batch_size]
+        )
+        for row in rows:
+            self.seen[row.pk] = row.created_at
+            self.since = max(self.since, row.created_at)
+        start = self.since - OVERLAP
+        kept = [(pk, created_at) for pk, created_at in self.seen.items() if created_at >= start]
+        self.seen = dict(kept[-self.max_seen:])
+        events = [(row.user_id, row.id, serialize(row)) for row in rows if hub.is_subscribed(row.user_id)]
+        return events, len(rows)
+
+    async def listen(self, hub):
+        self.since = None
+        while True:
+            fetched = 0
+            try:
+                events, fetched = await self.fetch(hub)
+            except Exception:
+                logger.exception('Polling for notifications failed')
+            else:
+                for user_id, event_id, data in events:
+                    hub.dispatch(user_id, event_id, data)
+            if fetched < self.batch_size:
+                await asyncio.sleep(POLL_INTERVAL)
+
+
+class RedisBackend:
+    """Fans out through a Redis channel shared by every process"""
+
+    def __init__(self):
+        import redis
+
+        self.url = getattr(settings, 'NOTIFICATION_REDIS_URL', 'redis://localhost:6379/0')
+        self.channel = getattr(settings, 'NOTIFICATION_REDIS_CHANNEL', 'notesharing:notifications')
+        self.client = redis.Redis.from_url(self.url)
+
+    def publish(self, notification):
+        message = json.dumps({'user_id': notification.user_id, 'id': notification.pk, 'data': serialize(notification)})
+        self.client.publish(self.channel, message)
+
+    async def listen(self, hub):
+        import redis.asyncio
+
+        while True:
+            try:
+                client = redis.asyncio.Redis.from_url(self.url)
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            event = json.loads(message['data'])
+                            hub.dispatch(event['user_id'], event['id'], event['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Lost the Redis notification channel, reconnecting')
+                await asyncio.sleep(POLL_INTERVAL)
+
+
+backend = import_string(getattr(settings, 'NOTIFICATION_PUBSUB_BACKEND', 'api.events.DatabaseBackend'))()
+hub = Hub()
+
+
+def publish(notification):
+    try:
+        backend.publish(notification)
+    except Exception:
+        # Clients still see it on their next poll or reconnect
+        logger.exception('Publishing notification %s failed', notification.pk)
+
+
+def format_event(event_id, data):
+    return f'id: {event_id}\nevent: notification\ndata: {data}\n\n'
+
+
+@sync_to_async
+def missed_events(user, last_event_id):
+    """Notifications after ``last_event_id``, and those of the overlap window before it that committed late"""
+    notifications = Notification.objects.filter(user=user)
+    last = notifications.filter(id=last_event_id).values_list('created_at', flat=True).first()
+    missed = Q(id__gt=last_event_id)
+    if last is not None:
+        missed |= Q(created_at__gte=last - OVERLAP)
+    notifications = notifications.filter(missed).order_by('created_at', 'id')[:QUEUE_SIZE]
+    return [(n.id, serialize(n)) for n in notifications]
+
+
+class SentIds:
+    """The ids most recently sent on a stream, ids can arrive out of order"""
+
+    def __init__(self, size=QUEUE_SIZE * 2):
+        self.size = size
+        self.ids = OrderedDict()
+
+    def add(self, event_id):
+        """False if ``event_id`` was sent already"""
+        if event_id in self.ids:
+            return False
+        self.ids[event_id] = None
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return True
+
+
+async def stream(user, last_event_id=None):
+    """Yield SSE frames for ``user`` until the client disconnects"""
+    queue = hub.subscribe(user.pk)
+    sent = SentIds()
+    try:
+        yield 'retry: 5000\n\n'
+        if last_event_id is not None:
+            # Replay what the client missed while reconnecting
+            for event_id, data in await missed_events(user, last_event_id):
+                sent.add(event_id)
+                yield format_event(event_id, data)
+        while True:
+            try:
+                event_id, data = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'  # Keeps proxies from closing an idle connection
+                continue
+            if sent.add(event_id):
+                yield format_event(event_id, data)
+    finally:
+        hub.unsubscribe(user.pk, queue)
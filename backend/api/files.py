@@ -0,0 +1,154 @@
+"""
+Streaming file responses for note files and comment attachments.
+
+Files are read from storage in chunks and never loaded whole. Responses carry
+a strong ETag and Last-Modified so clients can revalidate with a 304, and a
+single byte range (``Range``, guarded by ``If-Range``) can be requested to
+resume an interrupted download.
+
+With ``FILE_SENDFILE_BACKEND`` set, the body is left to the front proxy
+instead: ``'nginx'`` answers with ``X-Accel-Redirect`` to
+``FILE_ACCEL_REDIRECT_PREFIX`` + the path under MEDIA_ROOT, ``'sendfile'`` with
+``X-Sendfile`` and the absolute path (Apache, lighttpd).
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from django.utils.cache import get_conditional_response
+from rest_framework.renderers import JSONRenderer
+
+CHUNK_SIZE = getattr(settings, 'FILE_STREAM_CHUNK_SIZE', 64 * 1024)
+SENDFILE_BACKEND = getattr(settings, 'FILE_SENDFILE_BACKEND', None)
+ACCEL_REDIRECT_PREFIX = getattr(settings, 'FILE_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class AnyMediaRenderer(JSONRenderer):
+    """
+    Lets file endpoints pass content negotiation for any Accept header, such
+    as a download manager asking for application/pdf. Errors are still JSON.
+    """
+    media_type = '*/*'
+    format = 'file'
+
+
+FILE_RENDERERS = [JSONRenderer, AnyMediaRenderer]
+
+
+def file_etag(field_file, size, modified):
+    """Strong validator for the stored version of a file"""
+    digest = getattr(field_file.storage, 'content_hash', lambda name: None)(field_file.name)
+    if digest:
+        return quote_etag(digest)
+    key = f'{field_file.name}:{size}:{modified.timestamp()}'
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single satisfiable byte range, None
+    when the header should be ignored, or False when it is unsatisfiable.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None  # Absent, malformed or multiple ranges: send the whole file
+    first, last = match.groups()
+    if size == 0:
+        return False
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag  # Weak tags never match (RFC 9110 13.1.5)
+    return parse_http_date_safe(if_range) == int(last_modified)
+
+
+def iter_range(file, start, length):
+    try:
+        file.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def serve_file(request, field_file, etag=None):
+    """Stream ``field_file`` with validators, range support and proxy offload"""
+    storage, name = field_file.storage, field_file.name
+    size = storage.size(name)
+    modified = storage.get_modified_time(name)
+    last_modified = modified.timestamp()
+    etag = etag or file_etag(field_file, size, modified)
+
+    validators = HttpResponse()
+    validators['ETag'] = etag
+    validators['Last-Modified'] = http_date(last_modified)
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified), response=validators)
+    if response is not validators:
+        return response
+
+    filename = os.path.basename(name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    if SENDFILE_BACKEND:
+        response = HttpResponse(content_type=content_type)
+        if SENDFILE_BACKEND == 'nginx':
+            # A URI to nginx, which decodes it: legacy names may hold spaces, '%', '?' or non-ASCII characters
+            response['X-Accel-Redirect'] = quote(ACCEL_REDIRECT_PREFIX + getattr(storage, 'physical_name', str)(name))
+        else:
+            response['X-Sendfile'] = storage.path(name)
+    else:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        if byte_range is not None and not if_range_matches(request, etag, last_modified):
+            byte_range = None
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if byte_range is None:
+            response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+            response.block_size = CHUNK_SIZE
+        else:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                iter_range(storage.open(name, 'rb'), start, length),
+                status=206,
+                content_type=content_type,
+            )
+            response['Content-Length'] = str(length)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
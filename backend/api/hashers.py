@@ -0,0 +1,25 @@
+"""
+Password hashers whose cost comes from settings.
+
+``PASSWORD_HASHER_PROFILE`` puts one of them first in ``PASSWORD_HASHERS``.
+A stored hash whose algorithm or cost differs from the first hasher's is
+upgraded on the user's next login (see api/passwords.py), so switching the
+profile or tuning the cost needs no migration.
+"""
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    iterations = getattr(settings, 'PASSWORD_PBKDF2_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    work_factor = getattr(settings, 'PASSWORD_SCRYPT_WORK_FACTOR', 2 ** 14)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """Needs the argon2-cffi package"""
+    time_cost = getattr(settings, 'PASSWORD_ARGON2_TIME_COST', 2)
+    memory_cost = getattr(settings, 'PASSWORD_ARGON2_MEMORY_COST', 19456)
+    parallelism = getattr(settings, 'PASSWORD_ARGON2_PARALLELISM', 1)
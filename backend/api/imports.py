@@ -0,0 +1,275 @@
+"""
+Bulk import of existing note archives.
+
+A manifest (JSON lines or CSV) has one record per note: ``title``, ``file``
+(relative to the files directory), ``subject``, ``email`` of the uploader
+and optionally ``description``, ``tags``, ``full_name``, ``college``,
+``course``, ``year``, ``is_approved`` and ``created_at``.
+
+``Importer.run`` reads the manifest in batches. A thread pool checks the
+records of the next batch and copies their files into blob storage while the
+current batch is written: users, subjects, notes and tags each with one
+``bulk_create``, in a transaction together with the blob references,
+counters and search index entries that the model signals maintain for notes
+saved one by one. After each commit the caller records how many records are
+done, so an interrupted import picks up where it stopped.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from . import catalog, search, stats, storage, tags
+from .models import Note, Subject, User, UserStats
+
+REQUIRED = ('title', 'file', 'subject', 'email')
+FILE_MAX_LENGTH = Note._meta.get_field('file').max_length
+FALSE = {'0', 'false', 'no', 'n', 'off'}
+
+
+class RecordError(Exception):
+    """A manifest record that cannot be imported, the import skips it"""
+
+
+def read_manifest(path, format=None):
+    """(line number, record) for each record of a JSON lines or CSV manifest"""
+    format = format or ('csv' if str(path).lower().endswith('.csv') else 'jsonl')
+    with open(path, newline='', encoding='utf-8') as manifest:
+        if format == 'csv':
+            reader = csv.DictReader(manifest)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for number, line in enumerate(manifest, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except json.JSONDecodeError as exc:
+                yield number, RecordError(f'invalid JSON: {exc}')
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def clean(record):
+    """The Note and User fields of a manifest record, raises RecordError"""
+    if isinstance(record, RecordError):
+        raise record
+    if not isinstance(record, dict):
+        raise RecordError('not an object')
+    missing = [field for field in REQUIRED if not str(record.get(field) or '').strip()]
+    if missing:
+        raise RecordError(f'missing {", ".join(missing)}')
+
+    created_at = record.get('created_at') or None
+    if created_at:
+        try:
+            created_at = parse_datetime(str(created_at))
+        except ValueError:
+            created_at = None
+        if created_at is None:
+            raise RecordError(f'invalid created_at {record["created_at"]!r}')
+        if settings.USE_TZ and timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at)
+
+    record_tags = record.get('tags') or ''
+    if isinstance(record_tags, list):
+        record_tags = ', '.join(str(tag) for tag in record_tags)
+    is_approved = record.get('is_approved', True)
+    if isinstance(is_approved, str):
+        is_approved = is_approved.strip().lower() not in FALSE
+    email = User.objects.normalize_email(str(record['email']).strip())
+
+    return {
+        'title': str(record['title']).strip()[:255],
+        'description': str(record.get('description') or ''),
+        'tags': record_tags[:500],
+        'is_approved': bool(is_approved),
+        'created_at': created_at,
+        'subject': str(record['subject']).strip()[:255],
+        'email': email,
+        'user': {
+            'full_name': str(record.get('full_name') or email.split('@')[0])[:255],
+            **{field: str(record[field])[:255] for field in ('college', 'course', 'year') if record.get(field)},
+        },
+    }
+
+
+class Importer:
+    """Imports manifest records in batches, see the module docstring"""
+
+    def __init__(self, files_dir, batch_size=500, workers=8, log=print):
+        self.files_dir = Path(files_dir).resolve()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.log = log
+        self.subjects = {}  # name -> id
+        self.users = {}  # email -> id
+        self.recheck = False
+        self.totals = {'records': 0, 'notes': 0, 'skipped': 0, 'users': 0, 'subjects': 0, 'bytes': 0}
+
+    def run(self, records, done=0, on_commit=None):
+        """
+        Import ``records`` ((line number, record) pairs) after skipping the
+        first ``done``. ``on_commit(done)`` is called after each batch.
+        """
+        self.recheck = bool(done)
+        self.totals['records'] = done
+        self.started = time.perf_counter()
+        pool = ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix='import')
+        try:
+            pending = None
+            for batch in batched(islice(records, done, None), self.batch_size):
+                # Copy the next batch while this one is written
+                submitted = (batch, [pool.submit(self.prepare, record) for _, record in batch])
+                if pending:
+                    self.commit(*pending, on_commit)
+                pending = submitted
+            if pending:
+                self.commit(*pending, on_commit)
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return self.totals
+
+    def prepare(self, record):
+        """Runs on a worker: check the record and copy its file into blob storage"""
+        fields = clean(record)
+        path = (self.files_dir / str(record['file'])).resolve()
+        if not path.is_relative_to(self.files_dir):
+            raise RecordError(f'{record["file"]} is outside the files directory')
+        try:
+            handle = open(path, 'rb')
+        except OSError as exc:
+            raise RecordError(f'cannot read {record["file"]}: {exc.strerror or exc}')
+        with handle:
+            name, digest = storage.blob_storage.save_unreferenced(
+                f'notes/{path.name}', File(handle), max_length=FILE_MAX_LENGTH,
+            )
+            fields.update(file=name, digest=digest, size=os.fstat(handle.fileno()).st_size)
+        return fields
+
+    def commit(self, batch, futures, on_commit=None):
+        rows = []
+        for (number, _), future in zip(batch, futures):
+            try:
+                rows.append(future.result())
+            except RecordError as exc:
+                self.log(f'Line {number}: skipped, {exc}')
+                self.totals['skipped'] += 1
+
+        with transaction.atomic():
+            notes = self.create_notes(rows) if rows else []
+        self.totals['records'] += len(batch)
+        self.totals['notes'] += len(notes)
+        self.totals['bytes'] += sum(row['size'] for row in rows)
+        if on_commit:
+            on_commit(self.totals['records'])
+        self.report()
+
+    def create_notes(self, rows):
+        user_ids = self.user_ids(rows)
+        subject_ids = self.subject_ids(rows)
+        if self.recheck:
+            # The last batch before an interruption may have committed without reaching the checkpoint
+            self.recheck = False
+            existing = set(Note.objects.filter(file__in=[row['file'] for row in rows])
+                           .values_list('file', 'uploaded_by_id'))
+            rows = [row for row in rows if (row['file'], user_ids[row['email']]) not in existing]
+
+        notes = Note.objects.bulk_create([
+            Note(title=row['title'], description=row['description'], file=row['file'], tags=row['tags'],
+                 is_approved=row['is_approved'], subject_id=subject_ids[row['subject']],
+                 uploaded_by_id=user_ids[row['email']])
+            for row in rows
+        ])
+
+        # bulk_create always stamps created_at with the current time
+        dated = []
+        for note, row in zip(notes, rows):
+            if row['created_at']:
+                note.created_at = row['created_at']
+                dated.append(note)
+        Note.objects.bulk_update(dated, ['created_at'])
+
+        # What the post_save signals do for a note saved on its own
+        self.add_tags(notes)
+        sizes, counts = {}, {}
+        for row in rows:
+            sizes[row['digest']] = row['size']
+            counts[row['digest']] = counts.get(row['digest'], 0) + 1
+        storage.add_references(sizes, counts)
+        deltas = {}
+        for note in notes:
+            for key, delta in stats.note_contribution(note).items():
+                deltas[key] = deltas.get(key, 0) + delta
+        stats.apply(deltas)
+        for note in notes:
+            search.index_object(note)
+        transaction.on_commit(catalog.invalidate)
+        return notes
+
+    def user_ids(self, rows):
+        """{email: user id} for the batch, creating users with an unusable password"""
+        profiles = {}
+        for row in rows:
+            if row['email'] not in self.users:
+                profiles.setdefault(row['email'], row['user'])
+        if profiles:
+            self.users.update(User.objects.filter(email__in=profiles).values_list('email', 'id'))
+            created = User.objects.bulk_create([
+                User(email=email, password=make_password(None), **profile)
+                for email, profile in profiles.items() if email not in self.users
+            ])
+            UserStats.objects.bulk_create([UserStats(user=user) for user in created], ignore_conflicts=True)
+            self.users.update((user.email, user.pk) for user in created)
+            self.totals['users'] += len(created)
+        return self.users
+
+    def subject_ids(self, rows):
+        """{name: subject id}, the oldest subject of that name or a new one"""
+        names = {row['subject'] for row in rows} - self.subjects.keys()
+        if names:
+            self.subjects.update(Subject.objects.filter(name__in=names).order_by('-id').values_list('name', 'id'))
+            created = Subject.objects.bulk_create([
+                Subject(name=name, description=f'Notes for {name}') for name in sorted(names - self.subjects.keys())
+            ])
+            self.subjects.update((subject.name, subject.pk) for subject in created)
+            self.totals['subjects'] += len(created)
+        return self.subjects
+
+    def add_tags(self, notes):
+        names = {note.pk: tags.parse_tags(note.tags) for note in notes}
+        tag_ids = {
+            tag.name: tag.pk
+            for tag in tags.get_or_create_tags(sorted({name for parsed in names.values() for name in parsed}))
+        }
+        Note.tag_set.through.objects.bulk_create([
+            Note.tag_set.through(note_id=note_id, tag_id=tag_ids[name])
+            for note_id, parsed in names.items() for name in parsed
+        ])
+
+    def report(self):
+        totals = self.totals
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        self.log(
+            f'{totals["records"]} records: {totals["notes"]} notes imported, {totals["skipped"]} skipped | '
+            f'{totals["notes"] / elapsed:.0f} notes/s, {totals["bytes"] / elapsed / 2**20:.1f} MB/s'
+        )
@@ -0,0 +1,175 @@
+"""
+Durable background jobs kept in the database (a transactional outbox).
+
+``enqueue`` inserts a ``Job`` row, so a job queued inside a transaction is
+committed or rolled back together with the change that caused it and no
+broker is needed. ``manage.py runworker`` claims due jobs in batches and runs
+them on a thread pool.
+
+Claiming uses ``SELECT ... FOR UPDATE SKIP LOCKED`` where the database
+supports it. On SQLite, a conditional ``UPDATE`` takes a lease instead. A job
+whose lease runs out, for example because its worker died, is claimed again.
+Failed jobs are retried with exponential backoff and jitter until
+``max_attempts``. After that they stay in the table as ``failed``, and the
+handler's ``on_failure`` callback, if it has one, is called with the payload.
+
+A handler runs in one transaction with the deletion of its job. A worker that
+lost its lease finds the row gone or owned by another worker, and rolls the
+handler back. So a handler's database writes happen exactly once. Anything it
+does outside the database, such as sending mail, happens at least once.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = getattr(settings, 'JOB_BACKOFF_BASE', 5)
+BACKOFF_MAX = getattr(settings, 'JOB_BACKOFF_MAX', 3600)
+
+HANDLERS = {}
+FAILURE_HANDLERS = {}
+
+
+def register(name, on_failure=None):
+    """
+    Decorator registering a job handler, called with the payload as keyword
+    arguments. ``on_failure`` is called the same way once the job has failed
+    for good.
+    """
+    def decorator(func):
+        HANDLERS[name] = func
+        if on_failure is not None:
+            FAILURE_HANDLERS[name] = on_failure
+        return func
+    return decorator
+
+
+def give_up(job):
+    on_failure = FAILURE_HANDLERS.get(job.name)
+    if on_failure is not None:
+        try:
+            on_failure(**job.payload)
+        except Exception:
+            logger.exception('Failure handler of job %s (%s) failed', job.pk, job.name)
+
+
+def enqueue(name, payload=None, delay=0, max_attempts=5):
+    if name not in HANDLERS:
+        raise ValueError(f'No job handler registered for {name!r}')
+    return Job.objects.create(
+        name=name,
+        payload=payload or {},
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts,
+    )
+
+
+def due(now):
+    """Jobs waiting to run, or running under a lease that has expired"""
+    return Q(status='queued', run_at__lte=now) | Q(status='running', locked_until__lt=now)
+
+
+def claim(worker_id, limit, lease):
+    """Lease up to ``limit`` due jobs to this worker and return them"""
+    now = timezone.now()
+    token = f'{worker_id}:{uuid.uuid4().hex[:8]}'
+    claimed = dict(status='running', locked_by=token, locked_until=now + timedelta(seconds=lease),
+                   attempts=F('attempts') + 1)
+    candidates = Job.objects.filter(due(now)).order_by('run_at', 'id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(candidates.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Job.objects.filter(pk__in=ids).update(**claimed)
+    else:
+        # No row locks: the UPDATE re-checks due() so two workers racing for the
+        # same rows cannot both win them.
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        Job.objects.filter(due(now), pk__in=ids).update(**claimed)
+    # By primary key, locked_by only tells which of them this worker won
+    return list(Job.objects.filter(pk__in=ids, locked_by=token))
+
+
+class LeaseLost(Exception):
+    """The job was claimed again or finished by another worker while this one ran it"""
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+def run(job):
+    """Run one claimed job and record the outcome, unless its lease was taken over meanwhile"""
+    mine = Job.objects.filter(pk=job.pk, locked_by=job.locked_by)
+    handler = HANDLERS.get(job.name)
+    try:
+        if handler is None:
+            raise LookupError(f'No job handler registered for {job.name!r}')
+        with transaction.atomic():
+            handler(**job.payload)
+            # Commits the handler's writes only if this worker still owns the job
+            if not mine.delete()[0]:
+                raise LeaseLost
+    except LeaseLost:
+        logger.warning('Job %s (%s) was taken over by another worker, rolled back', job.pk, job.name)
+    except Exception:
+        error = traceback.format_exc()
+        if handler is None or job.attempts >= job.max_attempts:
+            logger.error('Job %s (%s) failed for good:\n%s', job.pk, job.name, error)
+            if mine.update(status='failed', last_error=error, locked_by='', locked_until=None):
+                give_up(job)
+        else:
+            logger.warning('Job %s (%s) failed, attempt %s of %s', job.pk, job.name, job.attempts, job.max_attempts)
+            mine.update(status='queued', last_error=error, locked_by='', locked_until=None,
+                        run_at=timezone.now() + timedelta(seconds=backoff(job.attempts)))
+    finally:
+        connection.close()
+
+
+class Worker:
+    """Claims jobs in batches and runs them on ``concurrency`` threads"""
+
+    def __init__(self, concurrency=4, batch_size=20, poll_interval=1.0, lease=300):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.worker_id = f'{socket.gethostname()[:40]}:{os.getpid()}'
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, once=False):
+        """Process jobs until stopped, or with ``once`` until no job is due"""
+        processed = 0
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='job') as executor:
+            while not self._stop.is_set():
+                free = self.concurrency - len(running)
+                jobs = claim(self.worker_id, min(free, self.batch_size), self.lease) if free else []
+                running.update(executor.submit(run, job) for job in jobs)
+                processed += len(jobs)
+
+                if not running:
+                    if once:
+                        break
+                    self._stop.wait(self.poll_interval)
+                    continue
+                # Claim more as soon as a slot frees up, or poll again after the interval
+                _, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+        return processed
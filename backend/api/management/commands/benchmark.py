@@ -0,0 +1,111 @@
+import json
+import platform
+import tempfile
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from api import benchmarks, counters, uploads
+from api.models import Note, UploadSession
+
+
+class Command(BaseCommand):
+    help = ('Generate a synthetic dataset in a separate database and measure latency, queries '
+            'and memory of every API route, optionally against a baseline')
+
+    def add_arguments(self, parser):
+        dataset = parser.add_argument_group('dataset')
+        dataset.add_argument('--users', type=int, default=2000)
+        dataset.add_argument('--notes', type=int, default=20000)
+        dataset.add_argument('--downloads', type=int, default=100000, help='Bookmarks are a fifth of this')
+        dataset.add_argument('--requests', type=int, default=5000)
+        dataset.add_argument('--threads', type=int, default=200, help='Comment threads')
+        dataset.add_argument('--thread-depth', type=int, default=6, help='Reply levels below each thread')
+        dataset.add_argument('--branching', type=int, default=2, help='Replies to each comment')
+        dataset.add_argument('--notifications', type=int, default=10000)
+        dataset.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk_create')
+        dataset.add_argument('--seed', type=int, default=1)
+        dataset.add_argument('--keepdb', action='store_true',
+                             help='Keep the benchmark database and reuse its dataset next time')
+
+        parser.add_argument('--repeat', type=int, default=20, help='Timed requests per case')
+        parser.add_argument('--only', action='append', help='Only cases whose label contains this, repeatable')
+        parser.add_argument('--output', default='benchmark-results.json', help='Where to write the results')
+        parser.add_argument('--baseline', help='Results file to compare with, exits non-zero on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed slowdown or memory growth over the baseline, as a fraction')
+
+    def handle(self, *args, **options):
+        missing = benchmarks.uncovered()
+        if missing:
+            raise CommandError(f'Routes without a benchmark case in api/benchmarks.py: {", ".join(missing)}')
+        baseline = None
+        if options['baseline']:
+            baseline = json.loads(Path(options['baseline']).read_text())['results']
+
+        keepdb = options['keepdb']
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # On disk like production, not the in-memory database tests use
+            connection.settings_dict['TEST']['NAME'] = str(settings.BASE_DIR / 'benchmark.sqlite3')
+
+        setup_test_environment()
+        # Counters written inline roll back with each request, with no flusher thread competing for
+        # the database or spooling increments for the real one
+        flush_interval, counters.buffer.flush_interval = counters.buffer.flush_interval, 0
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+        try:
+            with tempfile.TemporaryDirectory(prefix='benchmark-media-') as media, override_settings(MEDIA_ROOT=media):
+                if keepdb and Note.objects.exists():
+                    self.stdout.write('Reusing the kept dataset')
+                else:
+                    benchmarks.generate(
+                        users=options['users'], notes=options['notes'], downloads=options['downloads'],
+                        requests=options['requests'], threads=options['threads'],
+                        thread_depth=options['thread_depth'], branching=options['branching'],
+                        notifications=options['notifications'], batch_size=options['batch_size'],
+                        seed=options['seed'], log=self.stdout.write,
+                    )
+                ctx = benchmarks.context()
+                self.stdout.write(benchmarks.HEADER)
+                results = benchmarks.run(ctx, options['repeat'], options['only'], self.stdout.write)
+                self.stdout.write(benchmarks.PAYLOAD_HEADER)
+                payloads = benchmarks.payloads(ctx, options['repeat'], options['only'], self.stdout.write)
+                for session in UploadSession.objects.filter(pk=ctx['upload']):
+                    uploads.discard(session)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+            counters.buffer.flush_interval = flush_interval
+            teardown_test_environment()
+
+        output = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'dataset': {name: options[name] for name in (
+                    'users', 'notes', 'downloads', 'requests', 'threads', 'thread_depth', 'branching',
+                    'notifications', 'seed',
+                )},
+                'repeat': options['repeat'],
+                'orjson': benchmarks.renderers.orjson is not None,
+                'brotli': benchmarks.compression.brotli is not None,
+            },
+            'skipped': benchmarks.SKIPPED,
+            'results': results,
+            'payloads': payloads,
+        }
+        Path(options['output']).write_text(json.dumps(output, indent=2) + '\n')
+        self.stdout.write(f'Wrote {len(results)} results to {options["output"]}')
+
+        if baseline is not None:
+            regressions = benchmarks.compare(results, baseline, options['tolerance'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}')
+            self.stdout.write(f'No regressions against {options["baseline"]}')
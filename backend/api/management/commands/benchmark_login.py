@@ -0,0 +1,51 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+PASSWORD = 'correct horse battery staple'
+
+
+class Command(BaseCommand):
+    help = 'Measure password checks (the CPU cost of a login) per second and per core for each hasher profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', action='append', choices=sorted(settings.PASSWORD_HASHER_PROFILES),
+                            help='Hasher profile to measure, repeatable (default: all)')
+        parser.add_argument('--logins', type=int, default=100, help='Password checks per run')
+        parser.add_argument('--workers', type=int, action='append',
+                            help='Hashing threads, repeatable (default: 1 and the number of cores)')
+
+    def handle(self, *args, **options):
+        cores = os.cpu_count() or 1
+        profiles = options['profile'] or list(settings.PASSWORD_HASHER_PROFILES)
+        worker_counts = options['workers'] or sorted({1, cores})
+        logins = options['logins']
+        if logins < 1:
+            raise CommandError('--logins must be at least 1')
+
+        self.stdout.write(f'{cores} cores, {logins} logins per run')
+        self.stdout.write(f'{"profile":<8} {"workers":>7} {"logins/s":>10} {"per core":>10} {"ms/login":>9}')
+        for profile in profiles:
+            hasher = import_string(settings.PASSWORD_HASHER_PROFILES[profile])()
+            try:
+                encoded = hasher.encode(PASSWORD, hasher.salt())
+            except ValueError as exc:
+                self.stdout.write(f'{profile:<8} skipped: {exc}')
+                continue
+
+            for workers in worker_counts:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    start = time.perf_counter()
+                    checks = list(pool.map(lambda _: hasher.verify(PASSWORD, encoded), range(logins)))
+                    elapsed = time.perf_counter() - start
+                if not all(checks):
+                    raise CommandError(f'{profile} failed to verify its own hash')
+                rate = logins / elapsed
+                self.stdout.write(
+                    f'{profile:<8} {workers:>7} {rate:>10.1f} {rate / min(workers, cores):>10.1f} '
+                    f'{elapsed / logins * workers * 1000:>9.1f}'
+                )
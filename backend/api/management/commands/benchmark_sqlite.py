@@ -0,0 +1,140 @@
+import random
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+from api.models import Note, Subject, User
+
+MODES = {
+    'default': {},
+    'tuned': settings.SQLITE_TUNED_OPTIONS,
+}
+
+
+class Command(BaseCommand):
+    help = ('Measure concurrent read and write throughput of SQLite with the default and the '
+            'SQLITE_TUNED settings, on a scratch copy of the schema')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8, help='Threads listing and opening notes')
+        parser.add_argument('--writers', type=int, default=4,
+                            help='Threads counting views and uploading notes')
+        parser.add_argument('--seconds', type=float, default=10, help='Duration per mode')
+        parser.add_argument('--notes', type=int, default=5000, help='Notes in the scratch database')
+        parser.add_argument('--mode', action='append', choices=sorted(MODES), help='Repeatable (default: all)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('benchmark_sqlite needs the SQLite database backend')
+        if connection.is_in_memory_db():
+            # Closing its connection does nothing, the scratch databases would never be used
+            raise CommandError('benchmark_sqlite needs a database file, not an in-memory database')
+        settings_dict = connection.settings_dict
+        saved = settings_dict['NAME'], settings_dict['OPTIONS']
+        connection.close()
+
+        try:
+            with tempfile.TemporaryDirectory(prefix='benchmark-sqlite-') as scratch:
+                template = Path(scratch) / 'template.sqlite3'
+                self.use(template, {})
+                call_command('migrate', verbosity=0, interactive=False)
+                note_ids = self.seed(options['notes'])
+                connection.close()
+
+                self.stdout.write(f'{options["readers"]} readers, {options["writers"]} writers, '
+                                  f'{options["seconds"]:g}s per mode')
+                self.stdout.write(f'{"mode":<8} {"reads/s":>9} {"writes/s":>9} {"locked":>7} {"p99 write ms":>13}')
+                for mode in options['mode'] or list(MODES):
+                    path = Path(scratch) / f'{mode}.sqlite3'
+                    shutil.copy(template, path)
+                    self.use(path, MODES[mode])
+                    self.stdout.write(self.measure(mode, note_ids, options))
+                    connection.close()
+        finally:
+            settings_dict['NAME'], settings_dict['OPTIONS'] = saved
+            connection.close()
+
+    def use(self, path, options):
+        """Point the default alias at ``path``, threads connect with these settings"""
+        connection.settings_dict['NAME'] = str(path)
+        connection.settings_dict['OPTIONS'] = dict(options)
+
+    def seed(self, count):
+        user = User.objects.create(email='benchmark@example.com', full_name='Benchmark', password='!')
+        subject = Subject.objects.create(name='Benchmark')
+        Note.objects.bulk_create(
+            (Note(title=f'Note {i}', description='Notes', file=f'notes/{i}.pdf', subject=subject,
+                  uploaded_by=user) for i in range(max(count, 1))),
+            batch_size=1000,
+        )
+        return list(Note.objects.values_list('id', flat=True))
+
+    def measure(self, mode, note_ids, options):
+        stop = threading.Event()
+        lock = threading.Lock()
+        totals = {'reads': 0, 'writes': 0, 'locked': 0}
+        write_times = []
+        user_id = User.objects.values_list('id', flat=True).first()
+        subject_id = Subject.objects.values_list('id', flat=True).first()
+        connection.close()
+
+        def read():
+            # The feed page and a note, as NoteViewSet.list and retrieve query them
+            list(Note.objects.filter(is_approved=True).order_by('-created_at', '-id')[:20])
+            Note.objects.get(pk=random.choice(note_ids))
+
+        def write():
+            # What retrieve and upload do: read a row, then write in the same transaction
+            with transaction.atomic():
+                note = Note.objects.get(pk=random.choice(note_ids))
+                Note.objects.filter(pk=note.pk).update(views_count=F('views_count') + 1)
+                if random.random() < 0.1:
+                    # The row an upload inserts, without the thumbnail rendering its signals would start
+                    Note.objects.bulk_create([Note(title='Upload', description='Notes', file='notes/upload.pdf',
+                                                   subject_id=subject_id, uploaded_by_id=user_id)])
+
+        def worker(kind, operation):
+            done = locked = 0
+            timings = []
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        operation()
+                    except OperationalError as exc:
+                        if 'locked' not in str(exc):
+                            raise
+                        locked += 1
+                        continue
+                    done += 1
+                    if kind == 'writes':
+                        timings.append(time.perf_counter() - start)
+            finally:
+                connection.close()
+            with lock:
+                totals[kind] += done
+                totals['locked'] += locked
+                write_times.extend(timings)
+
+        threads = [threading.Thread(target=worker, args=('reads', read)) for _ in range(options['readers'])]
+        threads += [threading.Thread(target=worker, args=('writes', write)) for _ in range(options['writers'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(options['seconds'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        write_times.sort()
+        p99 = write_times[int(len(write_times) * 0.99)] * 1000 if write_times else float('nan')
+        return (f'{mode:<8} {totals["reads"] / elapsed:>9.0f} {totals["writes"] / elapsed:>9.0f} '
+                f'{totals["locked"]:>7} {p99:>13.1f}')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from api import counters
+
+
+class Command(BaseCommand):
+    help = 'Apply counter increments spooled by workers that could not flush on shutdown'
+
+    def handle(self, *args, **options):
+        updated = counters.buffer.replay_spool()
+        self.stdout.write(f'Updated {updated} counters')
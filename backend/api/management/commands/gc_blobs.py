@@ -0,0 +1,116 @@
+import os
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from api.models import Blob, Comment, Note
+from api.storage import BLOB_DIR, blob_storage
+
+
+class Command(BaseCommand):
+    help = 'Recount blob references and delete blobs no note file or attachment points to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Keep blobs referenced or stored more recently than this, they may belong '
+                                 'to an upload in flight')
+        parser.add_argument('--scan', action='store_true',
+                            help='Also walk the blob directory for files that have no Blob row')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        dry_run = options['dry_run']
+        refs = self.count_references()
+
+        # Candidates from a snapshot, each is then checked again with its row locked
+        candidates = [
+            blob.pk for blob in Blob.objects.filter(referenced_at__lt=cutoff).only('sha256', 'ref_count').iterator()
+            if blob.ref_count != refs[blob.sha256] or not refs[blob.sha256]
+        ]
+        recounted = deleted = freed = 0
+        for pk in candidates:
+            outcome, size = self.collect(pk, cutoff, dry_run)
+            recounted += outcome == 'recounted'
+            if outcome == 'deleted':
+                deleted += 1
+                freed += size
+
+        if options['scan']:
+            orphans, orphan_bytes = self.scan(refs, cutoff.timestamp(), dry_run)
+            deleted += orphans
+            freed += orphan_bytes
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(f'Recounted {recounted} blobs. {verb} {deleted} blobs, {freed} bytes')
+
+    def collect(self, pk, cutoff, dry_run):
+        """
+        Recount one blob and delete it if nothing points to it. The row stays
+        locked until the file is gone, so storage._save either counts its
+        reference before the check, or after the deletion and then writes the
+        file again.
+        """
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(pk=pk, referenced_at__lt=cutoff).first()
+            if blob is None:
+                return 'referenced', 0
+            count = self.count_blob_references(blob.sha256)
+            if count or self.recently_stored(blob.sha256, cutoff):
+                if count == blob.ref_count:
+                    return 'kept', 0
+                if not dry_run:
+                    Blob.objects.filter(pk=pk).update(ref_count=count)
+                return 'recounted', 0
+            if not dry_run:
+                blob.delete()
+                self.remove_blob(blob.sha256)
+            return 'deleted', blob.size
+
+    def count_blob_references(self, digest):
+        segment = f'/{digest}/'
+        return (Note.objects.filter(file__contains=segment).count()
+                + Comment.objects.filter(attachment__contains=segment).count())
+
+    def recently_stored(self, digest, cutoff):
+        try:
+            return os.path.getmtime(blob_storage.path(blob_storage.blob_name(digest))) >= cutoff.timestamp()
+        except FileNotFoundError:
+            return False
+
+    def count_references(self):
+        refs = Counter()
+        names = [
+            Note.objects.values_list('file', flat=True),
+            Comment.objects.exclude(attachment='').exclude(attachment__isnull=True).values_list('attachment', flat=True),
+        ]
+        for queryset in names:
+            for name in queryset.iterator():
+                digest = blob_storage.content_hash(name)
+                if digest:
+                    refs[digest] += 1
+        return refs
+
+    def remove_blob(self, digest):
+        try:
+            os.remove(blob_storage.path(blob_storage.blob_name(digest)))
+        except FileNotFoundError:
+            pass
+
+    def scan(self, refs, cutoff, dry_run):
+        """Delete blob files with neither references nor a Blob row, and stale temp files"""
+        known = set(Blob.objects.values_list('sha256', flat=True))
+        deleted = freed = 0
+        for root, _, files in os.walk(blob_storage.path(BLOB_DIR)):
+            for filename in files:
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                if stat.st_mtime >= cutoff or filename in known or refs[filename]:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+                deleted += 1
+                freed += stat.st_size
+        return deleted, freed
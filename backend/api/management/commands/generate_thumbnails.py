@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from api import thumbnails
+from api.models import Note
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnails for notes that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help='Also retry notes whose rendering failed')
+        parser.add_argument('--all', action='store_true', help='Render every note again')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        notes = Note.objects.all()
+        if not options['all']:
+            statuses = ['pending', 'failed'] if options['retry_failed'] else ['pending']
+            notes = notes.filter(thumbnail_status__in=statuses)
+        note_ids = list(notes.order_by('id').values_list('id', flat=True))
+
+        results = {}
+        batch_size = options['batch_size']
+        with ThreadPoolExecutor(max_workers=max(thumbnails.WORKERS, 1)) as executor:
+            for start in range(0, len(note_ids), batch_size):
+                batch = note_ids[start:start + batch_size]
+                # Each thread waits on one render in the process pool
+                for status in executor.map(thumbnails.generate_now, batch):
+                    results[status] = results.get(status, 0) + 1
+                self.stdout.write(f'{start + len(batch)}/{len(note_ids)} notes')
+
+        summary = ', '.join(f'{count} {status}' for status, count in results.items() if status) or 'nothing to do'
+        self.stdout.write(f'Done: {summary}')
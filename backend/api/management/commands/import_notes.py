@@ -0,0 +1,52 @@
+import json
+import os
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from api import imports
+
+
+class Command(BaseCommand):
+    help = ('Import notes with their uploaders and subjects from a JSON lines or CSV manifest and a '
+            'directory of files. Imported users get an unusable password')
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='One record per note, see api/imports.py for the fields')
+        parser.add_argument('files', help='Directory the manifest file paths are relative to')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='Default: from the manifest extension')
+        parser.add_argument('--batch-size', type=int, default=500, help='Records per transaction')
+        parser.add_argument('--workers', type=int, default=8, help='Threads copying files')
+        parser.add_argument('--checkpoint', help='Progress file (default: <manifest>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+
+    def handle(self, *args, **options):
+        manifest = Path(options['manifest']).resolve()
+        if not manifest.is_file():
+            raise CommandError(f'No manifest at {manifest}')
+        if not Path(options['files']).is_dir():
+            raise CommandError(f'No directory at {options["files"]}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        checkpoint = Path(options['checkpoint'] or f'{manifest}.checkpoint')
+
+        done = 0
+        if checkpoint.exists() and not options['restart']:
+            state = json.loads(checkpoint.read_text())
+            if state['manifest'] != str(manifest):
+                raise CommandError(f'{checkpoint} belongs to {state["manifest"]}, pass --restart to start over')
+            done = state['records']
+            self.stdout.write(f'Resuming after {done} records')
+
+        def save_checkpoint(records):
+            tmp = checkpoint.with_name(checkpoint.name + '.tmp')
+            tmp.write_text(json.dumps({'manifest': str(manifest), 'records': records}))
+            os.replace(tmp, checkpoint)
+
+        importer = imports.Importer(options['files'], batch_size=options['batch_size'],
+                                    workers=options['workers'], log=self.stdout.write)
+        totals = importer.run(imports.read_manifest(manifest, options['format']), done, save_checkpoint)
+
+        self.stdout.write(
+            f'Done: {totals["notes"]} notes, {totals["users"]} new users, {totals["subjects"]} new subjects, '
+            f'{totals["skipped"]} records skipped. Run generate_thumbnails to render their thumbnails'
+        )
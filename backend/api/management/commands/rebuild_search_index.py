@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from api.models import Note, NoteRequest
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for notes and note requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None, help='Database alias to rebuild the index on')
+
+    def handle(self, *args, **options):
+        for model in (Note, NoteRequest):
+            count = search.rebuild_index(model, using=options['database'])
+            self.stdout.write(f'Indexed {count} {model._meta.verbose_name_plural}')
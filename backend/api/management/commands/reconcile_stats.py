@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from api import stats
+from api.models import SiteStats, Subject, User, UserStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute dashboard, badge and subject counters from the tables and report drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        fields = list(stats.USER_COUNTERS)
+        counts = stats.recount_users()
+        existing = {row.pk: row for row in UserStats.objects.all()}
+
+        drifted, missing = [], []
+        for user_id in User.objects.values_list('id', flat=True).iterator():
+            expected = {field: counts.get(user_id, {}).get(field, 0) for field in fields}
+            row = existing.get(user_id)
+            if row is None:
+                missing.append(UserStats(user_id=user_id, **expected))
+                continue
+            drift = {field: getattr(row, field) - value for field, value in expected.items() if getattr(row, field) != value}
+            if drift:
+                self.stdout.write(f'User {user_id}: ' + ', '.join(f'{field} off by {diff:+d}' for field, diff in drift.items()))
+                for field, value in expected.items():
+                    setattr(row, field, value)
+                drifted.append(row)
+
+        site_expected = stats.recount_site()
+        site_row = SiteStats.objects.filter(pk=stats.SITE).first()
+        site_drift = {
+            field: (getattr(site_row, field) if site_row else 0) - value
+            for field, value in site_expected.items()
+            if site_row is None or getattr(site_row, field) != value
+        }
+        if site_drift:
+            self.stdout.write('Site: ' + ', '.join(f'{field} off by {diff:+d}' for field, diff in site_drift.items()))
+
+        subject_counts = stats.recount_subjects()
+        subjects = []
+        for subject in Subject.objects.only('id', 'notes_count').iterator():
+            expected = subject_counts.get(subject.pk, 0)
+            if subject.notes_count != expected:
+                self.stdout.write(f'Subject {subject.pk}: notes_count off by {subject.notes_count - expected:+d}')
+                subject.notes_count = expected
+                subjects.append(subject)
+
+        if not dry_run:
+            Subject.objects.bulk_update(subjects, ['notes_count'], batch_size=500)
+            UserStats.objects.bulk_create(missing, batch_size=500, ignore_conflicts=True)
+            UserStats.objects.bulk_update(drifted, fields, batch_size=500)
+            SiteStats.objects.update_or_create(pk=stats.SITE, defaults=site_expected)
+
+        verb = 'Found' if dry_run else 'Fixed'
+        self.stdout.write(f'{verb} {len(drifted)} drifted and {len(missing)} missing user rows, '
+                          f'{len(subjects)} drifted subjects, site counters {"drifted" if site_drift else "in step"}')
@@ -0,0 +1,30 @@
+import signal
+
+from django.core.management.base import BaseCommand
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Jobs run at the same time')
+        parser.add_argument('--batch-size', type=int, default=20, help='Jobs claimed per query')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between polls when idle')
+        parser.add_argument('--lease', type=int, default=300,
+                            help='Seconds a claimed job is reserved before another worker may retry it')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due')
+
+    def handle(self, *args, **options):
+        worker = jobs.Worker(
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'],
+            poll_interval=options['poll_interval'],
+            lease=options['lease'],
+        )
+        # Finish the jobs in hand and exit on Ctrl-C or SIGTERM
+        signal.signal(signal.SIGINT, lambda *_: worker.stop())
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+        self.stdout.write(f'Worker {worker.worker_id} running {worker.concurrency} jobs at a time')
+        processed = worker.run(once=options['once'])
+        self.stdout.write(f'Processed {processed} jobs')
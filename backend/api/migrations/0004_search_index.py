@@ -0,0 +1,64 @@
+from django.db import migrations
+
+# The index as this migration created it, written out so that later changes to
+# api.search cannot change what the migration does.
+INDEXES = [
+    ('api.Note', 'api_note_search', ['title', 'tags', 'description']),
+    ('api.NoteRequest', 'api_noterequest_search', ['title', 'description']),
+]
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+    "{columns}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+SQLITE_INSERT = 'INSERT INTO {table} (rowid, {columns}) VALUES (%s, {placeholders})'
+
+POSTGRESQL_CREATE = [
+    'CREATE TABLE IF NOT EXISTS {table} (object_id bigint PRIMARY KEY, document tsvector NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS {table}_document ON {table} USING gin (document)',
+]
+POSTGRESQL_INSERT = 'INSERT INTO {table} (object_id, document) VALUES (%s, {document})'
+POSTGRESQL_LABELS = ['A', 'B', 'C', 'D']
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    with connection.cursor() as cursor:
+        for model_label, table, fields in INDEXES:
+            if connection.vendor == 'sqlite':
+                cursor.execute(SQLITE_CREATE.format(table=table, columns=', '.join(fields)))
+                insert = SQLITE_INSERT.format(
+                    table=table, columns=', '.join(fields), placeholders=', '.join(['%s'] * len(fields))
+                )
+            else:
+                for sql in POSTGRESQL_CREATE:
+                    cursor.execute(sql.format(table=table))
+                document = ' || '.join(
+                    f"setweight(to_tsvector('english', %s), '{label}')" for label in POSTGRESQL_LABELS[:len(fields)]
+                )
+                insert = POSTGRESQL_INSERT.format(table=table, document=document)
+            model = apps.get_model(model_label)
+            rows = model.objects.using(connection.alias).values_list('pk', *fields)
+            for row in rows.iterator():
+                cursor.execute(insert, [row[0], *(value or '' for value in row[1:])])
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for model_label, table, fields in INDEXES:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_alter_user_options_alter_user_managers_and_more"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
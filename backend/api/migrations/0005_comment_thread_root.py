@@ -0,0 +1,56 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_thread_root(apps, schema_editor):
+    Comment = apps.get_model("api", "Comment")
+    threads = {}
+    pending = list(Comment.objects.order_by("id").values_list("id", "parent_id"))
+    # Replies are normally created after their parent, but loop until every
+    # comment has been placed in case ids are out of order.
+    while pending:
+        remaining = []
+        for comment_id, parent_id in pending:
+            if parent_id is None:
+                threads[comment_id] = (None, 0)
+            elif parent_id in threads:
+                root_id, depth = threads[parent_id]
+                threads[comment_id] = (root_id or parent_id, depth + 1)
+            else:
+                remaining.append((comment_id, parent_id))
+        if len(remaining) == len(pending):
+            break
+        pending = remaining
+
+    for comment_id, (root_id, depth) in threads.items():
+        if root_id is not None:
+            Comment.objects.filter(id=comment_id).update(root_id=root_id, depth=depth)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_search_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="root",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="thread",
+                to="api.comment",
+            ),
+        ),
+        migrations.RunPython(backfill_thread_root, migrations.RunPython.noop),
+    ]
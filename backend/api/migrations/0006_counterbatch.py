@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_comment_thread_root"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CounterBatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("batch", models.CharField(max_length=32, unique=True)),
+                ("applied_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:38
+
+from django.db import migrations, models
+
+from api import tags
+
+
+def backfill_tags(apps, schema_editor):
+    Note = apps.get_model("api", "Note")
+    Tag = apps.get_model("api", "Tag")
+    Through = Note.tag_set.through
+
+    notes = Note.objects.exclude(tags__isnull=True).exclude(tags="").values_list("id", "tags")
+    for batch_start in range(0, notes.count(), 1000):
+        batch = list(notes.order_by("id")[batch_start:batch_start + 1000])
+        names = {name for _, value in batch for name in tags.parse_tags(value)}
+        tag_ids = {tag.name: tag.id for tag in tags.get_or_create_tags(list(names), Tag)}
+        Through.objects.bulk_create(
+            [
+                Through(note_id=note_id, tag_id=tag_ids[name])
+                for note_id, value in batch
+                for name in tags.parse_tags(value)
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_counterbatch"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tag",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                "ordering": ["name"],
+            },
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="tag_set",
+            field=models.ManyToManyField(blank=True, related_name="notes", to="api.tag"),
+        ),
+        migrations.RunPython(backfill_tags, migrations.RunPython.noop),
+    ]
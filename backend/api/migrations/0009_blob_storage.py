@@ -0,0 +1,50 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:44
+
+import api.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_uploadsession"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                ("size", models.PositiveBigIntegerField(default=0)),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="comment",
+            name="attachment",
+            field=models.FileField(
+                blank=True,
+                max_length=255,
+                null=True,
+                storage=api.storage.get_blob_storage,
+                upload_to="comment_attachments/",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="note",
+            name="file",
+            field=models.FileField(
+                max_length=255, storage=api.storage.get_blob_storage, upload_to="notes/"
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_blob_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="note",
+            name="thumbnail_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("ready", "Ready"),
+                    ("unsupported", "Unsupported"),
+                    ("failed", "Failed"),
+                ],
+                default="pending",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="note",
+            name="thumbnails",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
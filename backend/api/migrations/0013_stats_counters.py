@@ -0,0 +1,89 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:52
+
+from django.db import migrations, models
+
+
+def backfill_stats(apps, schema_editor):
+    User = apps.get_model("api", "User")
+    UserStats = apps.get_model("api", "UserStats")
+    SiteStats = apps.get_model("api", "SiteStats")
+    Note = apps.get_model("api", "Note")
+    NoteRequest = apps.get_model("api", "NoteRequest")
+    Download = apps.get_model("api", "Download")
+    Bookmark = apps.get_model("api", "Bookmark")
+    Notification = apps.get_model("api", "Notification")
+
+    counters = {
+        "uploads": (Note.objects.all(), "uploaded_by"),
+        "downloads": (Download.objects.all(), "user"),
+        "bookmarks": (Bookmark.objects.all(), "user"),
+        "requests": (NoteRequest.objects.all(), "requested_by"),
+        "unread_notifications": (Notification.objects.filter(is_read=False), "user"),
+    }
+    counts = {}
+    for field, (rows, fk) in counters.items():
+        for user_id, n in rows.values(fk).annotate(n=models.Count("pk")).values_list(fk, "n"):
+            counts.setdefault(user_id, {})[field] = n
+
+    UserStats.objects.all().delete()
+    UserStats.objects.bulk_create(
+        [
+            UserStats(user_id=user_id, **counts.get(user_id, {}))
+            for user_id in User.objects.values_list("id", flat=True)
+        ],
+        batch_size=500,
+    )
+    SiteStats.objects.update_or_create(
+        pk=1,
+        defaults={
+            "total_notes": Note.objects.filter(is_approved=True).count(),
+            "open_requests": NoteRequest.objects.filter(status="open").count(),
+        },
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0012_notification_indexes_userstats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SiteStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("total_notes", models.PositiveIntegerField(default=0)),
+                ("open_requests", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="userstats",
+            name="bookmarks",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="userstats",
+            name="downloads",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="userstats",
+            name="requests",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="userstats",
+            name="uploads",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
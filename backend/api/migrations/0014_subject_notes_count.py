@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-17 18:54
+
+from django.db import migrations, models
+
+
+def backfill_notes_count(apps, schema_editor):
+    Subject = apps.get_model("api", "Subject")
+    Note = apps.get_model("api", "Note")
+    counts = dict(
+        Note.objects.filter(is_approved=True)
+        .values("subject")
+        .annotate(n=models.Count("pk"))
+        .values_list("subject", "n")
+    )
+    subjects = list(Subject.objects.all())
+    for subject in subjects:
+        subject.notes_count = counts.get(subject.pk, 0)
+    Subject.objects.bulk_update(subjects, ["notes_count"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0013_stats_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="subject",
+            name="notes_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_notes_count, migrations.RunPython.noop),
+    ]
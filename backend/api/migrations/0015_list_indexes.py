@@ -0,0 +1,65 @@
+# Generated by Django 5.2.7 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0014_subject_notes_count"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["note", "parent", "created_at", "id"],
+                name="comment_note_thread_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["request", "parent", "created_at", "id"],
+                name="comment_request_thread_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["root", "depth"], name="comment_replies_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                condition=models.Q(("is_approved", True)),
+                fields=["-created_at", "-id"],
+                name="note_feed_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                condition=models.Q(("is_approved", True)),
+                fields=["subject", "-created_at", "-id"],
+                name="note_subject_feed_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                condition=models.Q(("is_approved", True)),
+                fields=["uploaded_by", "-created_at", "-id"],
+                name="note_uploader_feed_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="noterequest",
+            index=models.Index(fields=["-created_at", "-id"], name="request_feed_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="noterequest",
+            index=models.Index(
+                fields=["status", "-created_at", "-id"], name="request_status_feed_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-17 19:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0015_list_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blob",
+            name="referenced_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-17 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0016_blob_referenced_at"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                fields=["created_at", "id"], name="notification_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-17 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0017_notification_created_index"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="comment",
+            name="comment_replies_idx",
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["parent", "created_at", "id"], name="comment_replies_idx"
+            ),
+        ),
+    ]
@@ -1,6 +1,12 @@
+import uuid
+
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.conf import settings
+from django.utils import timezone
+
+from .storage import get_blob_storage
 
 
 class UserManager(BaseUserManager):
@@ -55,34 +61,98 @@ class Subject(models.Model):
     description = models.TextField(blank=True, null=True)
     icon = models.CharField(max_length=50, default='book')
     color = models.CharField(max_length=7, default='#6366F1')  # Hex color
+    notes_count = models.PositiveIntegerField(default=0)  # Approved notes, maintained by api/stats.py
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.name
 
 
+class Tag(models.Model):
+    """Normalized note tag, kept in step with the comma separated Note.tags"""
+    name = models.CharField(max_length=100, unique=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
 class Note(models.Model):
     """Notes uploaded by students"""
+    THUMBNAIL_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('ready', 'Ready'),
+        ('unsupported', 'Unsupported'),
+        ('failed', 'Failed'),
+    ]
+
     title = models.CharField(max_length=255)
     description = models.TextField()
-    file = models.FileField(upload_to='notes/')
+    file = models.FileField(upload_to='notes/', storage=get_blob_storage, max_length=255)
     thumbnail = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
+    thumbnails = models.JSONField(default=dict, blank=True)  # Rendered size name -> storage name
+    thumbnail_status = models.CharField(max_length=20, choices=THUMBNAIL_STATUS_CHOICES, default='pending')
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE, related_name='notes')
     uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='uploaded_notes')
     downloads_count = models.PositiveIntegerField(default=0)
     views_count = models.PositiveIntegerField(default=0)
     is_approved = models.BooleanField(default=True)  # Auto-approve since no admin
     tags = models.CharField(max_length=500, blank=True, null=True)  # Comma separated
+    tag_set = models.ManyToManyField(Tag, related_name='notes', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Approved notes newest first, as the keyset paginator walks them. Partial,
+            # because SQLite cannot seek on a boolean column that is tested bare
+            models.Index(fields=['-created_at', '-id'], condition=Q(is_approved=True), name='note_feed_idx'),
+            models.Index(fields=['subject', '-created_at', '-id'], condition=Q(is_approved=True),
+                         name='note_subject_feed_idx'),
+            models.Index(fields=['uploaded_by', '-created_at', '-id'], condition=Q(is_approved=True),
+                         name='note_uploader_feed_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
 
+class UploadSession(models.Model):
+    """Resumable chunked upload of a note file, becomes a Note once finalized"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('assembling', 'Assembling'),
+        ('complete', 'Complete'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    checksum = models.CharField(max_length=64, blank=True)  # SHA-256 of the whole file, optional
+    title = models.CharField(max_length=255)
+    description = models.TextField()
+    subject = models.ForeignKey(Subject, on_delete=models.CASCADE, related_name='upload_sessions')
+    tags = models.CharField(max_length=500, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    note = models.ForeignKey(Note, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.status})"
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+
 class NoteRequest(models.Model):
     """Requests posted by students for specific notes"""
     STATUS_CHOICES = [
@@ -102,6 +172,10 @@ class NoteRequest(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='request_feed_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='request_status_feed_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -119,17 +193,36 @@ class Comment(models.Model):
     request = models.ForeignKey(NoteRequest, on_delete=models.CASCADE, related_name='comments', null=True, blank=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='comments')
     text = models.TextField()
-    attachment = models.FileField(upload_to='comment_attachments/', null=True, blank=True)  # For sharing notes in comments
+    attachment = models.FileField(upload_to='comment_attachments/', storage=get_blob_storage, max_length=255, null=True, blank=True)  # For sharing notes in comments
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies')
+    # Top-level comment of the thread and distance from it
+    root = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='thread')
+    depth = models.PositiveSmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Top-level comments of a note or request, oldest first
+            models.Index(fields=['note', 'parent', 'created_at', 'id'], name='comment_note_thread_idx'),
+            models.Index(fields=['request', 'parent', 'created_at', 'id'], name='comment_request_thread_idx'),
+            # Replies of a level of comments, oldest first (threads.attach_replies)
+            models.Index(fields=['parent', 'created_at', 'id'], name='comment_replies_idx'),
+        ]
 
     def __str__(self):
         return f"Comment by {self.user.email}"
 
+    def save(self, *args, **kwargs):
+        if self.parent_id:
+            self.root_id = self.parent.root_id or self.parent_id
+            self.depth = self.parent.depth + 1
+        else:
+            self.root_id = None
+            self.depth = 0
+        super().save(*args, **kwargs)
+
 
 class Download(models.Model):
     """Track note downloads"""
@@ -161,6 +254,85 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # A user's notifications newest first, as the keyset paginator walks them
+            models.Index(fields=['user', '-created_at', '-id'], name='notification_user_idx'),
+            # Unread count and unread list
+            models.Index(fields=['user', 'is_read', '-created_at', '-id'], name='notification_unread_idx'),
+            # The window api/events.py's DatabaseBackend polls
+            models.Index(fields=['created_at', 'id'], name='notification_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.title} - {self.user.email}"
+
+
+class CounterBatch(models.Model):
+    """Spooled counter batches already applied, so a replay never counts twice"""
+    batch = models.CharField(max_length=32, unique=True)
+    applied_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.batch
+
+
+class Blob(models.Model):
+    """Stored file content, shared by every note file and attachment with the same SHA-256"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last time a reference was counted, gc_blobs leaves recently referenced blobs alone
+    referenced_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256} ({self.ref_count} refs)"
+
+
+class Job(models.Model):
+    """Background job, written in the same transaction as the change that caused it"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField()
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+
+class UserStats(models.Model):
+    """Per-user counters kept up to date as rows change, so reading them is one lookup"""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='stats')
+    uploads = models.PositiveIntegerField(default=0)
+    downloads = models.PositiveIntegerField(default=0)
+    bookmarks = models.PositiveIntegerField(default=0)
+    requests = models.PositiveIntegerField(default=0)
+    unread_notifications = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Stats for {self.user_id}"
+
+
+class SiteStats(models.Model):
+    """Site-wide counters, a single row maintained like UserStats"""
+    total_notes = models.PositiveIntegerField(default=0)
+    open_requests = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return f"{self.title} - {self.user.email}"
\ No newline at end of file
+        return f"{self.total_notes} notes, {self.open_requests} open requests"
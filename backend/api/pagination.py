@@ -0,0 +1,142 @@
+"""
+Keyset pagination for the infinite lists in the app.
+
+Pages are selected with ``WHERE (created_at, id) < (cursor)`` instead of
+``OFFSET``, and no ``COUNT(*)`` is run, so page 500 costs the same as page 1.
+The cursor is an opaque token holding the last row's key, so rows inserted
+while a client scrolls never shift or repeat items.
+
+Clients that still need numbered pages can opt in with ``?page=``.
+
+Querysets that carry an explicit ordering are search results ranked by
+relevance, which cannot be keyed on ``created_at``. They are bounded by
+``SEARCH_RESULT_LIMIT``, so they are paged by position with the same opaque
+cursor and the same response shape, still without a ``COUNT(*)``. A view
+that searched sets ``search_truncated``, and the response then says with
+``truncated`` whether matches beyond the limit were left out.
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class OptInPageNumberPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination keyed on (created_at, id), newest first"""
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_query_param = 'page'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        if self.page_query_param in request.query_params:
+            self.fallback = OptInPageNumberPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+        self.fallback = None
+        self.truncated = getattr(view, 'search_truncated', None)
+
+        self.page_size = self.get_page_size(request)
+        if queryset.query.order_by:
+            return self.paginate_ranked(queryset, request)
+        self.offset = None
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(*cursor))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def paginate_ranked(self, queryset, request):
+        """A page of a bounded, explicitly ordered queryset by position"""
+        self.offset = self.decode_offset(request)
+        rows = list(queryset[self.offset:self.offset + self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def after(self, value, pk):
+        """Rows strictly past (value, pk) in the paginator's ordering"""
+        field, tiebreaker = (name.lstrip('-') for name in self.ordering)
+        op = 'lt' if self.ordering[0].startswith('-') else 'gt'
+        return Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'{tiebreaker}__{op}': pk})
+
+    def encode_cursor(self, obj):
+        field, tiebreaker = (name.lstrip('-') for name in self.ordering)
+        data = json.dumps([getattr(obj, field).isoformat(), getattr(obj, tiebreaker)])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_offset(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return 0
+        try:
+            offset = int(json.loads(base64.urlsafe_b64decode(token.encode()))['offset'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if offset < 0:
+            raise NotFound(self.invalid_cursor_message)
+        return offset
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(token.encode()))
+            value = parse_datetime(value)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if value is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.offset is not None:
+            data = json.dumps({'offset': self.offset + self.page_size})
+            return replace_query_param(url, self.cursor_query_param, base64.urlsafe_b64encode(data.encode()).decode())
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        body = {
+            'next': self.get_next_link(),
+            'results': data,
+        }
+        if self.truncated is not None:
+            body['truncated'] = self.truncated
+        return Response(body)
+
+
+class CommentPagination(KeysetPagination):
+    """Top-level comments read oldest first, like the thread itself"""
+    ordering = ('created_at', 'id')
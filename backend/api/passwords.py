@@ -0,0 +1,55 @@
+"""
+Password hashing off the request path.
+
+Hashing a password costs tens of milliseconds of CPU by design. The auth
+views are async and await it on a pool of ``PASSWORD_HASH_WORKERS`` threads;
+hashlib and argon2 release the GIL while hashing. A login spike therefore
+waits in this pool while the server keeps answering other requests. Once
+``PASSWORD_HASH_QUEUE`` hashes are waiting, new ones fail fast with ``Busy``
+and the views answer 503, so a spike cannot build an unbounded backlog.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, verify_password
+
+WORKERS = getattr(settings, 'PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+QUEUE = getattr(settings, 'PASSWORD_HASH_QUEUE', 64)
+RETRY_AFTER = 1
+
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE)
+
+
+class Busy(Exception):
+    """Too many hashes waiting, the client should retry shortly"""
+
+
+async def submit(func, *args):
+    if not _slots.acquire(blocking=False):
+        raise Busy
+    future = executor.submit(func, *args)
+    # Released when the hash finishes, even if the client gave up waiting
+    future.add_done_callback(lambda _: _slots.release())
+    return await asyncio.wrap_future(future)
+
+
+def check(password, encoded):
+    """(valid, new hash if the stored one is outdated), runs on the pool"""
+    if encoded is None:
+        # Unknown user: hash anyway so the response time does not tell
+        make_password(password)
+        return False, None
+    valid, must_update = verify_password(password, encoded)
+    return valid, (make_password(password) if valid and must_update else None)
+
+
+async def verify(password, encoded):
+    return await submit(check, password, encoded)
+
+
+async def make(password):
+    return await submit(make_password, password)
@@ -0,0 +1,57 @@
+"""
+Queryset builders for the list endpoints.
+
+Serializers read the attributes these annotate (``comments_count``,
+``is_bookmarked``...) instead of querying per row, so a page
+costs the same number of queries whatever its size.
+"""
+from django.db.models import Count, Exists, IntegerField, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
+from .models import Note, Comment, Download, Bookmark
+
+
+def count_of(model, field):
+    """Correlated COUNT of ``model`` rows whose ``field`` points at the outer row"""
+    counts = (
+        model.objects.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(total=Count('pk'))
+        .values('total')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def notes(queryset, user, detail=False):
+    """Notes with uploader, subject, comment count and per-user flags loaded"""
+    queryset = queryset.select_related('uploaded_by', 'subject').annotate(
+        comments_count=count_of(Comment, 'note')
+    )
+
+    if user is not None and user.is_authenticated:
+        queryset = queryset.annotate(
+            is_bookmarked=Exists(Bookmark.objects.filter(note=OuterRef('pk'), user=user))
+        )
+        if detail:
+            queryset = queryset.annotate(
+                is_downloaded=Exists(Download.objects.filter(note=OuterRef('pk'), user=user))
+            )
+    else:
+        queryset = queryset.annotate(is_bookmarked=Value(False))
+        if detail:
+            queryset = queryset.annotate(is_downloaded=Value(False))
+    return queryset
+
+
+def note_requests(queryset):
+    return queryset.select_related('requested_by', 'subject').annotate(
+        comments_count=count_of(Comment, 'request')
+    )
+
+
+def bookmarks(queryset, user):
+    return queryset.prefetch_related(Prefetch('note', queryset=notes(Note.objects.all(), user)))
+
+
+def downloads(queryset, user):
+    return queryset.prefetch_related(Prefetch('note', queryset=notes(Note.objects.all(), user)))
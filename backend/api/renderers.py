@@ -0,0 +1,45 @@
+"""
+JSON rendering and parsing with orjson.
+
+orjson serializes the nested list payloads several times faster than the
+``json`` module behind DRF's JSONRenderer. It is optional: without it, and
+for indented output such as the browsable API's, both classes fall back to
+DRF's own. Values orjson does not know (Decimal, lazy translations,
+datetimes, which DRF formats with a ``Z`` suffix) go through DRF's encoder,
+so both produce the same JSON.
+"""
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pip install orjson
+    orjson = None
+
+if orjson is not None:
+    # Non string keys: the ``included`` map of compact responses is keyed by id
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class FastJSONRenderer(JSONRenderer):
+    encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=self.encoder.default, option=OPTIONS)
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
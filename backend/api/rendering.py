@@ -0,0 +1,62 @@
+"""
+Thumbnail rasterizing, run inside the thumbnail process pool.
+
+This module must not import Django: pool workers are started with ``spawn``
+and only import what the submitted function needs. PDFs are rendered with
+PyMuPDF when it is installed, images with Pillow.
+"""
+import os
+
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+
+class UnsupportedFile(Exception):
+    pass
+
+
+def open_pdf_page(path, width):
+    try:
+        import pymupdf
+    except ImportError:
+        raise UnsupportedFile('PDF thumbnails need PyMuPDF (pip install pymupdf)')
+    with pymupdf.open(path) as document:
+        if not document.page_count:
+            raise UnsupportedFile('PDF has no pages')
+        page = document[0]
+        zoom = width / page.rect.width  # Rasterize only as large as the biggest thumbnail
+        pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+        return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def open_image(path, width):
+    image = Image.open(path)
+    image.draft('RGB', (width, width * 4))  # Lets JPEG decode at a reduced scale
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+
+def render(source_path, filename, out_dir, sizes, quality=80):
+    """
+    Render ``source_path`` into one WebP per entry of ``sizes`` (name -> width)
+    and return {name: path}. ``filename`` only decides how the source is read.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    width = max(sizes.values())
+    if extension == '.pdf':
+        source = open_pdf_page(source_path, width)
+    elif extension in IMAGE_EXTENSIONS:
+        source = open_image(source_path, width)
+    else:
+        raise UnsupportedFile(f'No thumbnail renderer for {extension or "files without extension"}')
+
+    rendered = {}
+    image = source
+    for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        image = image.copy()  # Each size is scaled down from the previous, larger one
+        image.thumbnail((size, size * 4), Image.LANCZOS)
+        path = os.path.join(out_dir, f'{name}.webp')
+        image.save(path, 'WEBP', quality=quality, method=4)
+        rendered[name] = path
+    return rendered
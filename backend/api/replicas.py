@@ -0,0 +1,122 @@
+"""
+Read replica routing.
+
+``ReplicaRouter`` sends every write to ``default`` (the primary). Reads go
+to the primary too, except inside a view using ``ReplicaReadMixin``. There,
+``list`` and ``retrieve`` read from a randomly picked alias in
+``DATABASE_REPLICAS``.
+
+Replicas lag behind the primary, so a user who has just written would not
+see the change. ``PinAfterWriteMiddleware`` records each successful write
+request of an authenticated user in the ``REPLICA_PIN_CACHE`` cache. For
+the next ``REPLICA_PIN_SECONDS`` that user reads from the primary. The
+cache must be shared between workers, or a pin only holds in the worker
+that served the write, so replicas are refused with a process-local one.
+A subject list cached by api/catalog.py just after a
+change may hold the replica's older view until SUBJECT_CATALOG_TTL.
+"""
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from . import caching
+
+REPLICAS = list(getattr(settings, 'DATABASE_REPLICAS', []))
+PIN_SECONDS = getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+PIN_CACHE = getattr(settings, 'REPLICA_PIN_CACHE', 'default')
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+if REPLICAS and not caching.is_shared(PIN_CACHE):
+    raise ImproperlyConfigured(
+        f'Read replicas need REPLICA_PIN_CACHE {PIN_CACHE!r} to be shared between workers, '
+        'set CACHE_REDIS_URL'
+    )
+
+# Alias reads of the current request go to, None for the primary
+read_alias = ContextVar('read_alias', default=None)
+
+
+def pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def pin(user_id):
+    caches[PIN_CACHE].set(pin_key(user_id), True, PIN_SECONDS)
+
+
+def is_pinned(user):
+    return bool(user and user.is_authenticated and caches[PIN_CACHE].get(pin_key(user.pk)))
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Explicitly, or Django would write objects back to the replica they were read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Every alias holds the same data
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in REPLICAS  # Replicas get the schema through replication
+
+
+class ReplicaReadMixin:
+    """Serves ``replica_actions`` from a read replica unless the user wrote recently"""
+    replica_actions = ('list', 'retrieve')
+
+    def dispatch(self, request, *args, **kwargs):
+        token = read_alias.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            read_alias.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if REPLICAS and self.action in self.replica_actions and not is_pinned(request.user):
+            read_alias.set(random.choice(REPLICAS))
+
+
+class PinAfterWriteMiddleware:
+    """Pins users to the primary for ``REPLICA_PIN_SECONDS`` after a successful write"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if self.is_write(request, response):
+            self.pin_user(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if self.is_write(request, response):
+            # Reading request.user may query the session and the cache is sync
+            await sync_to_async(self.pin_user)(request)
+        return response
+
+    def is_write(self, request, response):
+        return REPLICAS and request.method not in SAFE_METHODS and response.status_code < 400
+
+    def pin_user(self, request):
+        # DRF sets the token authenticated user on the Django request as well
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            pin(user.pk)
@@ -0,0 +1,211 @@
+"""
+Full-text search index for notes and note requests.
+
+SQLite keeps an FTS5 virtual table per model, PostgreSQL a side table with a
+GIN indexed tsvector column. Both are keyed by the object's primary key and
+kept up to date by the signal handlers in ``api.signals``. Any other database
+falls back to ``icontains`` filtering.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Case, When, Q, IntegerField
+
+# Only the best ranked matches are considered, which keeps the cost of a search
+# bounded by the result window instead of the size of the table. The list's
+# other filters apply to that window, so a narrow filter may find fewer rows
+# than exist; the search reports when the window was full.
+SEARCH_RESULT_LIMIT = getattr(settings, 'SEARCH_RESULT_LIMIT', 500)
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchIndex:
+    """Which columns of a model are indexed and how much each one counts"""
+
+    def __init__(self, model_label, table, fields, weights):
+        self.model_label = model_label
+        self.table = table
+        self.fields = fields
+        self.weights = weights
+
+    def values(self, obj):
+        return [getattr(obj, field) or '' for field in self.fields]
+
+
+NOTE_INDEX = SearchIndex('api.Note', 'api_note_search', ['title', 'tags', 'description'], [10.0, 5.0, 1.0])
+REQUEST_INDEX = SearchIndex('api.NoteRequest', 'api_noterequest_search', ['title', 'description'], [10.0, 1.0])
+
+INDEXES = {index.model_label: index for index in (NOTE_INDEX, REQUEST_INDEX)}
+
+
+def parse_terms(query):
+    """Split user input into plain word terms, dropping any query syntax"""
+    return TERM_RE.findall(query.lower())[:16]
+
+
+class SQLiteBackend:
+    """FTS5 virtual table, rowid is the object's primary key"""
+
+    def create(self, cursor, index):
+        columns = ', '.join(index.fields)
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {index.table} USING fts5("
+            f"{columns}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+
+    def drop(self, cursor, index):
+        cursor.execute(f'DROP TABLE IF EXISTS {index.table}')
+
+    def update(self, cursor, index, pk, values):
+        self.delete(cursor, index, pk)
+        placeholders = ', '.join(['%s'] * (len(values) + 1))
+        cursor.execute(
+            f"INSERT INTO {index.table} (rowid, {', '.join(index.fields)}) VALUES ({placeholders})",
+            [pk, *values]
+        )
+
+    def delete(self, cursor, index, pk):
+        cursor.execute(f'DELETE FROM {index.table} WHERE rowid = %s', [pk])
+
+    def search(self, cursor, index, terms, limit):
+        # Every term is quoted, so FTS5 operators typed by users are matched
+        # literally, and made a prefix so results update while typing.
+        match = ' '.join('"%s"*' % term for term in terms)
+        weights = ', '.join(str(weight) for weight in index.weights)
+        cursor.execute(
+            f'SELECT rowid FROM {index.table} WHERE {index.table} MATCH %s '
+            f'ORDER BY bm25({index.table}, {weights}) LIMIT %s',
+            [match, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLBackend:
+    """Side table with a weighted tsvector document and a GIN index on it"""
+
+    config = 'english'
+    labels = ['A', 'B', 'C', 'D']
+
+    def create(self, cursor, index):
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {index.table} ('
+            f'object_id bigint PRIMARY KEY, document tsvector NOT NULL)'
+        )
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index.table}_document ON {index.table} USING gin (document)'
+        )
+
+    def drop(self, cursor, index):
+        cursor.execute(f'DROP TABLE IF EXISTS {index.table}')
+
+    def update(self, cursor, index, pk, values):
+        # Weights are ordered, so the first column gets label A and so on.
+        document = ' || '.join(
+            f"setweight(to_tsvector('{self.config}', %s), '{label}')"
+            for label in self.labels[:len(values)]
+        )
+        cursor.execute(
+            f'INSERT INTO {index.table} (object_id, document) VALUES (%s, {document}) '
+            f'ON CONFLICT (object_id) DO UPDATE SET document = EXCLUDED.document',
+            [pk, *values]
+        )
+
+    def delete(self, cursor, index, pk):
+        cursor.execute(f'DELETE FROM {index.table} WHERE object_id = %s', [pk])
+
+    def search(self, cursor, index, terms, limit):
+        tsquery = ' & '.join('%s:*' % term for term in terms)
+        cursor.execute(
+            f"SELECT object_id FROM {index.table}, to_tsquery('{self.config}', %s) query "
+            f'WHERE document @@ query ORDER BY ts_rank(document, query) DESC LIMIT %s',
+            [tsquery, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend(),
+    'postgresql': PostgreSQLBackend(),
+}
+
+
+def get_backend(connection):
+    return BACKENDS.get(connection.vendor)
+
+
+def _index_for(model):
+    return INDEXES.get(model._meta.label)
+
+
+def index_object(obj):
+    """Add or refresh a single object in its search index"""
+    index = _index_for(type(obj))
+    connection = connections[router.db_for_write(type(obj), instance=obj)]
+    backend = get_backend(connection)
+    if index and backend:
+        with connection.cursor() as cursor:
+            backend.update(cursor, index, obj.pk, index.values(obj))
+
+
+def unindex_object(obj, pk=None):
+    """Remove a single object from its search index"""
+    index = _index_for(type(obj))
+    connection = connections[router.db_for_write(type(obj), instance=obj)]
+    backend = get_backend(connection)
+    if index and backend:
+        with connection.cursor() as cursor:
+            backend.delete(cursor, index, pk if pk is not None else obj.pk)
+
+
+def rebuild_index(model, using=None, batch_size=1000):
+    """Re-index every row of ``model``, returns the number of rows indexed"""
+    index = _index_for(model)
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    backend = get_backend(connection)
+    if not index or not backend:
+        return 0
+
+    count = 0
+    with connection.cursor() as cursor:
+        backend.drop(cursor, index)
+        backend.create(cursor, index)
+        rows = model._base_manager.using(using).order_by('pk').values_list('pk', *index.fields)
+        for row in rows.iterator(chunk_size=batch_size):
+            backend.update(cursor, index, row[0], [value or '' for value in row[1:]])
+            count += 1
+    return count
+
+
+def search(queryset, query):
+    """
+    Filter ``queryset`` down to rows matching ``query``, ordered by relevance.
+
+    Returns ``(queryset, truncated)``. ``truncated`` is true when the index had
+    more matches than the ``SEARCH_RESULT_LIMIT`` best ranked ones considered.
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return queryset.none(), False
+
+    index = _index_for(queryset.model)
+    connection = connections[queryset.db]
+    backend = get_backend(connection)
+    if not index or not backend:
+        condition = Q()
+        for field in index.fields if index else []:
+            condition |= Q(**{f'{field}__icontains': query})
+        return queryset.filter(condition), False
+
+    # One row past the limit tells whether there were more
+    with connection.cursor() as cursor:
+        ids = backend.search(cursor, index, terms, SEARCH_RESULT_LIMIT + 1)
+    truncated = len(ids) > SEARCH_RESULT_LIMIT
+    ids = ids[:SEARCH_RESULT_LIMIT]
+    if not ids:
+        return queryset.none(), False
+
+    rank = Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(rank), truncated
@@ -1,7 +1,10 @@
 from rest_framework import serializers
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
-from .models import Subject, Note, NoteRequest, Comment, Download, Bookmark, Notification
+from . import compact, storage, uploads
+from .models import Subject, Note, NoteRequest, Comment, Download, Bookmark, Notification, UploadSession
 
 User = get_user_model()
 
@@ -30,8 +33,13 @@ class UserRegisterSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data.pop('password_confirm')
-        user = User.objects.create_user(**validated_data)
-        return user
+        encoded = validated_data.pop('encoded_password', None)
+        if encoded is None:
+            return User.objects.create_user(**validated_data)
+        # Already hashed off the request path by views.register
+        validated_data['email'] = User.objects.normalize_email(validated_data['email'])
+        validated_data['password'] = encoded
+        return User.objects.create(**validated_data)
 
 
 class UserLoginSerializer(serializers.Serializer):
@@ -51,64 +59,158 @@ class ChangePasswordSerializer(serializers.Serializer):
 
 
 class SubjectSerializer(serializers.ModelSerializer):
-    notes_count = serializers.SerializerMethodField()
-
     class Meta:
         model = Subject
         fields = ['id', 'name', 'description', 'icon', 'color', 'notes_count', 'created_at']
+        read_only_fields = ['notes_count']
+
+
+class ThumbnailsField(serializers.Field):
+    """Rendered thumbnail URLs keyed by size, empty until thumbnail_status is 'ready'"""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        request = self.context.get('request')
+        urls = {}
+        for size, name in (value or {}).items():
+            url = default_storage.url(name)
+            urls[size] = request.build_absolute_uri(url) if request else url
+        return urls
+
+
+class ReferenceField(serializers.Field):
+    """A related object in full, or in compact responses its id with the object in ``included``"""
+
+    def __init__(self, kind, serializer, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+        self.kind = kind
+        self.serializer = serializer
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self.serializer.bind(field_name, parent)
+
+    def to_representation(self, value):
+        return self.context['included'].add(self.kind, value, self.serializer)
 
-    def get_notes_count(self, obj):
-        return obj.notes.count()
 
+class ExcerptField(serializers.CharField):
+    """Text cut to compact.excerpt"""
 
-class NoteListSerializer(serializers.ModelSerializer):
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return compact.excerpt(super().to_representation(value))
+
+
+class ShapedResponseMixin:
+    """
+    Fields of the top-level items of a GET response: ``?fields=id,title``
+    keeps only those, ``?exclude=description`` drops those, and dropped
+    fields are never computed. In compact responses (api/compact.py) the
+    ``references`` become ReferenceFields and the ``excerpts`` ExcerptFields.
+    """
+    references = {}  # field name -> included kind
+    excerpts = ()
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return fields
+        if self.is_top_level():
+            keep = self.field_names(request, 'fields')
+            if keep:
+                fields = {name: field for name, field in fields.items() if name in keep}
+            for name in self.field_names(request, 'exclude'):
+                fields.pop(name, None)
+        if self.context.get('included') is not None:
+            for name, kind in self.references.items():
+                if name in fields:
+                    fields[name] = ReferenceField(kind, fields[name])
+            for name in self.excerpts:
+                if name in fields:
+                    fields[name] = ExcerptField()
+        return fields
+
+    def is_top_level(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def field_names(self, request, param):
+        return {name.strip() for value in request.query_params.getlist(param) for name in value.split(',')} - {''}
+
+
+class NoteListSerializer(ShapedResponseMixin, serializers.ModelSerializer):
     uploaded_by = UserSerializer(read_only=True)
     subject = SubjectSerializer(read_only=True)
     is_bookmarked = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
+    thumbnails = ThumbnailsField()
+    references = {'uploaded_by': 'users', 'subject': 'subjects'}
+    excerpts = ('description',)
 
     class Meta:
         model = Note
-        fields = ['id', 'title', 'description', 'thumbnail', 'subject', 'uploaded_by',
-                  'downloads_count', 'views_count', 'tags', 'is_bookmarked', 
-                  'comments_count', 'created_at']
+        fields = ['id', 'title', 'description', 'thumbnail', 'thumbnails', 'thumbnail_status',
+                  'subject', 'uploaded_by', 'downloads_count', 'views_count', 'tags',
+                  'is_bookmarked', 'comments_count', 'created_at']
 
     def get_is_bookmarked(self, obj):
+        if hasattr(obj, 'is_bookmarked'):
+            return obj.is_bookmarked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return Bookmark.objects.filter(note=obj, user=request.user).exists()
         return False
 
     def get_comments_count(self, obj):
+        if hasattr(obj, 'comments_count'):
+            return obj.comments_count
         return obj.comments.count()
 
 
-class NoteDetailSerializer(serializers.ModelSerializer):
+class NoteDetailSerializer(ShapedResponseMixin, serializers.ModelSerializer):
     uploaded_by = UserSerializer(read_only=True)
     subject = SubjectSerializer(read_only=True)
     is_bookmarked = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
     is_downloaded = serializers.SerializerMethodField()
+    thumbnails = ThumbnailsField()
 
     class Meta:
         model = Note
-        fields = ['id', 'title', 'description', 'file', 'thumbnail', 'subject', 
-                  'uploaded_by', 'downloads_count', 'views_count', 'tags', 
+        fields = ['id', 'title', 'description', 'file', 'thumbnail', 'thumbnails', 'thumbnail_status',
+                  'subject', 'uploaded_by', 'downloads_count', 'views_count', 'tags', 
                   'is_bookmarked', 'is_downloaded', 'comments_count', 'created_at', 'updated_at']
 
     def get_is_bookmarked(self, obj):
+        if hasattr(obj, 'is_bookmarked'):
+            return obj.is_bookmarked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return Bookmark.objects.filter(note=obj, user=request.user).exists()
         return False
 
     def get_is_downloaded(self, obj):
+        if hasattr(obj, 'is_downloaded'):
+            return obj.is_downloaded
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return Download.objects.filter(note=obj, user=request.user).exists()
         return False
 
     def get_comments_count(self, obj):
+        if hasattr(obj, 'comments_count'):
+            return obj.comments_count
         return obj.comments.count()
 
 
@@ -142,10 +244,55 @@ class NoteCreateSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class NoteRequestListSerializer(serializers.ModelSerializer):
+class UploadSessionSerializer(serializers.ModelSerializer):
+    subject_id = serializers.IntegerField(write_only=True, required=False)
+    subject_name = serializers.CharField(write_only=True, required=False)
+    chunk_size = serializers.IntegerField(required=False, min_value=256 * 1024, max_value=32 * 1024 * 1024)
+    size = serializers.IntegerField(min_value=1, max_value=settings.UPLOAD_MAX_SIZE)
+    total_chunks = serializers.IntegerField(read_only=True)
+    missing_chunks = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'size', 'chunk_size', 'checksum', 'title', 'description',
+                  'subject_id', 'subject_name', 'tags', 'status', 'total_chunks', 'missing_chunks',
+                  'note', 'error', 'created_at']
+        read_only_fields = ['id', 'status', 'note', 'error', 'created_at']
+
+    def validate(self, attrs):
+        if not attrs.get('subject_id') and not attrs.get('subject_name'):
+            raise serializers.ValidationError("Either subject_id or subject_name is required")
+        if attrs.get('subject_id') and not Subject.objects.filter(id=attrs['subject_id']).exists():
+            raise serializers.ValidationError({"subject_id": "Subject not found"})
+        return attrs
+
+    def get_missing_chunks(self, obj):
+        return uploads.missing_chunks(obj)
+
+    def create(self, validated_data):
+        subject_id = validated_data.pop('subject_id', None)
+        subject_name = validated_data.pop('subject_name', None)
+
+        if subject_id:
+            subject = Subject.objects.get(id=subject_id)
+        else:
+            subject, _ = Subject.objects.get_or_create(
+                name=subject_name,
+                defaults={'description': f'Notes for {subject_name}'}
+            )
+
+        validated_data['subject'] = subject
+        validated_data['user'] = self.context['request'].user
+        validated_data.setdefault('chunk_size', settings.UPLOAD_CHUNK_SIZE)
+        return super().create(validated_data)
+
+
+class NoteRequestListSerializer(ShapedResponseMixin, serializers.ModelSerializer):
     requested_by = UserSerializer(read_only=True)
     subject = SubjectSerializer(read_only=True)
     comments_count = serializers.SerializerMethodField()
+    references = {'requested_by': 'users', 'subject': 'subjects'}
+    excerpts = ('description',)
 
     class Meta:
         model = NoteRequest
@@ -153,6 +300,8 @@ class NoteRequestListSerializer(serializers.ModelSerializer):
                   'status', 'comments_count', 'created_at']
 
     def get_comments_count(self, obj):
+        if hasattr(obj, 'comments_count'):
+            return obj.comments_count
         return obj.comments.count()
 
 
@@ -191,30 +340,39 @@ class NoteRequestCreateSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(ShapedResponseMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     replies = serializers.SerializerMethodField()
+    more_replies = serializers.SerializerMethodField()
+    references = {'user': 'users'}
 
     class Meta:
         model = Comment
         fields = ['id', 'content_type', 'text', 'attachment', 'user', 
-                  'parent', 'replies', 'created_at']
+                  'parent', 'replies', 'more_replies', 'created_at']
         read_only_fields = ['id', 'user', 'created_at']
 
     def get_replies(self, obj):
+        # Trees built by threads.attach_replies are already in memory
+        if hasattr(obj, 'loaded_replies'):
+            return CommentSerializer(obj.loaded_replies, many=True, context=self.context).data
         if obj.replies.exists():
-            return CommentSerializer(obj.replies.all(), many=True).data
+            return CommentSerializer(obj.replies.all(), many=True, context=self.context).data
         return []
 
+    def get_more_replies(self, obj):
+        return getattr(obj, 'more_replies', None)
+
 
 class CommentCreateSerializer(serializers.ModelSerializer):
     note_id = serializers.IntegerField(required=False)
     request_id = serializers.IntegerField(required=False)
+    share_note_id = serializers.IntegerField(write_only=True, required=False)
 
     class Meta:
         model = Comment
         fields = ['id', 'content_type', 'note_id', 'request_id', 'text', 
-                  'attachment', 'parent']
+                  'attachment', 'share_note_id', 'parent']
 
     def validate(self, attrs):
         content_type = attrs.get('content_type')
@@ -222,16 +380,28 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"note_id": "Required for note comments"})
         if content_type == 'request' and not attrs.get('request_id'):
             raise serializers.ValidationError({"request_id": "Required for request comments"})
+        if attrs.get('share_note_id') and attrs.get('attachment'):
+            raise serializers.ValidationError("Send either an attachment or share_note_id, not both")
+        if attrs.get('share_note_id'):
+            shared = Note.objects.filter(is_approved=True, id=attrs['share_note_id']).only('file').first()
+            if shared is None:
+                raise serializers.ValidationError({"share_note_id": "Note not found"})
+            attrs['share_note_id'] = shared
         return attrs
 
     def create(self, validated_data):
         note_id = validated_data.pop('note_id', None)
         request_id = validated_data.pop('request_id', None)
+        shared = validated_data.pop('share_note_id', None)
         
         if note_id:
             validated_data['note'] = Note.objects.get(id=note_id)
         if request_id:
             validated_data['request'] = NoteRequest.objects.get(id=request_id)
+        if shared:
+            # Re-sharing a note attaches its existing blob, nothing is uploaded or copied
+            validated_data['attachment'] = shared.file.name
+            storage.add_name_reference(shared.file.name)
         
         validated_data['user'] = self.context['request'].user
         return super().create(validated_data)
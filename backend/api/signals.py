@@ -0,0 +1,129 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+from .models import Bookmark, Comment, Download, Note, NoteRequest, Notification, Subject, User, UserStats
+from . import authentication, catalog, events, search, stats, storage, tags, thumbnails
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=NoteRequest)
+def update_search_index(sender, instance, **kwargs):
+    """Keep the full-text index in step with saved notes and requests"""
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not set(update_fields) & set(search.INDEXES[sender._meta.label].fields):
+        return
+    search.index_object(instance)
+
+
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=NoteRequest)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.unindex_object(instance)
+
+
+@receiver(post_save, sender=Note)
+def update_note_tags(sender, instance, **kwargs):
+    """Mirror the comma separated tags into Note.tag_set"""
+    update_fields = kwargs.get('update_fields')
+    if update_fields and 'tags' not in update_fields:
+        return
+    tags.sync_note_tags(instance)
+
+
+FILE_FIELDS = {Note: 'file', Comment: 'attachment'}
+
+
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=Comment)
+def release_blob(sender, instance, **kwargs):
+    """Drop the deleted row's reference, gc_blobs removes blobs left unreferenced"""
+    field_file = getattr(instance, FILE_FIELDS[sender])
+    if field_file:
+        storage.remove_reference(field_file.name)
+
+
+@receiver(pre_save, sender=Note)
+@receiver(pre_save, sender=Comment)
+def snapshot_blob(sender, instance, **kwargs):
+    """Remember the stored name of a row about to be updated, the save may replace it"""
+    field = FILE_FIELDS[sender]
+    update_fields = kwargs.get('update_fields')
+    if instance._state.adding or instance.pk is None or (update_fields and field not in update_fields):
+        return
+    instance._blob_before = sender._base_manager.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=Comment)
+def release_replaced_blob(sender, instance, created, **kwargs):
+    """Drop the reference of a file the save replaced"""
+    before = instance.__dict__.pop('_blob_before', None)
+    if before and before != getattr(instance, FILE_FIELDS[sender]).name:
+        storage.remove_reference(before)
+
+
+@receiver(post_save, sender=Note)
+def render_note_thumbnails(sender, instance, created, **kwargs):
+    if created:
+        thumbnails.schedule(instance)
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, **kwargs):
+    if created:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    """Cached tokens carry the user, so password, is_active and profile changes drop them"""
+    if not created:
+        authentication.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    authentication.invalidate(instance.key)
+
+
+@receiver(pre_save, sender=Note)
+@receiver(pre_save, sender=NoteRequest)
+@receiver(pre_save, sender=Download)
+@receiver(pre_save, sender=Bookmark)
+@receiver(pre_save, sender=Notification)
+def snapshot_stats(sender, instance, **kwargs):
+    stats.snapshot(instance, kwargs.get('update_fields'))
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_save, sender=NoteRequest)
+@receiver(post_save, sender=Download)
+@receiver(post_save, sender=Bookmark)
+@receiver(post_save, sender=Notification)
+def update_stats(sender, instance, created, **kwargs):
+    """Keep dashboard and badge counters in step with the rows they count"""
+    stats.record_save(instance, created, kwargs.get('update_fields'))
+
+
+@receiver(post_delete, sender=Note)
+@receiver(post_delete, sender=NoteRequest)
+@receiver(post_delete, sender=Download)
+@receiver(post_delete, sender=Bookmark)
+@receiver(post_delete, sender=Notification)
+def remove_from_stats(sender, instance, **kwargs):
+    stats.record_delete(instance)
+
+
+@receiver(post_save, sender=Notification)
+def push_notification(sender, instance, created, **kwargs):
+    """Hand new notifications to the fan-out backend for connected streams"""
+    if created:
+        transaction.on_commit(lambda: events.publish(instance))
+
+
+@receiver(post_save, sender=Subject)
+@receiver(post_delete, sender=Subject)
+def invalidate_subject_catalog(sender, instance, **kwargs):
+    """New, edited or removed subjects show up in the catalog straight away"""
+    transaction.on_commit(catalog.invalidate)
@@ -0,0 +1,217 @@
+"""
+Dashboard, badge and subject counters, maintained incrementally.
+
+Each counted model declares what one of its rows contributes to which
+counter. For example, a note adds one upload to its uploader and, while it
+is approved, one to the site's ``total_notes``. When a row is saved or
+deleted, the signals in api/signals.py apply the difference between what it
+contributed before and after. They use ``F()`` updates in the same
+transaction as the change, so a read is a primary key lookup.
+
+``QuerySet.update()`` bypasses signals, so code using it adjusts the
+counters itself (see ``mark_all_read``). Inside ``deferred()`` the updates
+of many saves and deletes are merged and applied once at the end, so a bulk
+change costs one UPDATE per counter row instead of one per changed row.
+``manage.py reconcile_stats`` recomputes every counter from the tables and
+reports drift.
+"""
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+from .models import Bookmark, Download, Note, NoteRequest, Notification, SiteStats, Subject, UserStats
+
+SITE = 1  # Primary key of the single SiteStats row
+
+
+def note_contribution(note):
+    return {
+        ('user', note.uploaded_by_id, 'uploads'): 1,
+        ('site', SITE, 'total_notes'): int(note.is_approved),
+        ('subject', note.subject_id, 'notes_count'): int(note.is_approved),
+    }
+
+
+def request_contribution(note_request):
+    return {
+        ('user', note_request.requested_by_id, 'requests'): 1,
+        ('site', SITE, 'open_requests'): int(note_request.status == 'open'),
+    }
+
+
+def download_contribution(download):
+    return {('user', download.user_id, 'downloads'): 1}
+
+
+def bookmark_contribution(bookmark):
+    return {('user', bookmark.user_id, 'bookmarks'): 1}
+
+
+def notification_contribution(notification):
+    return {('user', notification.user_id, 'unread_notifications'): int(not notification.is_read)}
+
+
+# Model -> (contribution, fields the contribution reads)
+CONTRIBUTIONS = {
+    Note: (note_contribution, ['uploaded_by_id', 'subject_id', 'is_approved']),
+    NoteRequest: (request_contribution, ['requested_by_id', 'status']),
+    Download: (download_contribution, ['user_id']),
+    Bookmark: (bookmark_contribution, ['user_id']),
+    Notification: (notification_contribution, ['user_id', 'is_read']),
+}
+
+TARGETS = {
+    'user': UserStats,
+    'site': SiteStats,
+    'subject': Subject,
+}
+
+# Counter -> (model, field pointing at the user, filter), to recount per user
+USER_COUNTERS = {
+    'uploads': (Note, 'uploaded_by', {}),
+    'downloads': (Download, 'user', {}),
+    'bookmarks': (Bookmark, 'user', {}),
+    'requests': (NoteRequest, 'requested_by', {}),
+    'unread_notifications': (Notification, 'user', {'is_read': False}),
+}
+
+SITE_COUNTERS = {
+    'total_notes': (Note, {'is_approved': True}),
+    'open_requests': (NoteRequest, {'status': 'open'}),
+}
+
+
+def tracks(instance, update_fields):
+    _, fields = CONTRIBUTIONS[type(instance)]
+    if update_fields is None:
+        return True
+    return bool({field.removesuffix('_id') for field in fields} & {field.removesuffix('_id') for field in update_fields})
+
+
+def snapshot(instance, update_fields=None):
+    """Remember what a row about to be updated contributes now"""
+    if instance._state.adding or instance.pk is None or not tracks(instance, update_fields):
+        return
+    contribution, fields = CONTRIBUTIONS[type(instance)]
+    values = type(instance).objects.filter(pk=instance.pk).values(*fields).first()
+    instance._stats_before = contribution(SimpleNamespace(**values)) if values else {}
+
+
+def record_save(instance, created, update_fields=None):
+    if not created and not tracks(instance, update_fields):
+        return
+    contribution, _ = CONTRIBUTIONS[type(instance)]
+    before = {} if created else instance.__dict__.pop('_stats_before', {})
+    after = contribution(instance)
+    apply({key: after.get(key, 0) - before.get(key, 0) for key in before.keys() | after.keys()})
+
+
+def record_delete(instance):
+    contribution, _ = CONTRIBUTIONS[type(instance)]
+    apply({key: -value for key, value in contribution(instance).items()})
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred():
+    """Collect the counter updates made inside and apply them together on the way out"""
+    if getattr(_deferred, 'deltas', None) is not None:
+        yield  # Nested, the outermost block applies
+        return
+    _deferred.deltas = {}
+    try:
+        yield
+        deltas = _deferred.deltas
+    finally:
+        _deferred.deltas = None
+    apply(deltas)
+
+
+def apply(deltas):
+    """Apply {(target, pk, field): delta}, one UPDATE per target row"""
+    pending = getattr(_deferred, 'deltas', None)
+    if pending is not None:
+        for key, delta in deltas.items():
+            pending[key] = pending.get(key, 0) + delta
+        return
+    rows = {}
+    for (target, pk, field), delta in deltas.items():
+        if delta and pk is not None:
+            rows.setdefault((target, pk), {})[field] = delta
+    for (target, pk), fields in rows.items():
+        TARGETS[target].objects.filter(pk=pk).update(
+            **{field: Greatest(F(field) + delta, 0) for field, delta in fields.items()}
+        )
+
+
+def adjust(user_id, **deltas):
+    """Add ``deltas`` (field -> amount) to a user's counters, never going below zero"""
+    apply({('user', user_id, field): delta for field, delta in deltas.items()})
+
+
+def lock_user(user_id):
+    """Hold the user's counter row until the transaction ends, serializing their counted writes"""
+    for_user(user_id)  # The row to lock, recounted if missing
+    list(UserStats.objects.select_for_update().filter(pk=user_id).values_list('pk', flat=True))
+
+
+def recount_user(user_id):
+    return {
+        field: model.objects.filter(**{fk: user_id}, **filters).count()
+        for field, (model, fk, filters) in USER_COUNTERS.items()
+    }
+
+
+def reset_user(user_id, *fields):
+    """Set some of a user's counters from a recount, for bulk writes that cannot tell what they changed"""
+    counts = {}
+    for field in fields:
+        model, fk, filters = USER_COUNTERS[field]
+        counts[field] = model.objects.filter(**{fk: user_id}, **filters).count()
+    UserStats.objects.filter(pk=user_id).update(**counts)
+
+
+def recount_site():
+    return {field: model.objects.filter(**filters).count() for field, (model, filters) in SITE_COUNTERS.items()}
+
+
+def recount_subjects():
+    """{subject_id: approved notes}, for subjects that have any"""
+    rows = Note.objects.filter(is_approved=True).values('subject').annotate(n=Count('pk')).values_list('subject', 'n')
+    return dict(rows)
+
+
+def recount_users():
+    """Every user's counters from grouped counts, one query per counter: {user_id: {field: count}}"""
+    counts = {}
+    for field, (model, fk, filters) in USER_COUNTERS.items():
+        rows = model.objects.filter(**filters).values(fk).annotate(n=Count('pk')).values_list(fk, 'n')
+        for user_id, n in rows:
+            counts.setdefault(user_id, {})[field] = n
+    return counts
+
+
+def get_or_recount(model, pk, recount):
+    try:
+        return model.objects.get(pk=pk)
+    except model.DoesNotExist:
+        counts = recount()
+        try:
+            # A savepoint, so a lost race leaves the caller's transaction usable on PostgreSQL
+            with transaction.atomic():
+                return model.objects.create(pk=pk, **counts)
+        except IntegrityError:
+            return model.objects.get(pk=pk)  # Created by a concurrent request
+
+
+def for_user(user_id):
+    return get_or_recount(UserStats, user_id, lambda: recount_user(user_id))
+
+
+def site():
+    return get_or_recount(SiteStats, SITE, recount_site)
@@ -0,0 +1,259 @@
+"""
+Content-addressed storage for note files and comment attachments.
+
+Files are stored once per distinct content under ``blobs/ab/cd/<sha256>``.
+The name saved on the model is ``<upload_to>/<sha256>/<original filename>``,
+which keeps the filename for downloads while every name with the same hash
+resolves to the same blob. ``Blob`` rows count references and the
+``gc_blobs`` command deletes blobs that nothing points to anymore.
+
+Uploads are hashed as they stream in by ``HashingMemoryUploadHandler`` and
+``HashingTemporaryUploadHandler``, so saving a file whose content is already
+stored costs neither a second hash pass nor a copy.
+
+Names saved before this storage was introduced have no hash segment and are
+read from their original location unchanged.
+"""
+import hashlib
+import os
+import re
+import uuid
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db.models import F
+from django.utils import timezone
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+HASH_SEGMENT = 65  # '<sha256>/' that stored_name inserts
+BLOB_DIR = 'blobs'
+READ_SIZE = 64 * 1024
+
+
+def fit_name(name, max_length):
+    """``name`` with the stem of its filename cut so the whole fits ``max_length``"""
+    excess = len(name) - max_length if max_length is not None else 0
+    if excess <= 0:
+        return name
+    directory, filename = os.path.split(name)
+    stem, extension = os.path.splitext(filename)
+    if excess >= len(stem):
+        raise SuspiciousFileOperation(f'Storage cannot fit "{name}" in {max_length} characters')
+    return '/'.join(part for part in (directory, stem[:-excess] + extension) if part)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def content_hash(self, name):
+        """SHA-256 encoded in a stored name, None for legacy names"""
+        parts = (name or '').split('/')
+        if len(parts) >= 3 and HASH_RE.match(parts[-2]):
+            return parts[-2]
+        return None
+
+    def physical_name(self, name):
+        """Path of the blob behind ``name``, relative to the storage root"""
+        digest = self.content_hash(name)
+        return name if digest is None else self.blob_name(digest)
+
+    def blob_name(self, digest):
+        return f'{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content is hashed in _save, leave room for the hash
+        return fit_name(name, None if max_length is None else max_length - HASH_SEGMENT)
+
+    def _save(self, name, content):
+        digest = getattr(content, 'sha256', None)
+        tmp_name = None
+        if digest is None:
+            digest, tmp_name = self._hash_to_temp(content)
+
+        # Count the reference first: gc_blobs skips blobs referenced within its grace period, and
+        # deletes a file before releasing the blob row, so the file is either kept or missing here
+        # and then written again.
+        add_reference(digest, content.size)
+        self._store_blob(digest, content, tmp_name)
+        return self.stored_name(name, digest)
+
+    def save_unreferenced(self, name, content, max_length=None):
+        """
+        Store ``content`` without counting a reference, returns (stored name,
+        digest). The caller counts it with ``add_references``, e.g. in the
+        transaction that saves the rows pointing at it.
+        """
+        name = self.generate_filename(name)
+        digest, tmp_name = self._hash_to_temp(content)
+        # gc_blobs leaves blobs referenced within its grace period alone until the caller counts it
+        mark_referenced(digest, content.size)
+        self._store_blob(digest, content, tmp_name)
+        return self.stored_name(name, digest, max_length), digest
+
+    def stored_name(self, name, digest, max_length=None):
+        directory, filename = os.path.split(name)
+        return fit_name('/'.join(part for part in (directory, digest, filename) if part), max_length)
+
+    def _store_blob(self, digest, content, tmp_name=None):
+        blob_path = super().path(self.blob_name(digest))
+        if os.path.exists(blob_path):
+            # Reused as is: the file is shared, its mtime stays the time it was first written
+            if tmp_name:
+                os.remove(tmp_name)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            if tmp_name:
+                os.replace(tmp_name, blob_path)
+            elif hasattr(content, 'temporary_file_path'):
+                file_move_safe(content.temporary_file_path(), blob_path, allow_overwrite=True)
+            else:
+                self._copy(content, blob_path)
+
+    def _hash_to_temp(self, content):
+        """Copy ``content`` to a temporary file next to the blobs, hashing it on the way"""
+        tmp_dir = self.path(f'{BLOB_DIR}/tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_name = os.path.join(tmp_dir, uuid.uuid4().hex)
+        sha = hashlib.sha256()
+        content.seek(0)
+        with open(tmp_name, 'wb') as out:
+            for chunk in content.chunks(READ_SIZE):
+                sha.update(chunk)
+                out.write(chunk)
+        return sha.hexdigest(), tmp_name
+
+    def _copy(self, content, path):
+        tmp_name = f'{path}.{uuid.uuid4().hex}.tmp'
+        content.seek(0)
+        with open(tmp_name, 'wb') as out:
+            for chunk in content.chunks(READ_SIZE):
+                out.write(chunk)
+        os.replace(tmp_name, path)
+
+    def _open(self, name, mode='rb'):
+        return super()._open(self.physical_name(name), mode)
+
+    def delete(self, name):
+        # Blobs are shared, they are only removed by gc_blobs.
+        if self.content_hash(name) is None:
+            super().delete(name)
+
+    def exists(self, name):
+        return super().exists(self.physical_name(name))
+
+    def size(self, name):
+        return super().size(self.physical_name(name))
+
+    def url(self, name):
+        return super().url(self.physical_name(name))
+
+    def get_accessed_time(self, name):
+        return super().get_accessed_time(self.physical_name(name))
+
+    def get_created_time(self, name):
+        return super().get_created_time(self.physical_name(name))
+
+    def get_modified_time(self, name):
+        # A blob never changes once written, so files.py serves its creation time as Last-Modified
+        digest = self.content_hash(name)
+        if digest:
+            from .models import Blob
+
+            created_at = Blob.objects.filter(sha256=digest).values_list('created_at', flat=True).first()
+            if created_at is not None:
+                return created_at
+        return super().get_modified_time(self.physical_name(name))
+
+    def path(self, name):
+        return super().path(self.physical_name(name))
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def get_blob_storage():
+    return blob_storage
+
+
+def add_reference(digest, size=0):
+    from .models import Blob
+
+    blobs = Blob.objects.filter(sha256=digest)
+    if not blobs.update(ref_count=F('ref_count') + 1, referenced_at=timezone.now()):
+        _, created = Blob.objects.get_or_create(sha256=digest, defaults={'size': size, 'ref_count': 1})
+        if not created:
+            blobs.update(ref_count=F('ref_count') + 1, referenced_at=timezone.now())
+
+
+def mark_referenced(digest, size=0):
+    """Restart the gc_blobs grace period of a blob without counting a reference"""
+    from .models import Blob
+
+    if not Blob.objects.filter(sha256=digest).update(referenced_at=timezone.now()):
+        Blob.objects.bulk_create([Blob(sha256=digest, size=size, ref_count=0)], ignore_conflicts=True)
+
+
+def add_references(sizes, counts):
+    """Count ``counts[digest]`` more references per blob in a few queries, creating missing rows"""
+    from .models import Blob
+
+    Blob.objects.bulk_create(
+        [Blob(sha256=digest, size=sizes[digest], ref_count=0) for digest in counts], ignore_conflicts=True
+    )
+    by_amount = {}
+    for digest, count in counts.items():
+        by_amount.setdefault(count, []).append(digest)
+    for count, digests in by_amount.items():
+        Blob.objects.filter(sha256__in=digests).update(ref_count=F('ref_count') + count, referenced_at=timezone.now())
+
+
+def add_name_reference(name):
+    """Count another row pointing at an already stored name"""
+    digest = blob_storage.content_hash(name)
+    if digest:
+        add_reference(digest)
+
+
+def remove_reference(name):
+    from .models import Blob
+
+    digest = blob_storage.content_hash(name)
+    if digest:
+        Blob.objects.filter(sha256=digest, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+
+class HashingMemoryUploadHandler(MemoryFileUploadHandler):
+    """MemoryFileUploadHandler that also records the upload's SHA-256"""
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        if uploaded is not None:
+            uploaded.sha256 = self.sha256.hexdigest()
+        return uploaded
+
+
+class HashingTemporaryUploadHandler(TemporaryFileUploadHandler):
+    """TemporaryFileUploadHandler that also records the upload's SHA-256"""
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        uploaded.sha256 = self.sha256.hexdigest()
+        return uploaded
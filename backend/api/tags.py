@@ -0,0 +1,49 @@
+"""
+Normalized tags.
+
+``Note.tags`` stays the comma separated string the app sends and displays,
+``Note.tag_set`` mirrors it with one ``Tag`` row per distinct lowercase tag so
+tag filters and counts are index lookups instead of ``icontains`` scans.
+"""
+from django.db.models import Count, Q
+from .models import Tag
+
+
+def normalize(name):
+    return ' '.join(name.split()).lower()[:100]
+
+
+def parse_tags(value):
+    """Distinct normalized tags of a comma separated string, in order"""
+    names = []
+    for part in (value or '').split(','):
+        name = normalize(part)
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def get_or_create_tags(names, tag_model=Tag):
+    """Tag rows for ``names``, created in bulk where missing"""
+    if not names:
+        return []
+    tag_model.objects.bulk_create([tag_model(name=name) for name in names], ignore_conflicts=True)
+    return list(tag_model.objects.filter(name__in=names))
+
+
+def sync_note_tags(note):
+    note.tag_set.set(get_or_create_tags(parse_tags(note.tags)))
+
+
+def tag_counts(subject_id=None, limit=None):
+    """Tags with their number of approved notes, most used first, in one query"""
+    condition = Q(notes__is_approved=True)
+    if subject_id:
+        condition &= Q(notes__subject_id=subject_id)
+    queryset = (
+        Tag.objects.annotate(notes_count=Count('notes', filter=condition))
+        .filter(notes_count__gt=0)
+        .order_by('-notes_count', 'name')
+        .values('name', 'notes_count')
+    )
+    return list(queryset if limit is None else queryset[:limit])
@@ -0,0 +1,25 @@
+"""
+Job handlers run by ``manage.py runworker``, see api/jobs.py.
+"""
+from . import jobs, thumbnails, uploads
+from .models import Notification
+
+
+@jobs.register('notifications.create')
+def create_notification(user_id, title, message):
+    Notification.objects.create(user_id=user_id, title=title, message=message)
+
+
+def notify(user, title, message):
+    """Queue a notification for ``user``, committed with the caller's transaction"""
+    return jobs.enqueue('notifications.create', {'user_id': user.pk, 'title': title, 'message': message})
+
+
+@jobs.register('uploads.assemble', on_failure=uploads.give_up)
+def assemble_upload(session_id):
+    uploads.assemble(session_id)
+
+
+@jobs.register('thumbnails.generate', on_failure=thumbnails.give_up)
+def generate_thumbnails(note_id):
+    thumbnails.generate(note_id)
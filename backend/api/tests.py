@@ -1,3 +1,1622 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from . import (
+    authentication, caching, compact, compression, counters, events, files, jobs, passwords, renderers, replicas,
+    search, stats, tasks, threads, thumbnails, uploads, views,
+)
+from .models import (
+    Blob, Bookmark, Comment, CounterBatch, Download, Job, Note, NoteRequest, Notification, SiteStats, Subject,
+    UploadSession, User, UserStats,
+)
+from .storage import blob_storage
+
+# Rows per big table, raise it to check plans against a production-sized dataset
+ROWS = int(os.environ.get('QUERY_PLAN_ROWS', 3000))
+
+# Tables small enough that reading them whole is the right plan
+SMALL_TABLES = {'api_subject', 'api_sitestats'}
+
+
+def sqlite_plan_problems(sql):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        details = [row[-1] for row in cursor.fetchall()]
+    # Scanning the rows a subquery produced is fine, its own plan lines are checked
+    derived = {detail.split(' ', 1)[1] for detail in details if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    problems = []
+    for detail in details:
+        words = detail.split()
+        if words[0] == 'SCAN' and 'USING' not in words and words[1] not in SMALL_TABLES | derived:
+            problems.append(detail)
+        if 'TEMP B-TREE' in detail:
+            problems.append(detail)
+    return problems
+
+
+def postgresql_plan_problems(sql):
+    with connection.cursor() as cursor:
+        # Made expensive rather than impossible, so a plan that still needs them is a missing index
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('SET LOCAL enable_sort = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+        plan = cursor.fetchone()[0][0]['Plan']
+    problems = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if node['Node Type'] == 'Seq Scan' and node['Relation Name'] not in SMALL_TABLES:
+            problems.append(f"Seq Scan on {node['Relation Name']}")
+        if node['Node Type'] in ('Sort', 'Incremental Sort'):
+            problems.append(f"Sort on {', '.join(node['Sort Key'])}")
+    return problems
+
+
+class QueryPlanTests(TestCase):
+    """
+    Every query behind the list endpoints must be served by an index: no full
+    scan of a large table and no sort into a temporary B-tree.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = User.objects.bulk_create(
+            User(email=f'user{i}@example.com', full_name=f'User {i}', password='!')
+            for i in range(max(ROWS // 100, 10))
+        )
+        subjects = Subject.objects.bulk_create(Subject(name=f'Subject {i}') for i in range(10))
+        notes = Note.objects.bulk_create(
+            Note(
+                title=f'Note {i}', description='Notes', file=f'notes/{i}.pdf',
+                subject=subjects[i % len(subjects)], uploaded_by=users[i % len(users)],
+                is_approved=i % 10 != 0, created_at=now - timedelta(minutes=i),
+            )
+            for i in range(ROWS)
+        )
+        requests = NoteRequest.objects.bulk_create(
+            NoteRequest(
+                title=f'Request {i}', description='Wanted', subject=subjects[i % len(subjects)],
+                requested_by=users[i % len(users)], status=('open', 'fulfilled', 'closed')[i % 3],
+                created_at=now - timedelta(minutes=i),
+            )
+            for i in range(ROWS)
+        )
+        roots = Comment.objects.bulk_create(
+            Comment(content_type='note', note=notes[i % 50], user=users[i % len(users)], text='Top',
+                    created_at=now - timedelta(minutes=i))
+            for i in range(ROWS // 2)
+        )
+        Comment.objects.bulk_create(
+            Comment(content_type='note', note=root.note, user=root.user, text='Reply', parent=root, root=root,
+                    depth=1)
+            for root in roots
+        )
+        Comment.objects.bulk_create(
+            Comment(content_type='request', request=requests[i % 50], user=users[i % len(users)], text='Top')
+            for i in range(ROWS // 2)
+        )
+        Download.objects.bulk_create(Download(note=note, user=note.uploaded_by) for note in notes)
+        Bookmark.objects.bulk_create(
+            Bookmark(note=note, user=users[i % len(users)]) for i, note in enumerate(notes[::3])
+        )
+        Notification.objects.bulk_create(
+            Notification(user=users[i % len(users)], title='Hi', message='m', is_read=i % 3 == 0)
+            for i in range(ROWS)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.user = users[0]
+        cls.note = notes[1]
+        cls.subject = subjects[1]
+        cls.request = requests[0]
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def assert_indexed(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+
+        if connection.vendor == 'sqlite':
+            plan_problems = sqlite_plan_problems
+        elif connection.vendor == 'postgresql':
+            plan_problems = postgresql_plan_problems
+        else:
+            self.skipTest(f'No plan checks for {connection.vendor}')
+        for query in captured.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            problems = plan_problems(sql)
+            self.assertFalse(problems, f'{url} runs an unindexed query: {problems}\n{sql}')
+        return response
+
+    def test_note_feed(self):
+        response = self.assert_indexed('/api/notes/')
+        self.assert_indexed(response.json()['next'])
+
+    def test_notes_by_subject(self):
+        self.assert_indexed(f'/api/notes/?subject={self.subject.pk}')
+
+    def test_my_notes(self):
+        self.assert_indexed('/api/notes/?my_notes=1')
+
+    def test_request_feed(self):
+        response = self.assert_indexed('/api/requests/')
+        self.assert_indexed(response.json()['next'])
+
+    def test_requests_by_status(self):
+        self.assert_indexed('/api/requests/?status=open')
+
+    def test_note_comments(self):
+        response = self.assert_indexed(f'/api/notes/{self.note.pk}/comments/')
+        self.assert_indexed(response.json()['next'])
+        self.assert_indexed(f'/api/comments/?note={self.note.pk}')
+
+    def test_request_comments(self):
+        self.assert_indexed(f'/api/requests/{self.request.pk}/comments/')
+
+    def test_notifications(self):
+        response = self.assert_indexed('/api/notifications/')
+        self.assert_indexed(response.json()['next'])
+        self.assert_indexed('/api/notifications/?unread=1')
+        self.assert_indexed('/api/notifications/unread_count/')
+
+    def test_user_lists(self):
+        self.assert_indexed('/api/my/bookmarks/')
+        self.assert_indexed('/api/my/downloads/')
+        self.assert_indexed('/api/dashboard/')
+
+    def test_subjects(self):
+        self.assert_indexed('/api/subjects/')
+
+
+class SearchTests(TestCase):
+    """Search ranks the index's best matches and applies the list's other filters to them"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.physics = Subject.objects.create(name='Physics')
+        cls.history = Subject.objects.create(name='History')
+
+        def note(title, description='Notes', subject=None, tags='', is_approved=True):
+            return Note.objects.create(title=title, description=description, tags=tags, file='notes/a.pdf',
+                                       subject=subject or cls.physics, uploaded_by=cls.user, is_approved=is_approved)
+
+        cls.in_description = note('Week 1', description='Thermodynamics lecture')
+        cls.in_title = note('Thermodynamics summary')
+        cls.in_tags = note('Week 2', tags='thermodynamics')
+        cls.other_subject = note('Thermodynamics in history', subject=cls.history)
+        cls.unapproved = note('Thermodynamics draft', is_approved=False)
+        note('Optics')
+        cls.request = NoteRequest.objects.create(title='Thermodynamics slides', description='Please',
+                                                 subject=cls.physics, requested_by=cls.user)
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.json()['results']]
+
+    def test_title_ranks_above_tags_above_description(self):
+        self.assertEqual(self.ids(f'/api/notes/?search=thermodynamics&subject={self.physics.pk}'),
+                         [self.in_title.pk, self.in_tags.pk, self.in_description.pk])
+
+    def test_prefixes_and_query_syntax(self):
+        self.assertIn(self.in_title.pk, self.ids('/api/notes/?search=thermo'))
+        # FTS operators are matched as words, not interpreted
+        self.assertEqual(self.ids('/api/notes/?search=thermo OR optics'), [])
+        self.assertEqual(self.ids('/api/notes/?search=%22*'), [])
+
+    def test_filters_apply_to_the_matches(self):
+        ids = self.ids('/api/notes/?search=thermodynamics')
+        self.assertIn(self.other_subject.pk, ids)
+        self.assertNotIn(self.unapproved.pk, ids)
+        self.assertEqual(self.ids(f'/api/notes/?search=thermodynamics&subject={self.history.pk}'),
+                         [self.other_subject.pk])
+        self.assertEqual(self.ids('/api/requests/?search=slides'), [self.request.pk])
+
+    def test_index_follows_edits_and_deletes(self):
+        Note.objects.filter(pk=self.in_title.pk).first().delete()
+        self.in_tags.title = 'Entropy'
+        self.in_tags.tags = ''
+        self.in_tags.save()
+        self.assertEqual(self.ids('/api/notes/?search=entropy'), [self.in_tags.pk])
+        self.assertNotIn(self.in_title.pk, self.ids('/api/notes/?search=thermodynamics'))
+
+    def test_ranked_pages_and_truncation(self):
+        with mock.patch.object(search, 'SEARCH_RESULT_LIMIT', 2):
+            response = self.client.get('/api/notes/?search=week&page_size=1')
+            self.assertFalse(response.json()['truncated'])
+            ids = [item['id'] for item in response.json()['results']]
+            ids += self.ids(response.json()['next'])
+            self.assertEqual(sorted(ids), [self.in_description.pk, self.in_tags.pk])
+
+            response = self.client.get('/api/notes/?search=thermodynamics')
+            self.assertTrue(response.json()['truncated'])
+            self.assertLessEqual(len(response.json()['results']), 2)
+
+
+class TagTests(TestCase):
+    """Note tags are mirrored as normalized Tag rows, which the tag filter and tag counts read"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.physics = Subject.objects.create(name='Physics')
+        history = Subject.objects.create(name='History')
+
+        def note(tags, subject=None, is_approved=True):
+            return Note.objects.create(title='Notes', description='d', tags=tags, file='notes/a.pdf',
+                                       subject=subject or cls.physics, uploaded_by=cls.user, is_approved=is_approved)
+
+        cls.both = note('Exam Prep,  Week   1')
+        cls.exam = note('exam prep, exam prep')
+        cls.history = note('Week 1', subject=history)
+        note('exam prep', is_approved=False)
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sorted(item['id'] for item in response.json()['results'])
+
+    def test_tags_are_normalized(self):
+        self.assertEqual(sorted(self.both.tag_set.values_list('name', flat=True)), ['exam prep', 'week 1'])
+        self.assertEqual(list(self.exam.tag_set.values_list('name', flat=True)), ['exam prep'])
+
+    def test_filter_matches_every_given_tag(self):
+        self.assertEqual(self.ids('/api/notes/?tag=EXAM%20prep'), sorted([self.both.pk, self.exam.pk]))
+        self.assertEqual(self.ids('/api/notes/?tag=exam prep&tag=week 1'), [self.both.pk])
+        self.assertEqual(self.ids('/api/notes/?tag=unknown'), [])
+
+    def test_editing_tags_updates_the_filter(self):
+        self.exam.tags = 'week 1'
+        self.exam.save()
+        self.assertEqual(self.ids('/api/notes/?tag=exam prep'), [self.both.pk])
+        self.assertEqual(self.ids('/api/notes/?tag=week 1'), sorted([self.both.pk, self.exam.pk, self.history.pk]))
+
+    def test_counts_approved_notes_per_tag(self):
+        response = self.client.get('/api/tags/')
+        self.assertEqual(response.json(), [
+            {'name': 'exam prep', 'notes_count': 2},
+            {'name': 'week 1', 'notes_count': 2},
+        ])
+        response = self.client.get(f'/api/tags/?subject={self.physics.pk}&limit=1')
+        self.assertEqual(response.json(), [{'name': 'exam prep', 'notes_count': 2}])
+        for query in ('limit=0', 'limit=many', 'subject=physics'):
+            self.assertEqual(self.client.get(f'/api/tags/?{query}').status_code, 400, query)
+
+
+class ResponseShapeTests(TestCase):
+    """``?compact=1`` moves repeated references into ``included``, ``?fields=`` and ``?exclude=`` pick fields"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.subject = Subject.objects.create(name='Physics')
+        cls.notes = [
+            Note.objects.create(title=f'Note {i}', description='Worked examples ' * 20, file='notes/a.pdf',
+                                subject=cls.subject, uploaded_by=cls.user, is_approved=True)
+            for i in range(3)
+        ]
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_compact_list(self):
+        body = self.client.get('/api/notes/?compact=1').json()
+        for item in body['results']:
+            self.assertEqual((item['uploaded_by'], item['subject']), (self.user.pk, self.subject.pk))
+            self.assertLessEqual(len(item['description']), compact.EXCERPT_LENGTH + 1)
+            self.assertTrue(item['description'].endswith('…'))
+        self.assertEqual(list(body['included']['users']), [str(self.user.pk)])
+        self.assertEqual(body['included']['users'][str(self.user.pk)]['full_name'], 'Reader')
+        self.assertEqual(body['included']['subjects'][str(self.subject.pk)]['name'], 'Physics')
+
+    def test_full_list_and_detail_are_unchanged(self):
+        item = self.client.get('/api/notes/').json()['results'][0]
+        self.assertEqual(item['uploaded_by']['id'], self.user.pk)
+        self.assertEqual(item['description'], self.notes[0].description)
+        body = self.client.get(f'/api/notes/{self.notes[0].pk}/?compact=1').json()
+        self.assertNotIn('included', body)
+        self.assertEqual(body['description'], self.notes[0].description)
+
+    def test_sparse_fieldsets(self):
+        results = self.client.get('/api/notes/?fields=id,title').json()['results']
+        self.assertEqual({tuple(item) for item in results}, {('id', 'title')})
+        item = self.client.get('/api/notes/?exclude=description,uploaded_by').json()['results'][0]
+        self.assertNotIn('description', item)
+        self.assertNotIn('uploaded_by', item)
+        self.assertIn('title', item)
+
+    def test_excerpt(self):
+        self.assertEqual(compact.excerpt('short'), 'short')
+        self.assertEqual(compact.excerpt('one two three', 9), 'one two…')
+        self.assertEqual(compact.excerpt('one two, three', 8), 'one two…')
+
+
+class CompressionTests(TestCase):
+    """Responses are compressed with the encoding the client prefers, and orjson renders what DRF would"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        subject = Subject.objects.create(name='Physics')
+        for i in range(5):
+            Note.objects.create(title=f'Note {i}', description='Worked examples ' * 20, file='notes/a.pdf',
+                                subject=subject, uploaded_by=cls.user, is_approved=True)
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def process(self, response, accept_encoding='gzip'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return compression.CompressionMiddleware(lambda request: response)(request)
+
+    def test_choose_encoding(self):
+        with mock.patch.object(compression, 'ENCODINGS', ('br', 'gzip')):
+            self.assertEqual(compression.choose_encoding('gzip, deflate, br'), 'br')
+            self.assertEqual(compression.choose_encoding('br;q=0.5, gzip'), 'gzip')
+            self.assertEqual(compression.choose_encoding('br;q=0, *'), 'gzip')
+        with mock.patch.object(compression, 'ENCODINGS', ('gzip',)):
+            self.assertEqual(compression.choose_encoding('br'), None)
+        self.assertEqual(compression.choose_encoding('gzip;q=0'), None)
+        self.assertEqual(compression.choose_encoding('gzip;q=high, identity'), None)
+        self.assertEqual(compression.choose_encoding(''), None)
+
+    def test_api_responses_are_gzipped(self):
+        plain = self.client.get('/api/notes/')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        response = self.client.get('/api/notes/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+    def test_what_is_left_uncompressed(self):
+        small = self.process(HttpResponse(b'{}', content_type='application/json'))
+        self.assertNotIn('Content-Encoding', small)
+        self.assertIn('Accept-Encoding', small['Vary'])
+        pdf = self.process(HttpResponse(b'%PDF' * 1000, content_type='application/pdf'))
+        self.assertNotIn('Content-Encoding', pdf)
+        self.assertFalse(pdf.has_header('Vary'))
+        body = b'{"text": "%s"}' % (b'a' * 2000)
+        not_found = HttpResponse(body, content_type='application/json', status=404)
+        no_transform = HttpResponse(body, content_type='application/json', headers={'Cache-Control': 'no-transform'})
+        for response in (not_found, no_transform):
+            self.assertEqual(self.process(response).content, body)
+
+    def test_etag_is_weakened(self):
+        response = HttpResponse(b'[%s]' % b','.join([b'1'] * 1000), content_type='application/json')
+        response['ETag'] = '"abc"'
+        self.assertEqual(self.process(response)['ETag'], 'W/"abc"')
+
+    def test_streams_are_flushed_chunk_by_chunk(self):
+        chunks = [b'{"chunk": %d}' % i for i in range(3)]
+        response = self.process(StreamingHttpResponse(iter(chunks), content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        parts = list(response.streaming_content)
+        # Each chunk can be decompressed as soon as it arrives
+        for chunk, part in zip(chunks, parts):
+            self.assertEqual(decompressor.decompress(part), chunk)
+        self.assertEqual(gzip.decompress(b''.join(parts)), b''.join(chunks))
+
+    def test_async_streams(self):
+        async def chunks():
+            for i in range(3):
+                yield b'{"chunk": %d}' % i
+
+        async def read(content):
+            return [part async for part in content]
+
+        response = self.process(StreamingHttpResponse(chunks(), content_type='application/json'))
+        parts = async_to_sync(read)(response.streaming_content)
+        self.assertEqual(gzip.decompress(b''.join(parts)), b'{"chunk": 0}{"chunk": 1}{"chunk": 2}')
+
+    @skipUnless(compression.brotli, 'brotli is not installed')
+    def test_brotli(self):
+        response = self.client.get('/api/notes/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(response.content), self.client.get('/api/notes/').content)
+
+    def test_fast_renderer_matches_drf(self):
+        data = {'price': Decimal('1.50'), 'at': timezone.now(), 'included': {1: {'name': 'Thermodynamics é'}}}
+        self.assertEqual(renderers.FastJSONRenderer().render(data), JSONRenderer().render(data))
+        indented = renderers.FastJSONRenderer().render(data, 'application/json; indent=2')
+        self.assertEqual(indented, JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_parse_errors_are_bad_requests(self):
+        response = self.client.post('/api/notes/bulk_bookmark/', '{"add": [1,', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+        self.assertEqual(json.loads(renderers.FastJSONRenderer().render({'add': [1]})), {'add': [1]})
+
+
+class CounterBufferTests(TestCase):
+    """Buffered counter increments reach the table once: flushed, kept on failure, or spooled and replayed"""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        subject = Subject.objects.create(name='Physics')
+        cls.notes = [
+            Note.objects.create(title='Notes', description='d', file='notes/a.pdf', subject=subject, uploaded_by=user,
+                                is_approved=True)
+            for _ in range(3)
+        ]
+
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool_dir = spool_dir.name
+        self.buffer = counters.CounterBuffer(flush_interval=60, spool_dir=spool_dir.name)
+        patcher = mock.patch.object(counters.CounterBuffer, '_ensure_flusher')  # Flushed by hand here
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def views(self):
+        return list(Note.objects.filter(pk__in=[note.pk for note in self.notes]).order_by('pk')
+                    .values_list('views_count', flat=True))
+
+    def test_write_through_without_an_interval(self):
+        buffer = counters.CounterBuffer(flush_interval=0, spool_dir=self.spool_dir)
+        note = self.notes[0]
+        buffer.increment(note, 'views_count')
+        self.assertEqual(note.views_count, 1)
+        self.assertEqual(self.views(), [1, 0, 0])
+
+    def test_increments_are_buffered_until_flushed(self):
+        first, second = self.notes[:2]
+        self.buffer.increment(Note.objects.get(pk=first.pk), 'views_count')
+        # Each request loads the row: it sees the increments still buffered, its own included
+        note = Note.objects.get(pk=first.pk)
+        self.buffer.increment(note, 'views_count')
+        self.assertEqual(note.views_count, 2)
+        self.buffer.increment(second, 'views_count', 2)
+        self.assertEqual(self.views(), [0, 0, 0])
+
+        # Both rows have +2, so one UPDATE covers them
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(len([q for q in captured.captured_queries if q['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(self.views(), [2, 2, 0])
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_failed_flush_keeps_the_increments(self):
+        self.buffer.increment(self.notes[0], 'views_count')
+        with mock.patch.object(self.buffer, '_write', side_effect=DatabaseError('locked')), \
+                self.assertLogs('api.counters', 'ERROR'):
+            self.buffer.flush()
+        self.buffer.increment(self.notes[0], 'views_count')
+        self.buffer.flush()
+        self.assertEqual(self.views()[0], 2)
+
+    def test_spooled_batch_is_applied_once(self):
+        self.buffer.increment(self.notes[0], 'views_count', 3)
+        path = self.buffer.spool()
+        self.assertEqual(self.views()[0], 0)
+
+        # A replay that committed but crashed before removing its file
+        batch = path.name.split('.')[0]
+        CounterBatch.objects.create(batch=batch)
+        self.assertEqual(self.buffer.replay_spool(), 0)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        self.assertEqual(self.views()[0], 0)
+
+        self.buffer.increment(self.notes[1], 'views_count', 3)
+        self.buffer.spool()
+        self.assertEqual(self.buffer.replay_spool(), 1)
+        self.assertEqual(self.views(), [0, 3, 0])
+        self.assertFalse(CounterBatch.objects.exists())
+
+    def test_stale_claims_are_taken_over(self):
+        self.buffer.increment(self.notes[2], 'views_count')
+        path = self.buffer.spool()
+        claimed = path.with_name(path.stem + '.dead.claimed')
+        os.rename(path, claimed)
+        self.assertEqual(self.buffer.replay_spool(), 0)  # Claimed by a process that may still be running
+
+        stale = time.time() - counters.STALE_CLAIM - 1
+        os.utime(claimed, (stale, stale))
+        self.assertEqual(self.buffer.replay_spool(), 1)
+        self.assertEqual(self.views()[2], 1)
+
+
+class NotificationEventTests(TestCase):
+    """The SSE hub hands each notification to its user's streams once, and reconnects replay what was missed"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.other = User.objects.create_user(email='other@example.com', password='pw12345678!', full_name='Other')
+
+    def setUp(self):
+        patcher = mock.patch.object(events, 'backend', mock.Mock(listen=mock.AsyncMock()))  # No polling task
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def notify(self, user, ago=0):
+        notification = Notification.objects.create(user=user, title='Hi', message='m')
+        if ago:
+            notification.created_at = timezone.now() - timedelta(seconds=ago)
+            Notification.objects.filter(pk=notification.pk).update(created_at=notification.created_at)
+        return notification
+
+    def test_dispatch_reaches_only_the_users_streams(self):
+        async def scenario():
+            hub = events.Hub()
+            mine, also_mine, theirs = hub.subscribe(1), hub.subscribe(1), hub.subscribe(2)
+            hub.dispatch(1, 10, 'data')
+            await asyncio.sleep(0)  # Delivered through the loop
+            self.assertEqual([mine.get_nowait(), also_mine.get_nowait()], [(10, 'data'), (10, 'data')])
+            self.assertTrue(theirs.empty())
+
+            hub.unsubscribe(1, mine)
+            hub.unsubscribe(1, also_mine)
+            self.assertFalse(hub.is_subscribed(1))
+            hub.dispatch(1, 11, 'data')
+            await asyncio.sleep(0)
+            self.assertTrue(mine.empty())
+
+            # A stream this far behind keeps the newest events
+            for event_id in range(events.QUEUE_SIZE + 5):
+                hub.dispatch(2, event_id, 'data')
+            await asyncio.sleep(0)
+            self.assertEqual(theirs.qsize(), events.QUEUE_SIZE)
+            self.assertEqual(theirs.get_nowait()[0], 5)
+
+        async_to_sync(scenario)()
+
+    def test_database_backend_sends_each_row_once(self):
+        backend = events.DatabaseBackend()
+        hub = mock.Mock(has_subscribers=lambda: True, is_subscribed=lambda user_id: user_id == self.user.pk)
+        fetch = async_to_sync(backend.fetch)
+        self.assertEqual(fetch(hub), ([], 0))  # Starts from now
+
+        first = self.notify(self.user)
+        self.notify(self.other)
+        sent, fetched = fetch(hub)
+        self.assertEqual(([event_id for _, event_id, _ in sent], fetched), ([first.pk], 2))
+        self.assertEqual(fetch(hub), ([], 0))
+
+        # Committed late, with a created_at before the newest row already handled
+        late = self.notify(self.user, ago=5)
+        self.assertEqual([event_id for _, event_id, _ in fetch(hub)[0]], [late.pk])
+        self.assertEqual(fetch(hub), ([], 0))
+
+    def test_reconnect_replays_missed_and_late_notifications(self):
+        seen = self.notify(self.user, ago=10)
+        late = self.notify(self.user, ago=20)  # Committed after the client saw ``seen``
+        new = self.notify(self.user)
+        self.notify(self.other)
+        missed = async_to_sync(events.missed_events)(self.user, seen.pk)
+        self.assertEqual([event_id for event_id, _ in missed], [late.pk, seen.pk, new.pk])
+
+    def test_stream_drops_repeated_ids(self):
+        new = self.notify(self.user)
+
+        async def scenario():
+            frames = events.stream(self.user, last_event_id=new.pk - 1)
+            self.assertEqual(await anext(frames), 'retry: 5000\n\n')
+            self.assertTrue((await anext(frames)).startswith(f'id: {new.pk}\n'))
+            events.hub.dispatch(self.user.pk, new.pk, 'again')  # Also polled after the replay
+            events.hub.dispatch(self.user.pk, new.pk + 1, '{}')
+            self.assertEqual(await anext(frames), f'id: {new.pk + 1}\nevent: notification\ndata: {{}}\n\n')
+            await frames.aclose()
+            self.assertFalse(events.hub.is_subscribed(self.user.pk))
+
+        async_to_sync(scenario)()
+
+
+class BlobStorageTests(TestCase):
+    """Files with the same content share one blob, counted by its references and collected by gc_blobs"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        self.subject = Subject.objects.create(name='Physics')
+
+    def note(self, content, filename='notes.pdf'):
+        return Note.objects.create(title='Notes', description='d', subject=self.subject, uploaded_by=self.user,
+                                   is_approved=True, file=SimpleUploadedFile(filename, content))
+
+    def blob(self, note):
+        return Blob.objects.get(sha256=blob_storage.content_hash(note.file.name))
+
+    def test_same_content_is_stored_once(self):
+        first = self.note(b'%PDF-1.4 same', 'a.pdf')
+        second = self.note(b'%PDF-1.4 same', 'b.pdf')
+        self.assertEqual(self.blob(first), self.blob(second))
+        self.assertEqual(self.blob(first).ref_count, 2)
+        self.assertEqual(first.file.path, second.file.path)
+        self.assertTrue(second.file.name.endswith('/b.pdf'))
+
+    def test_reuse_leaves_the_shared_file_alone(self):
+        first = self.note(b'%PDF-1.4 same')
+        week_ago = (timezone.now() - timedelta(days=7)).timestamp()
+        os.utime(first.file.path, (week_ago, week_ago))
+        Blob.objects.update(referenced_at=timezone.now() - timedelta(days=7))
+
+        self.note(b'%PDF-1.4 same')
+        self.assertEqual(os.path.getmtime(first.file.path), week_ago)
+        self.assertGreater(self.blob(first).referenced_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(blob_storage.get_modified_time(first.file.name), self.blob(first).created_at)
+
+    def test_delete_and_replace_release_the_reference(self):
+        first = self.note(b'%PDF-1.4 same')
+        second = self.note(b'%PDF-1.4 same')
+        blob = self.blob(first)
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+        second.file = SimpleUploadedFile('new.pdf', b'%PDF-1.4 new')
+        second.save()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertEqual(self.blob(second).ref_count, 1)
+
+    def test_gc_deletes_only_unreferenced_blobs(self):
+        kept = self.note(b'%PDF-1.4 kept')
+        dropped = self.note(b'%PDF-1.4 dropped')
+        dropped_blob, dropped_path = self.blob(dropped), dropped.file.path
+        dropped.delete()
+        Blob.objects.filter(pk=self.blob(kept).pk).update(ref_count=5)  # Drifted, gc recounts it
+
+        call_command('gc_blobs', grace_hours=0, stdout=StringIO())
+        self.assertFalse(Blob.objects.filter(pk=dropped_blob.pk).exists())
+        self.assertFalse(os.path.exists(dropped_path))
+        self.assertEqual(self.blob(kept).ref_count, 1)
+        self.assertTrue(os.path.exists(kept.file.path))
+
+    def test_gc_keeps_blobs_within_the_grace_period(self):
+        note = self.note(b'%PDF-1.4 recent')
+        blob = self.blob(note)
+        note.delete()
+        call_command('gc_blobs', stdout=StringIO())
+        self.assertTrue(Blob.objects.filter(pk=blob.pk).exists())
+
+
+class FileServingTests(TestCase):
+    """Note files stream with validators, a single byte range and proxy offload"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        subject = Subject.objects.create(name='Physics')
+        self.note = Note.objects.create(title='Notes', description='d', subject=subject, uploaded_by=user,
+                                        is_approved=True, file=SimpleUploadedFile('notes.pdf', b'0123456789'))
+        self.url = f'/api/notes/{self.note.pk}/file/'
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_parse_range(self):
+        self.assertEqual(files.parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(files.parse_range('bytes=-3', 10), (7, 9))  # Suffix
+        self.assertEqual(files.parse_range('bytes=-30', 10), (0, 9))
+        self.assertEqual(files.parse_range('bytes=4-', 10), (4, 9))  # Open ended
+        self.assertEqual(files.parse_range('bytes=8-30', 10), (8, 9))
+        self.assertIsNone(files.parse_range('bytes=0-1,4-5', 10))  # Multiple ranges: the whole file
+        self.assertIsNone(files.parse_range('bytes=-', 10))
+        self.assertIsNone(files.parse_range('items=0-1', 10))
+        self.assertIsNone(files.parse_range(None, 10))
+        self.assertIs(files.parse_range('bytes=10-', 10), False)  # Unsatisfiable
+        self.assertIs(files.parse_range('bytes=5-2', 10), False)
+        self.assertIs(files.parse_range('bytes=-0', 10), False)
+        self.assertIs(files.parse_range('bytes=0-', 0), False)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        validators = self.client.get(self.url)
+        for if_range in (validators['ETag'], validators['Last-Modified']):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 206, if_range)
+        # A stale validator gets the whole current file instead of a range of it
+        for if_range in ('"stale"', 'W/' + validators['ETag'], 'Mon, 01 Jan 2001 00:00:00 GMT'):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 200, if_range)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_not_modified(self):
+        validators = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=validators['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=validators['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_accel_redirect_is_quoted(self):
+        name = 'notes/week 1 100% ü?.pdf'  # Saved before content-addressed storage
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'notes'), exist_ok=True)
+        with open(os.path.join(settings.MEDIA_ROOT, name), 'wb') as legacy:
+            legacy.write(b'legacy')
+        Note.objects.filter(pk=self.note.pk).update(file=name)
+
+        with mock.patch.object(files, 'SENDFILE_BACKEND', 'nginx'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         files.ACCEL_REDIRECT_PREFIX + 'notes/week%201%20100%25%20%C3%BC%3F.pdf')
+
+
+class StatsTests(TestCase):
+    """Dashboard, site and subject counters follow saves and deletes, and reconcile_stats finds any drift"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        cls.subject = Subject.objects.create(name='Physics')
+
+    def note(self, is_approved=False):
+        return Note.objects.create(title='Notes', description='d', file='notes/a.pdf', subject=self.subject,
+                                   uploaded_by=self.user, is_approved=is_approved)
+
+    def counts(self):
+        user, site = stats.for_user(self.user.pk), stats.site()
+        self.subject.refresh_from_db()
+        return user.uploads, site.total_notes, self.subject.notes_count
+
+    def test_counters_follow_saves_and_deletes(self):
+        note = self.note()
+        self.note(is_approved=True)
+        self.assertEqual(self.counts(), (2, 1, 1))
+
+        note.is_approved = True
+        note.save(update_fields=['is_approved'])
+        self.assertEqual(self.counts(), (2, 2, 2))
+        note.title = 'Renamed'
+        note.save(update_fields=['title'])  # Untracked field, no counter is read or written
+        self.assertEqual(self.counts(), (2, 2, 2))
+
+        note.delete()
+        self.assertEqual(self.counts(), (1, 1, 1))
+        request = NoteRequest.objects.create(title='Wanted', description='d', subject=self.subject,
+                                             requested_by=self.user)
+        self.assertEqual((stats.for_user(self.user.pk).requests, stats.site().open_requests), (1, 1))
+        request.status = 'fulfilled'
+        request.save()
+        self.assertEqual(stats.site().open_requests, 0)
+
+    def test_deferred_updates_are_merged(self):
+        notes = [self.note(is_approved=True) for _ in range(3)]
+        with CaptureQueriesContext(connection) as captured, stats.deferred():
+            for note in notes:
+                Bookmark.objects.create(note=note, user=self.user)
+        self.assertEqual(len([q for q in captured.captured_queries if 'UPDATE "api_userstats"' in q['sql']]), 1)
+        self.assertEqual(stats.for_user(self.user.pk).bookmarks, 3)
+
+    def test_missing_rows_are_recounted(self):
+        self.note(is_approved=True)
+        UserStats.objects.filter(pk=self.user.pk).delete()
+        SiteStats.objects.all().delete()
+        self.assertEqual(self.counts(), (1, 1, 1))
+
+    def test_a_concurrent_recount_leaves_the_transaction_usable(self):
+        UserStats.objects.filter(pk=self.user.pk).delete()
+
+        def recount():
+            counts = stats.recount_user(self.user.pk)
+            UserStats.objects.create(user=self.user, **counts)  # Another request created the row meanwhile
+            return counts
+
+        with transaction.atomic():
+            self.assertEqual(stats.get_or_recount(UserStats, self.user.pk, recount).pk, self.user.pk)
+            self.assertEqual(stats.for_user(self.user.pk).uploads, 0)
+
+    def test_reconcile_finds_and_fixes_drift(self):
+        self.note(is_approved=True)
+        UserStats.objects.filter(pk=self.user.pk).update(uploads=5)
+        Subject.objects.filter(pk=self.subject.pk).update(notes_count=0)
+
+        out = StringIO()
+        call_command('reconcile_stats', dry_run=True, stdout=out)
+        self.assertIn(f'User {self.user.pk}: uploads off by +4', out.getvalue())
+        self.assertIn(f'Subject {self.subject.pk}: notes_count off by -1', out.getvalue())
+        self.assertEqual(self.counts(), (5, 1, 0))
+
+        call_command('reconcile_stats', stdout=StringIO())
+        self.assertEqual(self.counts(), (1, 1, 1))
+
+
+class UnreadCountTests(TestCase):
+    """The unread badge reads the user's counter, which follows creates, reads and deletes of notifications"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.other = User.objects.create_user(email='other@example.com', password='pw12345678!', full_name='Other')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def notify(self, user=None, is_read=False):
+        return Notification.objects.create(user=user or self.user, title='Hi', message='m', is_read=is_read)
+
+    def unread_count(self):
+        response = self.client.get('/api/notifications/unread_count/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['unread_count']
+
+    def test_counter_follows_notifications(self):
+        first, second, _ = self.notify(), self.notify(), self.notify()
+        self.notify(is_read=True)
+        self.notify(user=self.other)
+        self.assertEqual(self.unread_count(), 3)
+
+        response = self.client.patch(f'/api/notifications/{first.pk}/', {'is_read': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.unread_count(), 2)
+        self.client.patch(f'/api/notifications/{first.pk}/', {'is_read': False}, format='json')
+        self.assertEqual(self.unread_count(), 3)
+
+        self.assertEqual(self.client.delete(f'/api/notifications/{second.pk}/').status_code, 204)
+        self.assertEqual(self.unread_count(), 2)
+        self.assertEqual(self.client.post('/api/notifications/mark_all_read/').status_code, 200)
+        self.assertEqual(self.unread_count(), 0)
+        self.assertEqual(stats.for_user(self.other.pk).unread_notifications, 1)
+
+    def test_count_does_not_read_notifications(self):
+        self.notify()
+        self.unread_count()  # Authenticates and creates the stats row
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.unread_count(), 1)
+        self.assertFalse([query for query in captured.captured_queries if 'api_notification' in query['sql']])
+
+    def test_missing_counter_is_recounted_and_anonymous_users_are_refused(self):
+        self.notify()
+        self.notify(is_read=True)
+        UserStats.objects.filter(pk=self.user.pk).delete()
+        self.assertEqual(self.unread_count(), 1)
+        self.assertEqual(APIClient().get('/api/notifications/unread_count/').status_code, 401)
+
+
+class BulkBookmarkTests(TestCase):
+    """bulk_bookmark keeps the user's bookmark counter equal to a recount"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        owner = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        subject = Subject.objects.create(name='Physics')
+        cls.notes = Note.objects.bulk_create(
+            Note(title=f'Note {i}', description='d', file=f'notes/{i}.pdf', subject=subject, uploaded_by=owner,
+                 is_approved=i != 3)
+            for i in range(5)
+        )
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def bulk(self, body):
+        return self.client.post('/api/notes/bulk_bookmark/', body, format='json')
+
+    def assert_counted(self, expected):
+        self.assertEqual(Bookmark.objects.filter(user=self.user).count(), expected)
+        self.assertEqual(stats.for_user(self.user.pk).bookmarks, expected)
+        self.assertEqual(stats.recount_user(self.user.pk)['bookmarks'], expected)
+
+    def test_add_counts_each_new_bookmark_once(self):
+        ids = [note.pk for note in self.notes]
+        response = self.bulk({'add': ids[:3]})
+        self.assertEqual(response.status_code, 200)
+        self.assert_counted(3)
+
+        # Already bookmarked, unapproved and unknown ids are not counted again
+        response = self.bulk({'add': ids + [0]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][-1], {'id': 0, 'error': 'Note not found'})
+        self.assert_counted(4)
+
+    def test_rows_inserted_by_another_request_are_not_counted_again(self):
+        ids = [note.pk for note in self.notes]
+        bulk_create = Bookmark.objects.bulk_create
+
+        def racing_bulk_create(objs, **kwargs):
+            Bookmark.objects.create(note_id=ids[0], user=self.user)  # Counted by its signal
+            return bulk_create(objs, **kwargs)
+
+        with mock.patch.object(Bookmark.objects, 'bulk_create', racing_bulk_create):
+            self.bulk({'add': ids[:2]})
+        self.assert_counted(2)
+
+    def test_remove_and_toggle(self):
+        ids = [note.pk for note in self.notes]
+        self.bulk({'add': ids[:2]})
+        self.client.post(f'/api/notes/{ids[2]}/bookmark/')
+        self.assert_counted(3)
+        self.client.post(f'/api/notes/{ids[2]}/bookmark/')
+        self.assert_counted(2)
+        self.bulk({'remove': ids})
+        self.assert_counted(0)
+
+    def test_rejects_bodies_that_are_not_objects(self):
+        self.assertEqual(self.bulk([self.notes[0].pk]).status_code, 400)
+        self.assertEqual(self.bulk({'add': 'all'}).status_code, 400)
+        response = self.client.post('/api/notifications/mark_read/', [1], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assert_counted(0)
+
+
+class ReplicaRouterTests(TestCase):
+    """List and detail reads go to a replica, except for a user who wrote in the last REPLICA_PIN_SECONDS"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.other = User.objects.create_user(email='other@example.com', password='pw12345678!', full_name='Other')
+        subject = Subject.objects.create(name='Physics')
+        cls.note = Note.objects.create(title='Notes', description='d', file='notes/a.pdf', subject=subject,
+                                       uploaded_by=cls.other, is_approved=True)
+        cls.token = Token.objects.create(user=cls.user)
+        cls.other_token = Token.objects.create(user=cls.other)
+
+    def setUp(self):
+        caches[replicas.PIN_CACHE].clear()
+        replicas_override = mock.patch.object(replicas, 'REPLICAS', ['replica1'])
+        replicas_override.start()
+        self.addCleanup(replicas_override.stop)
+        # Records where reads would go, then runs them on the test database as there is no replica
+        self.read_aliases = []
+        db_for_read = replicas.ReplicaRouter.db_for_read
+
+        def recording_db_for_read(router, model, **hints):
+            self.read_aliases.append(db_for_read(router, model, **hints))
+
+        router_override = mock.patch.object(replicas.ReplicaRouter, 'db_for_read', recording_db_for_read)
+        router_override.start()
+        self.addCleanup(router_override.stop)
+
+    def client_for(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        return client
+
+    def reads_of(self, client, url):
+        self.read_aliases.clear()
+        self.assertEqual(client.get(url).status_code, 200)
+        return set(self.read_aliases)
+
+    def test_list_and_detail_read_from_a_replica(self):
+        client = self.client_for(self.token)
+        self.assertIn('replica1', self.reads_of(client, '/api/notes/'))
+        self.assertIn('replica1', self.reads_of(client, f'/api/notes/{self.note.pk}/'))
+        # Other views and actions keep reading from the primary
+        self.assertEqual(self.reads_of(client, '/api/dashboard/'), {None})
+
+        router = replicas.ReplicaRouter()
+        self.assertEqual(router.db_for_write(Note), 'default')
+        self.assertFalse(router.allow_migrate('replica1', 'api'))
+        self.assertTrue(router.allow_migrate('default', 'api'))
+
+    def test_a_write_pins_only_its_user_to_the_primary(self):
+        client = self.client_for(self.token)
+        self.assertEqual(client.post(f'/api/notes/{self.note.pk}/bookmark/').status_code, 200)
+        self.assertTrue(replicas.is_pinned(self.user))
+        self.assertEqual(self.reads_of(client, '/api/notes/'), {None})
+        self.assertEqual(self.reads_of(client, f'/api/notes/{self.note.pk}/'), {None})
+        self.assertIn('replica1', self.reads_of(self.client_for(self.other_token), '/api/notes/'))
+
+        caches[replicas.PIN_CACHE].delete(replicas.pin_key(self.user.pk))  # As after REPLICA_PIN_SECONDS
+        self.assertIn('replica1', self.reads_of(client, '/api/notes/'))
+
+    def test_failed_writes_do_not_pin(self):
+        client = self.client_for(self.token)
+        self.assertEqual(client.post('/api/notes/0/bookmark/').status_code, 404)
+        self.assertFalse(replicas.is_pinned(self.user))
+        self.assertIn('replica1', self.reads_of(client, '/api/notes/'))
+
+    def test_no_replicas_configured_pins_nobody(self):
+        with mock.patch.object(replicas, 'REPLICAS', []):
+            client = self.client_for(self.token)
+            client.post(f'/api/notes/{self.note.pk}/bookmark/')
+            self.assertFalse(replicas.is_pinned(self.user))
+            self.assertEqual(self.reads_of(client, '/api/notes/'), {None})
+
+
+class BatchEndpointTests(TestCase):
+    """notes/batch and notifications/mark_read answer for every id with a fixed number of queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.other = User.objects.create_user(email='other@example.com', password='pw12345678!', full_name='Other')
+        subject = Subject.objects.create(name='Physics')
+        cls.notes = [
+            Note.objects.create(title=f'Note {i}', description='d', file=f'notes/{i}.pdf', subject=subject,
+                                uploaded_by=cls.other, is_approved=i != 3)
+            for i in range(6)
+        ]
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def notify(self, user=None, is_read=False):
+        return Notification.objects.create(user=user or self.user, title='Hi', message='m', is_read=is_read)
+
+    def mark_read(self, ids):
+        return self.client.post('/api/notifications/mark_read/', {'ids': ids}, format='json')
+
+    def query_count(self, request):
+        request()  # Authenticates and creates the stats rows, so both counted calls start alike
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(request().status_code, 200)
+        return len(captured.captured_queries)
+
+    def test_batch_keeps_the_order_asked_for(self):
+        first, _, third, unapproved = self.notes[:4]
+        response = self.client.get(f'/api/notes/batch/?ids={third.pk},0,{first.pk},{unapproved.pk},{third.pk}')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([item['id'] for item in body['results']], [third.pk, first.pk])
+        self.assertEqual(body['missing'], [0, unapproved.pk])
+        self.assertEqual(self.client.get('/api/notes/batch/').json(), {'results': [], 'missing': []})
+
+    def test_batch_query_count_does_not_grow_with_ids(self):
+        ids = [note.pk for note in self.notes]
+        few = self.query_count(lambda: self.client.get(f'/api/notes/batch/?ids={ids[0]}'))
+        many = self.query_count(lambda: self.client.get(f'/api/notes/batch/?ids={",".join(map(str, ids))}'))
+        self.assertEqual(few, many)
+
+    def test_mark_read(self):
+        unread, already_read, others = self.notify(), self.notify(is_read=True), self.notify(user=self.other)
+        self.notify()
+        self.assertEqual(stats.for_user(self.user.pk).unread_notifications, 2)
+
+        response = self.mark_read([unread.pk, already_read.pk, others.pk, 0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'id': unread.pk, 'is_read': True},
+            {'id': already_read.pk, 'is_read': True},
+            {'id': others.pk, 'error': 'Notification not found'},
+            {'id': 0, 'error': 'Notification not found'},
+        ])
+        unread.refresh_from_db()
+        others.refresh_from_db()
+        self.assertEqual((unread.is_read, others.is_read), (True, False))
+        # Only the notification that was unread is taken off the counter
+        self.assertEqual(stats.for_user(self.user.pk).unread_notifications, 1)
+        self.assertEqual(stats.for_user(self.other.pk).unread_notifications, 1)
+        self.mark_read([unread.pk])
+        self.assertEqual(stats.for_user(self.user.pk).unread_notifications, 1)
+
+    def test_mark_read_query_count_does_not_grow_with_ids(self):
+        notifications = [self.notify() for _ in range(5)]
+        few = self.query_count(lambda: self.mark_read([notifications[0].pk]))
+        many = self.query_count(lambda: self.mark_read([notification.pk for notification in notifications]))
+        self.assertEqual(few, many)
+
+    def test_rejects_bad_ids(self):
+        for ids in ('x', [True], [1.5, 'a'], {'id': 1}):
+            self.assertEqual(self.mark_read(ids).status_code, 400, ids)
+        self.assertEqual(self.client.get('/api/notes/batch/?ids=1,x').status_code, 400)
+        with mock.patch.object(views, 'BATCH_MAX_IDS', 2):
+            response = self.client.get('/api/notes/batch/?ids=1,2,3')
+            self.assertEqual(response.json(), {'error': 'At most 2 ids per request'})
+            self.assertEqual(self.mark_read([1, 2, 3]).status_code, 400)
+            self.assertEqual(self.mark_read([1, 1, 2]).status_code, 200)  # Duplicates count once
+
+
+class TokenCacheTests(TestCase):
+    """Cached tokens stop working as soon as the token is deleted or the user changes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache_override = mock.patch.object(authentication, 'token_cache', authentication.LocalCache(100))
+        cache_override.start()
+        self.addCleanup(cache_override.stop)
+        authentication.metrics.reset()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def profile_status(self):
+        return self.client.get('/api/auth/profile/').status_code
+
+    def test_lookups_are_cached_without_the_password_hash(self):
+        self.assertEqual(self.profile_status(), 200)
+        self.assertEqual(self.profile_status(), 200)
+        self.assertEqual(authentication.metrics.hits, 1)
+        entry = authentication.token_cache.get(authentication.cache_key(self.token.key))
+        self.assertNotIn(self.user.password, entry[1])
+
+    def test_logout_revokes_the_cached_token(self):
+        self.assertEqual(self.profile_status(), 200)
+        self.client.post('/api/auth/logout/')
+        self.assertEqual(self.profile_status(), 401)
+
+    def test_saving_the_user_revokes_the_cached_token(self):
+        self.assertEqual(self.profile_status(), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.profile_status(), 401)
+
+    def test_change_password_checks_the_stored_hash(self):
+        self.assertEqual(self.profile_status(), 200)
+        # Changed behind the cache's back, as QuerySet.update() would
+        User.objects.filter(pk=self.user.pk).update(password=make_password('Changed!2345'))
+        response = self.client.post('/api/auth/change-password/', {
+            'old_password': 'Changed!2345', 'new_password': 'Newer!23456', 'confirm_new_password': 'Newer!23456',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(User.objects.get(pk=self.user.pk).check_password('Newer!23456'))
+
+    def test_process_local_caches_are_not_shared(self):
+        locmem = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        redis = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost'}
+        with override_settings(CACHES={'default': locmem, 'shared': redis}):
+            self.assertFalse(caching.is_shared('default'))
+            self.assertFalse(caching.is_shared('missing'))
+            self.assertTrue(caching.is_shared('shared'))
+
+
+class PasswordViewTests(TestCase):
+    """The async auth views hash on the bounded pool and answer 503 once it is full"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+
+    def login(self, email='reader@example.com', password='pw12345678!'):
+        return self.client.post('/api/auth/login/', {'email': email, 'password': password},
+                                content_type='application/json')
+
+    def test_register_and_login(self):
+        response = self.client.post('/api/auth/register/', {
+            'email': 'new@example.com', 'full_name': 'New',
+            'password': 'Secret!23456', 'password_confirm': 'Secret!23456',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        user = User.objects.get(email='new@example.com')
+        self.assertTrue(user.check_password('Secret!23456'))
+        self.assertEqual(response.json()['token'], Token.objects.get(user=user).key)
+        self.assertEqual(self.login('NEW@example.com', 'Secret!23456').status_code, 200)
+
+    def test_login_failures(self):
+        self.assertEqual(self.login(password='wrong').status_code, 401)
+        self.assertEqual(self.login(email='nobody@example.com').status_code, 401)
+        self.assertEqual(self.client.post('/api/auth/login/', '{', content_type='application/json').status_code, 400)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.login().status_code, 403)
+
+    def test_login_upgrades_outdated_hashes(self):
+        User.objects.filter(pk=self.user.pk).update(password=make_password('pw12345678!', hasher='scrypt'))
+        self.assertEqual(self.login().status_code, 200)
+        password = User.objects.get(pk=self.user.pk).password
+        self.assertTrue(password.startswith('pbkdf2_sha256$'), password)
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_change_password(self):
+        token = Token.objects.create(user=self.user)
+        url = '/api/auth/change-password/'
+        body = {'old_password': 'wrong', 'new_password': 'Newer!23456', 'confirm_new_password': 'Newer!23456'}
+        self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 401)
+        response = self.client.post(url, body, content_type='application/json', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 400)
+        body['old_password'] = 'pw12345678!'
+        response = self.client.post(url, body, content_type='application/json', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.login(password='Newer!23456').status_code, 200)
+
+    def test_full_pool_answers_503(self):
+        with mock.patch.object(passwords, '_slots', threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()  # Taken by a hash in progress
+            response = self.login()
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], str(passwords.RETRY_AFTER))
+            slots.release()
+            self.assertEqual(self.login().status_code, 200)
+            # The slot is given back once the hash is done
+            self.assertTrue(slots.acquire(blocking=False))
+
+
+class KeysetPaginationTests(TestCase):
+    """Cursor pages cover every row once, also across rows created at the same instant"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        subject = Subject.objects.create(name='Physics')
+        notes = Note.objects.bulk_create(
+            Note(title=f'Note {i}', description='d', file=f'notes/{i}.pdf', subject=subject, uploaded_by=cls.user,
+                 is_approved=True)
+            for i in range(25)
+        )
+        # Three rows per timestamp, set afterwards since auto_now_add overrides it on insert
+        now = timezone.now()
+        for i, note in enumerate(notes):
+            Note.objects.filter(pk=note.pk).update(created_at=now - timedelta(minutes=i // 3))
+        cls.notes = list(Note.objects.filter(pk__in=[note.pk for note in notes]))
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [item['id'] for item in response.json()['results']]
+            url = response.json()['next']
+        return ids
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        ids = self.walk('/api/notes/?page_size=4')
+        expected = sorted(self.notes, key=lambda note: (note.created_at, note.pk), reverse=True)
+        self.assertEqual(ids, [note.pk for note in expected])
+
+    def test_rows_created_while_paging_do_not_shift_the_next_page(self):
+        first = self.client.get('/api/notes/?page_size=10').json()
+        Note.objects.create(title='New', description='d', file='notes/new.pdf', subject=self.notes[0].subject,
+                            uploaded_by=self.user, is_approved=True)
+        ids = [item['id'] for item in first['results']] + self.walk(first['next'])
+        self.assertEqual(sorted(ids), sorted(note.pk for note in self.notes))
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/notes/?cursor=bm90LWpzb24').status_code, 404)
+
+
+@mock.patch.object(threads, 'REPLIES_PER_PARENT', 2)
+class CommentThreadTests(TestCase):
+    """Replies load level by level under the requested comments, a few per parent, with a token for the rest"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        note = Note.objects.create(title='Notes', description='d', file='notes/a.pdf', uploaded_by=cls.user,
+                                   subject=Subject.objects.create(name='Physics'), is_approved=True)
+
+        def reply(parent, text):
+            return Comment.objects.create(content_type='note', note=note, user=cls.user, text=text, parent=parent)
+
+        cls.root = reply(None, 'Question')
+        cls.replies = [reply(cls.root, f'Reply {i}') for i in range(5)]
+        cls.nested = reply(cls.replies[0], 'Nested')
+        cls.deep = reply(cls.nested, 'Deep')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_replies_are_capped_per_parent(self):
+        [root] = threads.attach_replies([Comment.objects.get(pk=self.root.pk)], 2)
+        self.assertEqual([reply.pk for reply in root.loaded_replies], [reply.pk for reply in self.replies[:2]])
+        self.assertEqual(root.loaded_replies[0].loaded_replies[0].pk, self.nested.pk)
+        # Below the depth limit, only a token
+        self.assertEqual(root.loaded_replies[0].loaded_replies[0].loaded_replies, [])
+        self.assertIsNotNone(root.loaded_replies[0].loaded_replies[0].more_replies)
+        self.assertIsNone(root.loaded_replies[1].more_replies)
+
+        ids = []
+        url = f'/api/comments/more-replies/?token={root.more_replies}&depth=1&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [item['id'] for item in response.json()['results']]
+            url = response.json()['next']
+        self.assertEqual(ids, [reply.pk for reply in self.replies[2:]])
+
+    def test_only_descendants_of_the_requested_comments_are_read(self):
+        with CaptureQueriesContext(connection) as captured:
+            [reply] = threads.attach_replies([Comment.objects.get(pk=self.replies[1].pk)], 3)
+        self.assertEqual(reply.loaded_replies, [])
+        self.assertIsNone(reply.more_replies)
+        # The first level is empty, so nothing else is read: not the rest of the thread under the sibling
+        [_, level] = captured.captured_queries
+        self.assertIn(f'"parent_id" IN ({self.replies[1].pk})', level['sql'])
+
+    def test_invalid_token(self):
+        response = self.client.get('/api/comments/more-replies/?token=forged')
+        self.assertEqual(response.status_code, 400)
+
+
+class BenchmarkSQLiteTests(TransactionTestCase):
+    """benchmark_sqlite measures each mode on a scratch database and leaves the real one alone"""
+
+    def test_runs_on_scratch_copies(self):
+        User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as scratch:
+            # As if run on a database file, the in-memory test database stays open aside
+            name = os.path.join(scratch, 'db.sqlite3')
+            with mock.patch.dict(connection.settings_dict, NAME=name), \
+                    mock.patch.object(connection, 'connection', None):
+                call_command('benchmark_sqlite', readers=1, writers=1, seconds=0.2, notes=20, stdout=out)
+                self.assertEqual(connection.settings_dict['NAME'], name)
+                self.assertFalse(os.path.exists(name))
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '1 readers, 1 writers, 0.2s per mode')
+        self.assertEqual([line.split()[0] for line in lines[2:]], ['default', 'tuned'])
+        for line in lines[2:]:
+            reads, writes = line.split()[1:3]
+            self.assertGreater(int(reads), 0, line)
+            self.assertGreater(int(writes), 0, line)
+        self.assertEqual(list(User.objects.values_list('email', flat=True)), ['reader@example.com'])
+        self.assertFalse(Note.objects.exists())
+
+    def test_needs_a_sqlite_file(self):
+        with self.assertRaisesMessage(CommandError, 'not an in-memory database'):
+            call_command('benchmark_sqlite', stdout=StringIO())
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            with self.assertRaisesMessage(CommandError, 'needs the SQLite database backend'):
+                call_command('benchmark_sqlite', stdout=StringIO())
+
+
+class JobQueueTests(TransactionTestCase):
+    """Jobs commit with the change that queued them, and a handler's writes commit once, with its deletion"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password='pw12345678!', full_name='Reader')
+
+    def claim(self):
+        return jobs.claim('test', 10, 300)
+
+    def test_job_is_rolled_back_with_its_transaction(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            tasks.notify(self.user, 'Hi', 'm')
+            raise RuntimeError
+        self.assertFalse(Job.objects.exists())
+
+    def test_run_creates_the_notification_and_deletes_the_job(self):
+        tasks.notify(self.user, 'Hi', 'm')
+        [job] = self.claim()
+        self.assertEqual(self.claim(), [])  # Leased
+        jobs.run(job)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_worker_that_lost_its_lease_rolls_back(self):
+        tasks.notify(self.user, 'Hi', 'm')
+        [job] = self.claim()
+        Job.objects.filter(pk=job.pk).update(locked_by='another worker')
+        with self.assertLogs('api.jobs', 'WARNING'):
+            jobs.run(job)
+        self.assertFalse(Notification.objects.exists())
+        self.assertTrue(Job.objects.filter(pk=job.pk).exists())
+
+    def test_failures_are_retried_then_given_up(self):
+        failures = []
+        handler = mock.Mock(side_effect=RuntimeError('down'))
+        with mock.patch.dict(jobs.HANDLERS, {'test.fail': handler}), \
+                mock.patch.dict(jobs.FAILURE_HANDLERS, {'test.fail': lambda **payload: failures.append(payload)}):
+            jobs.enqueue('test.fail', {'n': 1}, max_attempts=2)
+            [job] = self.claim()
+            with self.assertLogs('api.jobs', 'WARNING'):
+                jobs.run(job)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, failures), ('queued', 1, []))
+            self.assertGreater(job.run_at, timezone.now())
+
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+            [job] = self.claim()
+            with self.assertLogs('api.jobs', 'ERROR'):
+                jobs.run(job)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, failures), ('failed', 2, [{'n': 1}]))
+
+
+@mock.patch.object(thumbnails, 'WORKERS', 1)
+class ChunkedUploadTests(TransactionTestCase):
+    """Uploads resume from the chunks that are missing, and finalizing assembles the note in a job"""
+
+    def setUp(self):
+        media, sessions = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.addCleanup(sessions.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        sessions_override = mock.patch.object(uploads, 'UPLOAD_SESSION_DIR', Path(sessions.name))
+        sessions_override.start()
+        self.addCleanup(sessions_override.stop)
+
+        self.user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+        self.chunk_size = 256 * 1024
+        self.data = os.urandom(self.chunk_size * 2 + 100)
+
+    def start(self, checksum=None):
+        response = self.client.post('/api/uploads/', {
+            'filename': 'notes.pdf', 'size': len(self.data), 'chunk_size': self.chunk_size,
+            'checksum': checksum or hashlib.sha256(self.data).hexdigest(), 'title': 'Notes', 'description': 'd',
+            'subject_name': 'Physics',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put_chunk(self, session, index, data=None, checksum=None):
+        data = self.data[index * self.chunk_size:(index + 1) * self.chunk_size] if data is None else data
+        return self.client.put(f'/api/uploads/{session["id"]}/chunks/{index}/', data,
+                               content_type='application/octet-stream',
+                               HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(data).hexdigest())
+
+    def finalize(self, session):
+        return self.client.post(f'/api/uploads/{session["id"]}/finalize/')
+
+    def assemble(self):
+        [job] = [job for job in jobs.claim('test', 10, 300) if job.name == 'uploads.assemble']
+        jobs.run(job)
+
+    def test_resume_and_finalize(self):
+        session = self.start()
+        self.assertEqual((session['total_chunks'], session['missing_chunks']), (3, [0, 1, 2]))
+        self.assertEqual(self.put_chunk(session, 0).json(), {'index': 0, 'missing_chunks': [1, 2]})
+        self.assertEqual(self.put_chunk(session, 2).status_code, 200)
+
+        # Resuming: the session lists what is left to send
+        self.assertEqual(self.client.get(f'/api/uploads/{session["id"]}/').json()['missing_chunks'], [1])
+        response = self.finalize(session)
+        self.assertEqual((response.status_code, response.json()['missing_chunks']), (400, [1]))
+        self.put_chunk(session, 1)
+
+        response = self.finalize(session)
+        self.assertEqual((response.status_code, response.json()['status']), (202, 'assembling'))
+        self.assertEqual(self.finalize(session).status_code, 409)
+        self.assertEqual(self.put_chunk(session, 0).status_code, 409)
+
+        self.assemble()
+        upload = UploadSession.objects.get(pk=session['id'])
+        self.assertEqual(upload.status, 'complete')
+        with upload.note.file.open('rb') as file:
+            self.assertEqual(file.read(), self.data)
+        self.assertEqual((upload.note.uploaded_by, upload.note.subject.name), (self.user, 'Physics'))
+        self.assertFalse(uploads.session_dir(upload).exists())
+
+    def test_bad_chunks_are_not_kept(self):
+        session = self.start()
+        self.assertEqual(self.put_chunk(session, 0, checksum='0' * 64).status_code, 400)
+        self.assertEqual(self.put_chunk(session, 0, data=b'short').status_code, 400)
+        self.assertEqual(self.put_chunk(session, 3, data=b'x').status_code, 400)
+        response = self.client.put(f'/api/uploads/{session["id"]}/chunks/0/', b'x',
+                                   content_type='application/octet-stream')
+        self.assertEqual(response.json(), {'error': 'X-Chunk-SHA256 header is required'})
+        self.assertEqual(uploads.missing_chunks(UploadSession.objects.get(pk=session['id'])), [0, 1, 2])
+        self.assertEqual(list(uploads.session_dir(UploadSession(pk=session['id'])).iterdir()), [])
+
+    def test_file_checksum_mismatch_fails_the_session(self):
+        session = self.start(checksum='0' * 64)
+        for index in range(3):
+            self.put_chunk(session, index)
+        self.assertEqual(self.finalize(session).status_code, 202)
+
+        self.assemble()
+        upload = UploadSession.objects.get(pk=session['id'])
+        self.assertEqual((upload.status, upload.error, upload.note), ('failed', 'File checksum mismatch', None))
+        self.assertFalse(Note.objects.exists())
+        self.assertFalse(uploads.session_dir(upload).exists())
+
+    def test_sessions_are_private(self):
+        session = self.start()
+        other = User.objects.create_user(email='other@example.com', password='pw12345678!', full_name='Other')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=other).key)
+        self.assertEqual(self.client.get(f'/api/uploads/{session["id"]}/').status_code, 404)
+        self.assertEqual(self.put_chunk(session, 0).status_code, 404)
+
+
+class ThumbnailJobTests(TransactionTestCase):
+    """Thumbnails are rendered by a job queued with the note, and a note whose job gave up is not left pending"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        user = User.objects.create_user(email='owner@example.com', password='pw12345678!', full_name='Owner')
+        subject = Subject.objects.create(name='Physics')
+        self.note = Note.objects.create(title='Notes', description='d', subject=subject, uploaded_by=user,
+                                        file=SimpleUploadedFile('notes.pdf', b'%PDF-1.4'))
+
+    def run_job(self):
+        [job] = jobs.claim('test', 10, 300)
+        self.assertEqual((job.name, job.payload), ('thumbnails.generate', {'note_id': self.note.pk}))
+        jobs.run(job)
+        self.note.refresh_from_db()
+
+    def test_job_renders_the_thumbnails(self):
+        def render(source, out_dir):
+            path = os.path.join(out_dir, 'small.webp')
+            with open(path, 'wb') as image:
+                image.write(b'RIFF')
+            return {'small': path}
+
+        with mock.patch.object(thumbnails, 'render', render):
+            self.run_job()
+        self.assertEqual(self.note.thumbnail_status, 'ready')
+        self.assertEqual(self.note.thumbnails, {'small': thumbnails.thumbnail_name(self.note.pk, 'small')})
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_rendering_is_retried_then_marked_failed(self):
+        Job.objects.update(max_attempts=2)
+        with mock.patch.object(thumbnails, 'render', side_effect=RuntimeError('broken file')):
+            with self.assertLogs('api.jobs', 'WARNING'):
+                self.run_job()
+            self.assertEqual(self.note.thumbnail_status, 'pending')
+
+            Job.objects.update(run_at=timezone.now())
+            with self.assertLogs('api.jobs', 'ERROR'):
+                self.run_job()
+        self.assertEqual(self.note.thumbnail_status, 'failed')
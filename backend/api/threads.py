@@ -0,0 +1,117 @@
+"""
+Comment thread loading.
+
+A page of comments is fetched first, then their replies level by level down
+to the requested depth, one query per level over ``parent``, and the tree is
+assembled in memory. Each query only reads the children of the previous
+level, at most ``REPLIES_PER_PARENT`` of them per parent, so a thread's
+other branches and crowded levels are never loaded. A node with more
+replies than were loaded, or replies below the depth limit, carries a
+``more_replies`` continuation token instead. The token is signed, so clients
+can only hand back tokens the API gave out. The replies it continues are
+paginated like top-level comments, after the last one already shown.
+"""
+from django.conf import settings
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from .models import Comment
+
+DEFAULT_REPLY_DEPTH = getattr(settings, 'COMMENT_REPLY_DEPTH', 3)
+MAX_REPLY_DEPTH = getattr(settings, 'COMMENT_MAX_REPLY_DEPTH', 10)
+REPLIES_PER_PARENT = getattr(settings, 'COMMENT_REPLIES_PER_PARENT', 20)
+TOKEN_SALT = 'api.threads.more_replies'
+
+
+def get_depth(request):
+    """Reply depth requested with ``?depth=``, clamped to the allowed range"""
+    try:
+        depth = int(request.query_params.get('depth', DEFAULT_REPLY_DEPTH))
+    except (TypeError, ValueError):
+        return DEFAULT_REPLY_DEPTH
+    return max(0, min(depth, MAX_REPLY_DEPTH))
+
+
+def encode_token(comment, after=None):
+    """Token continuing the replies of ``comment``, after the reply ``after`` if given"""
+    data = {'parent': comment.pk}
+    if after is not None:
+        data['after'] = [after.created_at.isoformat(), after.pk]
+    return signing.dumps(data, salt=TOKEN_SALT)
+
+
+def decode_token(token):
+    """Return (comment id, (created_at, id) of the last reply shown or None) from a token, or None"""
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT)
+        after = data.get('after')
+        if after is not None:
+            after = (datetime.fromisoformat(after[0]), int(after[1]))
+        return int(data['parent']), after
+    except (signing.BadSignature, ValueError, KeyError, TypeError, IndexError, AttributeError):
+        return None
+
+
+def later_replies(parent_id, after=None):
+    """Replies of ``parent_id``, only those after the ``after`` position of a token"""
+    replies = Comment.objects.filter(parent_id=parent_id)
+    if after is not None:
+        created_at, pk = after
+        replies = replies.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk))
+    return replies
+
+
+def children(parent_ids):
+    """The first REPLIES_PER_PARENT + 1 replies of each parent, the extra one tells that there are more"""
+    position = Window(RowNumber(), partition_by=F('parent_id'), order_by=[F('created_at').asc(), F('id').asc()])
+    replies = (Comment.objects.filter(parent_id__in=parent_ids).annotate(position=position)
+               .filter(position__lte=REPLIES_PER_PARENT + 1).select_related('user').order_by())
+    # Siblings oldest first. Sorted here rather than in SQL, over a few rows per parent
+    return sorted(replies, key=lambda reply: (reply.created_at, reply.pk))
+
+
+def attach_replies(comments, depth):
+    """
+    Load the replies of ``comments`` up to ``depth`` levels below each of them.
+
+    Every node gets a ``loaded_replies`` list and a ``more_replies`` token,
+    which is only set when the node has replies that were not loaded.
+    """
+    comments = list(comments)
+    if not comments:
+        return comments
+
+    nodes = {}
+    for comment in comments:
+        comment.loaded_replies = []
+        comment.more_replies = None
+        nodes[comment.pk] = comment
+
+    level = list(nodes)
+    for _ in range(depth):
+        if not level:
+            break
+        next_level = []
+        for reply in children(level):
+            parent = nodes[reply.parent_id]
+            if len(parent.loaded_replies) == REPLIES_PER_PARENT:
+                parent.more_replies = encode_token(parent, after=parent.loaded_replies[-1])
+                continue
+            if reply.pk in nodes:
+                # Also requested on its own, so it keeps the subtree it already has
+                parent.loaded_replies.append(nodes[reply.pk])
+                continue
+            reply.loaded_replies = []
+            reply.more_replies = None
+            parent.loaded_replies.append(reply)
+            nodes[reply.pk] = reply
+            next_level.append(reply.pk)
+        level = next_level
+
+    # Below the depth limit, only whether there is anything to continue
+    if level:
+        for parent_id in Comment.objects.filter(parent_id__in=level).values_list('parent_id', flat=True).distinct():
+            nodes[parent_id].more_replies = encode_token(nodes[parent_id])
+    return comments
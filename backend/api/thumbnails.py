@@ -0,0 +1,125 @@
+"""
+Background thumbnail generation for notes.
+
+Saving a note queues a ``thumbnails.generate`` job (api/tasks.py) in the
+same transaction, so the work survives restarts and is retried like any
+other job. ``manage.py runworker`` runs it and hands the actual rasterizing
+(``api.rendering``) to a process pool, so CPU heavy PDF and image decoding
+never runs in a request worker or holds the GIL of one. Each note gets one
+WebP per ``THUMBNAIL_SIZES`` entry, rendered from the uploader's thumbnail
+if there is one and from the first page of the file otherwise.
+
+``Note.thumbnail_status`` tells clients whether thumbnails are still
+pending, and ``generate_thumbnails`` backfills existing notes.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection
+from . import jobs, rendering
+from .models import Note
+
+logger = logging.getLogger(__name__)
+
+SIZES = getattr(settings, 'THUMBNAIL_SIZES', {'small': 160, 'medium': 320, 'large': 640})
+WORKERS = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def process_pool():
+    """The rendering pool, created on first use and again after a fork"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn, not fork: runworker has threads running that a fork would copy mid-flight
+            _pool = ProcessPoolExecutor(max_workers=max(WORKERS, 1), mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def reset_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+
+
+def schedule(note):
+    """Queue thumbnail generation for ``note``, committed with the current transaction"""
+    if WORKERS:
+        jobs.enqueue('thumbnails.generate', {'note_id': note.pk})
+
+
+def thumbnail_name(note_id, size):
+    return f'thumbnails/{note_id}/{size}.webp'
+
+
+def render(field_file, out_dir):
+    try:
+        path = field_file.path
+    except NotImplementedError:
+        # Remote storage: the worker process needs a local copy to read
+        path = os.path.join(out_dir, 'source')
+        with field_file.open('rb') as source, open(path, 'wb') as copy:
+            shutil.copyfileobj(source, copy)
+    pool = process_pool()
+    try:
+        return pool.submit(rendering.render, path, field_file.name, out_dir, SIZES).result()
+    except BrokenProcessPool:
+        reset_pool(pool)
+        raise
+
+
+def generate(note_id):
+    """
+    Render and store every size for one note, recording the outcome in
+    thumbnail_status. Rendering errors are raised for the job to be retried.
+    """
+    try:
+        note = Note.objects.only('id', 'file', 'thumbnail').get(pk=note_id)
+    except Note.DoesNotExist:
+        return None
+    source = note.thumbnail or note.file
+    try:
+        with tempfile.TemporaryDirectory(prefix='thumbnails-') as out_dir:
+            rendered = render(source, out_dir)
+            names = {}
+            for size, path in rendered.items():
+                name = thumbnail_name(note.pk, size)
+                default_storage.delete(name)
+                with open(path, 'rb') as image:
+                    names[size] = default_storage.save(name, File(image))
+    except rendering.UnsupportedFile as exc:
+        logger.info('No thumbnail for note %s: %s', note_id, exc)
+        Note.objects.filter(pk=note_id).update(thumbnail_status='unsupported')
+        return 'unsupported'
+    Note.objects.filter(pk=note_id).update(thumbnails=names, thumbnail_status='ready')
+    return 'ready'
+
+
+def give_up(note_id):
+    """The job ran out of attempts, stop reporting the thumbnails as pending"""
+    Note.objects.filter(pk=note_id, thumbnail_status='pending').update(thumbnail_status='failed')
+
+
+def generate_now(note_id):
+    """``generate`` outside the job queue, for generate_thumbnails: a failure is recorded, not raised"""
+    try:
+        return generate(note_id)
+    except Exception:
+        logger.exception('Rendering thumbnails for note %s failed', note_id)
+        Note.objects.filter(pk=note_id).update(thumbnail_status='failed')
+        return 'failed'
+    finally:
+        connection.close()
@@ -0,0 +1,170 @@
+"""
+Resumable chunked uploads.
+
+Each chunk is streamed from the request straight to its own file under
+``UPLOAD_SESSION_DIR/<session id>/``, hashed on the way, and only renamed
+into place once its SHA-256 matches, so a chunk file on disk is always
+complete and the missing chunks are simply the absent files.
+
+Finalizing queues an ``uploads.assemble`` job (api/jobs.py) in the same
+transaction that marks the session ``assembling``. The job concatenates and
+verifies the chunks and moves the result into storage as a new ``Note``. The
+note and the ``complete`` status commit together with the job's deletion. A
+crash or error leaves the job to be retried with the chunks in place. The
+chunks are deleted only once the session is complete, or has failed for good:
+the file does not match its checksum, or the job ran out of attempts.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from . import jobs
+from .models import Note, UploadSession
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SESSION_DIR = Path(getattr(settings, 'UPLOAD_SESSION_DIR', settings.BASE_DIR / 'upload_sessions'))
+READ_SIZE = 64 * 1024
+
+
+class ChunkError(Exception):
+    pass
+
+
+class AssembledFile(File):
+    """Lets the storage move the assembled file into place instead of copying it"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def session_dir(session):
+    return UPLOAD_SESSION_DIR / str(session.pk)
+
+
+def chunk_path(session, index):
+    return session_dir(session) / f'{index:06d}.part'
+
+
+def expected_length(session, index):
+    if index == session.total_chunks - 1:
+        return session.size - session.chunk_size * index
+    return session.chunk_size
+
+
+def write_chunk(session, index, stream, length, checksum):
+    """Stream one chunk to disk, keeping it only if its length and SHA-256 match"""
+    if not 0 <= index < session.total_chunks:
+        raise ChunkError(f'Chunk index must be between 0 and {session.total_chunks - 1}')
+    if length != expected_length(session, index):
+        raise ChunkError(f'Chunk {index} must be {expected_length(session, index)} bytes')
+
+    directory = session_dir(session)
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / f'{index:06d}.{uuid.uuid4().hex}.tmp'
+    digest = hashlib.sha256()
+    received = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while received < length:
+                data = stream.read(min(READ_SIZE, length - received))
+                if not data:
+                    break
+                digest.update(data)
+                out.write(data)
+                received += len(data)
+        if received != length:
+            raise ChunkError(f'Chunk {index} ended after {received} of {length} bytes')
+        if digest.hexdigest() != checksum.lower():
+            raise ChunkError(f'Chunk {index} checksum mismatch')
+        os.replace(tmp_path, chunk_path(session, index))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def missing_chunks(session):
+    if session.status != 'pending':
+        return []
+    directory = session_dir(session)
+    present = {path.name for path in directory.glob('*.part')} if directory.is_dir() else set()
+    return [index for index in range(session.total_chunks) if chunk_path(session, index).name not in present]
+
+
+@transaction.atomic
+def finalize(session):
+    """Queue assembly, returns False if the session was not waiting for it"""
+    claimed = UploadSession.objects.filter(pk=session.pk, status='pending').update(status='assembling')
+    if not claimed:
+        return False
+    session.status = 'assembling'
+    jobs.enqueue('uploads.assemble', {'session_id': str(session.pk)})
+    return True
+
+
+def assemble(session_id):
+    """Turn an ``assembling`` session into its note, run as a job inside the job's transaction"""
+    session = (UploadSession.objects.select_for_update().select_related('subject', 'user')
+               .filter(pk=session_id, status='assembling').first())
+    if session is None:
+        return  # Deleted meanwhile, or assembled by an earlier run
+    directory = session_dir(session)
+    assembled_path = directory / f'assembled.{uuid.uuid4().hex}'
+    try:
+        digest = hashlib.sha256()
+        with open(assembled_path, 'wb') as out:
+            for index in range(session.total_chunks):
+                with open(chunk_path(session, index), 'rb') as chunk:
+                    while data := chunk.read(READ_SIZE):
+                        digest.update(data)
+                        out.write(data)
+        if session.checksum and digest.hexdigest() != session.checksum.lower():
+            fail(session, 'File checksum mismatch')
+            return
+
+        note = Note(
+            title=session.title,
+            description=session.description,
+            tags=session.tags,
+            subject=session.subject,
+            uploaded_by=session.user,
+        )
+        with open(assembled_path, 'rb') as assembled:
+            content = AssembledFile(assembled)
+            content.sha256 = digest.hexdigest()  # Already hashed, storage skips its own pass
+            note.file.save(session.filename, content, save=False)
+        note.save()
+
+        session.note = note
+        session.status = 'complete'
+        session.save(update_fields=['note', 'status', 'updated_at'])
+        transaction.on_commit(lambda: discard(session))
+    finally:
+        # The storage moved it into place, or the attempt failed and the next one writes its own
+        if assembled_path.exists():
+            assembled_path.unlink()
+
+
+def fail(session, error):
+    session.status = 'failed'
+    session.error = error
+    session.save(update_fields=['status', 'error', 'updated_at'])
+    transaction.on_commit(lambda: discard(session))
+
+
+def give_up(session_id):
+    """The assembly job ran out of attempts"""
+    session = UploadSession.objects.filter(pk=session_id, status='assembling').first()
+    if session is not None:
+        logger.error('Assembling upload session %s failed for good', session_id)
+        fail(session, 'Assembling the upload failed')
+
+
+def discard(session):
+    shutil.rmtree(session_dir(session), ignore_errors=True)
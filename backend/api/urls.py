@@ -5,6 +5,7 @@ from . import views
 router = DefaultRouter()
 router.register(r'subjects', views.SubjectViewSet)
 router.register(r'notes', views.NoteViewSet)
+router.register(r'uploads', views.UploadSessionViewSet, basename='upload')
 router.register(r'requests', views.NoteRequestViewSet)
 router.register(r'comments', views.CommentViewSet)
 router.register(r'notifications', views.NotificationViewSet, basename='notification')
@@ -16,11 +17,14 @@ urlpatterns = [
     path('auth/logout/', views.logout, name='logout'),
     path('auth/profile/', views.profile, name='profile'),
     path('auth/change-password/', views.change_password, name='change-password'),
+    path('auth/cache-stats/', views.auth_cache_stats, name='auth-cache-stats'),
     
     # User specific routes
     path('my/bookmarks/', views.my_bookmarks, name='my-bookmarks'),
     path('my/downloads/', views.my_downloads, name='my-downloads'),
     path('dashboard/', views.dashboard_stats, name='dashboard'),
+    path('tags/', views.tag_list, name='tags'),
+    path('notifications/stream/', views.notification_stream, name='notification-stream'),
     
     # Router URLs
     path('', include(router.urls)),
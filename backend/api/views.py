@@ -1,63 +1,130 @@
-from rest_framework import viewsets, status, generics
+import json
+
+from rest_framework import exceptions, viewsets, status, generics, mixins
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-from .models import Subject, Note, NoteRequest, Comment, Download, Bookmark, Notification
+from django.db import transaction
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from .models import Subject, Note, NoteRequest, Comment, Download, Bookmark, Notification, UploadSession
+from . import authentication, catalog, compact, counters, events, files, passwords, queries, search, stats, tags, tasks, threads, thumbnails, uploads
+from .pagination import KeysetPagination, CommentPagination
+from .replicas import ReplicaReadMixin
 from .serializers import (
     UserSerializer, UserRegisterSerializer, UserLoginSerializer, ChangePasswordSerializer,
     SubjectSerializer, NoteListSerializer, NoteDetailSerializer, NoteCreateSerializer,
     NoteRequestListSerializer, NoteRequestCreateSerializer,
     CommentSerializer, CommentCreateSerializer,
-    BookmarkSerializer, DownloadSerializer, NotificationSerializer
+    BookmarkSerializer, DownloadSerializer, NotificationSerializer, UploadSessionSerializer
 )
 
 User = get_user_model()
 
+BATCH_MAX_IDS = getattr(settings, 'BATCH_MAX_IDS', 100)
+
 
 # ==================== AUTH VIEWS ====================
+# register, login and change_password hash passwords. They are async Django
+# views (DRF views cannot be) that await the hashing on api/passwords.py's
+# bounded pool, so a login spike does not hold up every server worker.
 
-@api_view(['POST'])
-@permission_classes([AllowAny])
-def register(request):
-    """Register a new user"""
-    serializer = UserRegisterSerializer(data=request.data)
-    if serializer.is_valid():
-        user = serializer.save()
-        token, _ = Token.objects.get_or_create(user=user)
-        return Response({
-            'message': 'Registration successful',
-            'user': UserSerializer(user).data,
-            'token': token.key
-        }, status=status.HTTP_201_CREATED)
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+def request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+    return request.POST.dict()
 
 
-@api_view(['POST'])
-@permission_classes([AllowAny])
-def login(request):
-    """Login user"""
-    serializer = UserLoginSerializer(data=request.data)
-    if serializer.is_valid():
-        email = serializer.validated_data['email'].strip()
-        password = serializer.validated_data['password']
+def busy():
+    response = JsonResponse({'error': 'Too many sign-ins at once, try again shortly'}, status=503)
+    response['Retry-After'] = str(passwords.RETRY_AFTER)
+    return response
 
-        user = User.objects.filter(email__iexact=email).first()
-        if not user or not user.check_password(password):
-            return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
-        if not user.is_active:
-            return Response({'error': 'Account is disabled'}, status=status.HTTP_403_FORBIDDEN)
+@sync_to_async
+def api_user(request):
+    """The user the API's authentication classes find, as a DRF view would; AnonymousUser for none"""
+    return Request(
+        request,
+        parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],  # The CSRF check reads the form
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    ).user
 
-        token, _ = Token.objects.get_or_create(user=user)
-        return Response({
-            'message': 'Login successful',
-            'user': UserSerializer(user).data,
-            'token': token.key
-        })
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+async def token_user(request):
+    """The active user of the request's token, which may also come as ?token= (for EventSource)"""
+    header = request.headers.get('Authorization', '')
+    key = header[6:].strip() if header.startswith('Token ') else request.GET.get('token', '')
+    token = await sync_to_async(authentication.lookup)(key) if key else None
+    if token is None or not token.user.is_active:
+        return None
+    return token.user
+
+
+@csrf_exempt
+@require_POST
+async def register(request):
+    """Register a new user"""
+    serializer = UserRegisterSerializer(data=request_data(request))
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        encoded = await passwords.make(serializer.validated_data['password'])
+    except passwords.Busy:
+        return busy()
+
+    user = await sync_to_async(serializer.save)(encoded_password=encoded)
+    token, _ = await Token.objects.aget_or_create(user=user)
+    return JsonResponse({
+        'message': 'Registration successful',
+        'user': UserSerializer(user).data,
+        'token': token.key
+    }, status=status.HTTP_201_CREATED)
+
+
+@csrf_exempt
+@require_POST
+async def login(request):
+    """Login user"""
+    serializer = UserLoginSerializer(data=request_data(request))
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    email = serializer.validated_data['email'].strip()
+    password = serializer.validated_data['password']
+
+    user = await User.objects.filter(email__iexact=email).afirst()
+    try:
+        valid, upgraded = await passwords.verify(password, user.password if user else None)
+    except passwords.Busy:
+        return busy()
+    if not valid:
+        return JsonResponse({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    if upgraded:
+        # Stored with an older algorithm or cost than PASSWORD_HASHER_PROFILE
+        user.password = upgraded
+        await user.asave(update_fields=['password'])
+
+    if not user.is_active:
+        return JsonResponse({'error': 'Account is disabled'}, status=status.HTTP_403_FORBIDDEN)
+
+    token, _ = await Token.objects.aget_or_create(user=user)
+    return JsonResponse({
+        'message': 'Login successful',
+        'user': UserSerializer(user).data,
+        'token': token.key
+    })
 
 
 @api_view(['POST'])
@@ -86,37 +153,101 @@ def profile(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def change_password(request):
+@csrf_exempt
+@require_POST
+async def change_password(request):
     """Change user password"""
-    serializer = ChangePasswordSerializer(data=request.data)
-    if serializer.is_valid():
-        user = request.user
-        if not user.check_password(serializer.validated_data['old_password']):
-            return Response({'old_password': ['Wrong password.']}, status=status.HTTP_400_BAD_REQUEST)
-        
-        user.set_password(serializer.validated_data['new_password'])
-        user.save()
-        return Response({'message': 'Password updated successfully'})
-    
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    data = request_data(request)
+    try:
+        user = await api_user(request)
+    except exceptions.APIException as exc:
+        # A bad token, or a session request without its CSRF token
+        return JsonResponse({'detail': exc.detail}, status=exc.status_code)
+    if not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+    serializer = ChangePasswordSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # The authenticated user may come from the token cache, check against the stored hash
+    user = await User.objects.aget(pk=user.pk)
+    try:
+        valid, _ = await passwords.verify(serializer.validated_data['old_password'], user.password)
+        if not valid:
+            return JsonResponse({'old_password': ['Wrong password.']}, status=status.HTTP_400_BAD_REQUEST)
+        user.password = await passwords.make(serializer.validated_data['new_password'])
+    except passwords.Busy:
+        return busy()
+    await user.asave(update_fields=['password'])
+    return JsonResponse({'message': 'Password updated successfully'})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def auth_cache_stats(request):
+    """Token cache hit ratio, counted per worker process"""
+    return Response(authentication.metrics.snapshot())
 
 # ==================== SUBJECT VIEWS ====================
 
-class SubjectViewSet(viewsets.ReadOnlyModelViewSet):
+class SubjectViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for subjects/categories"""
-    queryset = Subject.objects.all()
+    queryset = Subject.objects.order_by('id')
     serializer_class = SubjectSerializer
     permission_classes = [AllowAny]
 
+    def list(self, request, *args, **kwargs):
+        # Served from the versioned catalog cache, see api/catalog.py
+        render = super().list
+        return Response(catalog.cached(request, lambda: render(request, *args, **kwargs).data))
+
+
+# ==================== TAG VIEWS ====================
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def tag_list(request):
+    """Tags with note counts, optionally scoped to a subject"""
+    try:
+        limit = int(request.query_params.get('limit', 50))
+    except ValueError:
+        return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    if limit < 1:
+        return Response({'error': 'limit must be at least 1'}, status=status.HTTP_400_BAD_REQUEST)
+    subject_id = request.query_params.get('subject') or None
+    if subject_id is not None and not subject_id.isdigit():
+        return Response({'error': 'subject must be an id'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(tags.tag_counts(subject_id=subject_id, limit=min(limit, 500)))
+
 
 # ==================== NOTE VIEWS ====================
 
-class NoteViewSet(viewsets.ModelViewSet):
+def id_list(value):
+    """
+    Distinct ids, in order, from a list or a comma separated string. Raises
+    ValueError for anything else or more than BATCH_MAX_IDS ids.
+    """
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    if not isinstance(value, list) or any(isinstance(item, bool) for item in value):
+        raise ValueError('ids must be a list of numbers')
+    try:
+        ids = list(dict.fromkeys(int(item) for item in value))
+    except (TypeError, ValueError):
+        raise ValueError('ids must be a list of numbers')
+    if len(ids) > BATCH_MAX_IDS:
+        raise ValueError(f'At most {BATCH_MAX_IDS} ids per request')
+    return ids
+
+
+class NoteViewSet(compact.CompactResponseMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for notes"""
     queryset = Note.objects.filter(is_approved=True)
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    replica_actions = ('list', 'retrieve', 'batch')
+    compact_actions = ('list', 'batch', 'comments')
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -133,27 +264,34 @@ class NoteViewSet(viewsets.ModelViewSet):
         if subject_id:
             queryset = queryset.filter(subject_id=subject_id)
         
-        # Search
-        search = self.request.query_params.get('search')
-        if search:
-            queryset = queryset.filter(
-                Q(title__icontains=search) | 
-                Q(description__icontains=search) |
-                Q(tags__icontains=search)
-            )
+        # Filter by tag, every given tag must match
+        for tag in self.request.query_params.getlist('tag'):
+            queryset = queryset.filter(tag_set__name=tags.normalize(tag))
         
         # Filter by user's uploads
         my_notes = self.request.query_params.get('my_notes')
         if my_notes:
             queryset = queryset.filter(uploaded_by=self.request.user)
         
-        return queryset
+        # Search, ranked by relevance
+        query = self.request.query_params.get('search')
+        if query:
+            queryset, self.search_truncated = search.search(queryset, query)
+        
+        return queries.notes(queryset, self.request.user, detail=self.action == 'retrieve')
+
+    def perform_update(self, serializer):
+        if {'file', 'thumbnail'} & set(serializer.validated_data):
+            # New source for the thumbnails, render them again
+            note = serializer.save(thumbnail_status='pending')
+            thumbnails.schedule(note)
+        else:
+            serializer.save()
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
-        # Increment view count
-        instance.views_count += 1
-        instance.save(update_fields=['views_count'])
+        # Increment view count, written to the database in batches
+        counters.increment(instance, 'views_count')
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
@@ -162,38 +300,141 @@ class NoteViewSet(viewsets.ModelViewSet):
         """Record download and return file URL"""
         note = self.get_object()
         Download.objects.get_or_create(note=note, user=request.user)
-        note.downloads_count += 1
-        note.save(update_fields=['downloads_count'])
+        counters.increment(note, 'downloads_count')
         return Response({
-            'file_url': request.build_absolute_uri(note.file.url),
+            'file_url': request.build_absolute_uri(reverse('note-file', args=[note.pk])),
             'downloads_count': note.downloads_count
         })
 
+    @action(detail=True, methods=['get'], renderer_classes=files.FILE_RENDERERS)
+    def file(self, request, pk=None):
+        """Stream the note file, with Range and conditional request support"""
+        note = self.get_object()
+        if not note.file:
+            raise Http404
+        return files.serve_file(request, note.file)
+
     @action(detail=True, methods=['post'])
     def bookmark(self, request, pk=None):
         """Toggle bookmark on a note"""
         note = self.get_object()
-        bookmark, created = Bookmark.objects.get_or_create(note=note, user=request.user)
-        if not created:
-            bookmark.delete()
-            return Response({'bookmarked': False, 'message': 'Bookmark removed'})
+        with transaction.atomic():
+            stats.lock_user(request.user.pk)  # Against a concurrent bulk_bookmark, see there
+            bookmark, created = Bookmark.objects.get_or_create(note=note, user=request.user)
+            if not created:
+                bookmark.delete()
+                return Response({'bookmarked': False, 'message': 'Bookmark removed'})
         return Response({'bookmarked': True, 'message': 'Note bookmarked'})
 
+    @action(detail=False, methods=['get'])
+    def batch(self, request):
+        """Several notes by id in one query, ?ids=1,2,3, in the order asked for"""
+        try:
+            ids = id_list(request.query_params.get('ids', ''))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        found = self.get_queryset().in_bulk(ids)
+        notes = [found[pk] for pk in ids if pk in found]
+        return Response({
+            'results': self.get_serializer(notes, many=True).data,
+            'missing': [pk for pk in ids if pk not in found],
+        })
+
+    @action(detail=False, methods=['post'])
+    @transaction.atomic
+    def bulk_bookmark(self, request):
+        """Bookmark the notes in ``add`` and unbookmark those in ``remove``, with a result per id"""
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected an object with add and remove'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            add = id_list(request.data.get('add', []))
+            remove = id_list(request.data.get('remove', []))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if set(add) & set(remove):
+            return Response({'error': 'A note cannot be both added and removed'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # The user's bookmark writes (this and the toggle) take this lock on PostgreSQL, SQLite serializes them
+        stats.lock_user(request.user.pk)
+        notes = set(Note.objects.filter(is_approved=True, pk__in=add + remove).values_list('pk', flat=True))
+        bookmarked = set(Bookmark.objects.filter(user=request.user, note_id__in=add + remove)
+                         .values_list('note_id', flat=True))
+        new = [pk for pk in add if pk in notes and pk not in bookmarked]
+        with stats.deferred():
+            Bookmark.objects.bulk_create([Bookmark(note_id=pk, user=request.user) for pk in new],
+                                         ignore_conflicts=True)
+            Bookmark.objects.filter(user=request.user, note_id__in=[pk for pk in remove if pk in bookmarked]).delete()
+        # bulk_create skips the signals that count bookmarks and returns skipped conflicts too, so the counter
+        # is recounted under the lock rather than incremented
+        stats.reset_user(request.user.pk, 'bookmarks')
+
+        results = [
+            {'id': pk, 'bookmarked': pk in add} if pk in notes or pk in bookmarked
+            else {'id': pk, 'error': 'Note not found'}
+            for pk in add + remove
+        ]
+        return Response({'results': results})
+
     @action(detail=True, methods=['get'])
     def comments(self, request, pk=None):
-        """Get comments for a note"""
+        """Get comment threads for a note"""
         note = self.get_object()
-        comments = note.comments.filter(parent=None)
-        serializer = CommentSerializer(comments, many=True)
-        return Response(serializer.data)
+        return comment_threads(request, note.comments.filter(parent=None), self)
+
+
+# ==================== UPLOAD SESSION VIEWS ====================
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """Resumable chunked note uploads: create, PUT chunks, then finalize"""
+    serializer_class = UploadSessionSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user)
+
+    def perform_destroy(self, instance):
+        uploads.discard(instance)
+        instance.delete()
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        """Store one chunk, the X-Chunk-SHA256 header must hold its checksum"""
+        session = self.get_object()
+        if session.status != 'pending':
+            return Response({'error': f'Upload is {session.status}'}, status=status.HTTP_409_CONFLICT)
+        checksum = request.META.get('HTTP_X_CHUNK_SHA256')
+        if not checksum:
+            return Response({'error': 'X-Chunk-SHA256 header is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            uploads.write_chunk(session, int(index), request.stream, length, checksum)
+        except uploads.ChunkError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'index': int(index), 'missing_chunks': uploads.missing_chunks(session)})
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        """Assemble the chunks into a note in the background"""
+        session = self.get_object()
+        missing = uploads.missing_chunks(session)
+        if missing:
+            return Response({'error': 'Chunks are missing', 'missing_chunks': missing},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not uploads.finalize(session):
+            return Response({'error': f'Upload is {session.status}'}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(session).data, status=status.HTTP_202_ACCEPTED)
 
 
 # ==================== NOTE REQUEST VIEWS ====================
 
-class NoteRequestViewSet(viewsets.ModelViewSet):
+class NoteRequestViewSet(compact.CompactResponseMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     """ViewSet for note requests"""
     queryset = NoteRequest.objects.all()
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    compact_actions = ('list', 'comments')
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -213,19 +454,17 @@ class NoteRequestViewSet(viewsets.ModelViewSet):
         if subject_id:
             queryset = queryset.filter(subject_id=subject_id)
         
-        # Search
-        search = self.request.query_params.get('search')
-        if search:
-            queryset = queryset.filter(
-                Q(title__icontains=search) | Q(description__icontains=search)
-            )
-        
         # My requests
         my_requests = self.request.query_params.get('my_requests')
         if my_requests:
             queryset = queryset.filter(requested_by=self.request.user)
         
-        return queryset
+        # Search, ranked by relevance
+        query = self.request.query_params.get('search')
+        if query:
+            queryset, self.search_truncated = search.search(queryset, query)
+        
+        return queries.note_requests(queryset)
 
     @action(detail=True, methods=['post'])
     def fulfill(self, request, pk=None):
@@ -238,17 +477,18 @@ class NoteRequestViewSet(viewsets.ModelViewSet):
         
         try:
             note = Note.objects.get(id=note_id)
-            note_request.status = 'fulfilled'
-            note_request.fulfilled_by = note
-            note_request.save()
-            
-            # Notify the user who requested the note
-            if note_request.requested_by != request.user:
-                Notification.objects.create(
-                    user=note_request.requested_by,
-                    title='Request Fulfilled',
-                    message=f'Your request "{note_request.title}" was fulfilled by {request.user.full_name}.'
-                )
+            with transaction.atomic():
+                note_request.status = 'fulfilled'
+                note_request.fulfilled_by = note
+                note_request.save()
+                
+                # Notify the user who requested the note
+                if note_request.requested_by != request.user:
+                    tasks.notify(
+                        note_request.requested_by,
+                        'Request Fulfilled',
+                        f'Your request "{note_request.title}" was fulfilled by {request.user.full_name}.'
+                    )
             
             return Response({'message': 'Request marked as fulfilled'})
         except Note.DoesNotExist:
@@ -256,41 +496,86 @@ class NoteRequestViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def comments(self, request, pk=None):
-        """Get comments for a request"""
+        """Get comment threads for a request"""
         note_request = self.get_object()
-        comments = note_request.comments.filter(parent=None)
-        serializer = CommentSerializer(comments, many=True)
-        return Response(serializer.data)
+        return comment_threads(request, note_request.comments.filter(parent=None), self)
 
 
 # ==================== COMMENT VIEWS ====================
 
-class CommentViewSet(viewsets.ModelViewSet):
+def comment_threads(request, comments, view):
+    """Cursor-paginated top-level comments with their reply trees"""
+    paginator = CommentPagination()
+    page = paginator.paginate_queryset(comments.select_related('user'), request, view=view)
+    threads.attach_replies(page, threads.get_depth(request))
+    serializer = CommentSerializer(page, many=True, context=view.get_serializer_context())
+    return paginator.get_paginated_response(serializer.data)
+
+
+class CommentViewSet(compact.CompactResponseMixin, viewsets.ModelViewSet):
     """ViewSet for comments"""
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('user')
     permission_classes = [IsAuthenticated]
+    pagination_class = CommentPagination
+    compact_actions = ('list', 'more_replies')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        comments = threads.attach_replies(page if page is not None else queryset, threads.get_depth(request))
+        serializer = self.get_serializer(comments, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        threads.attach_replies([instance], threads.get_depth(request))
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'], renderer_classes=files.FILE_RENDERERS)
+    def attachment(self, request, pk=None):
+        """Stream the comment attachment, with Range and conditional request support"""
+        comment = self.get_object()
+        if not comment.attachment:
+            raise Http404
+        return files.serve_file(request, comment.attachment)
+
+    @action(detail=False, methods=['get'], url_path='more-replies')
+    def more_replies(self, request):
+        """Continue a thread from a more_replies token, a page of replies at a time"""
+        continuation = threads.decode_token(request.query_params.get('token', ''))
+        if continuation is None or not Comment.objects.filter(id=continuation[0]).exists():
+            return Response({'error': 'Invalid token'}, status=status.HTTP_400_BAD_REQUEST)
+        page = self.paginate_queryset(threads.later_replies(*continuation).select_related('user'))
+        # The page is the first of the requested levels, attach the rest beneath it
+        replies = threads.attach_replies(page, max(threads.get_depth(request), 1) - 1)
+        serializer = CommentSerializer(replies, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
 
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
             return CommentCreateSerializer
         return CommentSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         comment = serializer.save(user=self.request.user)
         
         # Notify note owner
         if comment.note and comment.note.uploaded_by != self.request.user:
-            Notification.objects.create(
-                user=comment.note.uploaded_by,
-                title='New Comment on Note',
-                message=f'{self.request.user.full_name} commented on your note "{comment.note.title}".'
+            tasks.notify(
+                comment.note.uploaded_by,
+                'New Comment on Note',
+                f'{self.request.user.full_name} commented on your note "{comment.note.title}".'
             )
         # Notify request owner
         elif comment.request and comment.request.requested_by != self.request.user:
-             Notification.objects.create(
-                user=comment.request.requested_by,
-                title='New Comment on Request',
-                message=f'{self.request.user.full_name} commented on your request "{comment.request.title}".'
+            tasks.notify(
+                comment.request.requested_by,
+                'New Comment on Request',
+                f'{self.request.user.full_name} commented on your request "{comment.request.title}".'
             )
 
     def get_queryset(self):
@@ -315,7 +600,7 @@ class CommentViewSet(viewsets.ModelViewSet):
 @permission_classes([IsAuthenticated])
 def my_bookmarks(request):
     """Get user's bookmarked notes"""
-    bookmarks = Bookmark.objects.filter(user=request.user)
+    bookmarks = queries.bookmarks(Bookmark.objects.filter(user=request.user), request.user)
     serializer = BookmarkSerializer(bookmarks, many=True, context={'request': request})
     return Response(serializer.data)
 
@@ -324,7 +609,7 @@ def my_bookmarks(request):
 @permission_classes([IsAuthenticated])
 def my_downloads(request):
     """Get user's downloaded notes"""
-    downloads = Download.objects.filter(user=request.user)
+    downloads = queries.downloads(Download.objects.filter(user=request.user), request.user)
     serializer = DownloadSerializer(downloads, many=True, context={'request': request})
     return Response(serializer.data)
 
@@ -335,14 +620,15 @@ def my_downloads(request):
 @permission_classes([IsAuthenticated])
 def dashboard_stats(request):
     """Get dashboard statistics for the user"""
-    user = request.user
+    user_stats = stats.for_user(request.user.pk)
+    site_stats = stats.site()
     return Response({
-        'total_uploads': Note.objects.filter(uploaded_by=user).count(),
-        'total_downloads': Download.objects.filter(user=user).count(),
-        'total_bookmarks': Bookmark.objects.filter(user=user).count(),
-        'total_requests': NoteRequest.objects.filter(requested_by=user).count(),
-        'open_requests': NoteRequest.objects.filter(status='open').count(),
-        'total_notes': Note.objects.filter(is_approved=True).count(),
+        'total_uploads': user_stats.uploads,
+        'total_downloads': user_stats.downloads,
+        'total_bookmarks': user_stats.bookmarks,
+        'total_requests': user_stats.requests,
+        'open_requests': site_stats.open_requests,
+        'total_notes': site_stats.total_notes,
     })
 
 # ==================== NOTIFICATION VIEWS ====================
@@ -350,11 +636,58 @@ def dashboard_stats(request):
 class NotificationViewSet(viewsets.ModelViewSet):
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        return Notification.objects.filter(user=self.request.user)
+        queryset = Notification.objects.filter(user=self.request.user)
+        if self.request.query_params.get('unread'):
+            queryset = queryset.filter(is_read=False)
+        return queryset
 
     @action(detail=False, methods=['POST'])
+    @transaction.atomic
     def mark_all_read(self, request):
-        self.get_queryset().update(is_read=True)
+        marked = Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+        stats.adjust(request.user.pk, unread_notifications=-marked)
         return Response({'status': 'success'})
+
+    @action(detail=False, methods=['POST'])
+    @transaction.atomic
+    def mark_read(self, request):
+        """Mark the notifications in ``ids`` read, with a result per id"""
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected an object with ids'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = id_list(request.data.get('ids', []))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        current = dict(Notification.objects.filter(user=request.user, pk__in=ids).values_list('pk', 'is_read'))
+        unread = [pk for pk, is_read in current.items() if not is_read]
+        marked = Notification.objects.filter(user=request.user, pk__in=unread, is_read=False).update(is_read=True)
+        stats.adjust(request.user.pk, unread_notifications=-marked)
+
+        results = [
+            {'id': pk, 'is_read': True} if pk in current else {'id': pk, 'error': 'Notification not found'}
+            for pk in ids
+        ]
+        return Response({'results': results})
+
+    @action(detail=False, methods=['GET'])
+    def unread_count(self, request):
+        return Response({'unread_count': stats.for_user(request.user.pk).unread_notifications})
+
+
+@require_GET
+async def notification_stream(request):
+    """Server-Sent Events stream of the user's new notifications"""
+    # EventSource cannot set headers, so the token may also come as ?token=
+    user = await token_user(request)
+    if user is None:
+        return JsonResponse({'error': 'Invalid token'}, status=401)
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    response = StreamingHttpResponse(events.stream(user, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Tell nginx not to buffer the stream
+    return response
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "notesharing.settings")
+# Long-running server processes buffer view and download counters (api/counters.py)
+os.environ.setdefault("COUNTER_FLUSH_INTERVAL", "5")
 
 application = get_asgi_application()
@@ -39,6 +39,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it compresses what every other middleware has finished with
+    'api.compression.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -47,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.replicas.PinAfterWriteMiddleware',
 ]
 
 ROOT_URLCONF = 'notesharing.urls'
@@ -73,13 +76,92 @@ WSGI_APPLICATION = 'notesharing.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+# Opt-in SQLite settings for concurrent load (SQLITE_TUNED=1). WAL lets reads
+# run while a write is in progress. Writers wait up to `timeout` seconds for
+# the lock, and take it when the transaction begins (IMMEDIATE) instead of
+# failing to upgrade a read lock halfway through. `manage.py benchmark_sqlite`
+# compares throughput with and without these settings
+SQLITE_TUNED_OPTIONS = {
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 20,
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'  # Durable across crashes of the app, not of the OS, in WAL mode
+        'PRAGMA mmap_size=268435456;'
+        'PRAGMA cache_size=-65536;'  # KiB
+        'PRAGMA temp_store=MEMORY;'
+    ),
 }
 
+# SQLite unless DATABASE_ENGINE=postgresql, which is configured from the
+# DATABASE_* variables below. Its connections are kept DATABASE_CONN_MAX_AGE
+# seconds and checked before reuse, or pooled by psycopg when
+# DATABASE_POOL_MAX_SIZE is set (pip install "psycopg[pool]").
+# DATABASE_REPLICA_HOSTS (comma separated host[:port]) adds read replicas,
+# see api/replicas.py
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+    PRIMARY_DATABASE = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('DATABASE_NAME', 'notesharing'),
+        'USER': os.environ.get('DATABASE_USER', 'notesharing'),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('DATABASE_HOST', 'localhost'),
+        'PORT': os.environ.get('DATABASE_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+    if int(os.environ.get('DATABASE_POOL_MAX_SIZE', 0)):
+        # The pool replaces persistent connections, Django refuses both at once
+        PRIMARY_DATABASE['CONN_MAX_AGE'] = 0
+        PRIMARY_DATABASE['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ['DATABASE_POOL_MAX_SIZE']),
+            'timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+        }
+    DATABASES = {'default': PRIMARY_DATABASE}
+    replica_hosts = [host.strip() for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',') if host.strip()]
+    for number, replica_host in enumerate(replica_hosts, start=1):
+        host, _, port = replica_host.partition(':')
+        DATABASES[f'replica{number}'] = {
+            **PRIMARY_DATABASE,
+            'OPTIONS': dict(PRIMARY_DATABASE['OPTIONS']),
+            'HOST': host,
+            'PORT': port or PRIMARY_DATABASE['PORT'],
+            'TEST': {'MIRROR': 'default'},
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+    if os.environ.get('SQLITE_TUNED') == '1':
+        DATABASES['default']['OPTIONS'] = SQLITE_TUNED_OPTIONS
+
+# Tokens (api/authentication.py), subject catalog versions (api/catalog.py)
+# and replica pins (api/replicas.py) are cached, and every worker process must
+# see the same entries. CACHE_REDIS_URL (e.g. redis://localhost:6379/1) shares
+# the cache through Redis. Without it each process has its own memory cache,
+# which only suits a single process such as runserver
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or None
+if CACHE_REDIS_URL:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': CACHE_REDIS_URL}}
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+# Aliases list and detail views of notes, subjects and requests read from.
+# After a write, a user reads from the primary for REPLICA_PIN_SECONDS (keep
+# it above the replication lag). Pins live in the REPLICA_PIN_CACHE alias of
+# CACHES, which must be shared between workers
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+REPLICA_PIN_CACHE = os.environ.get('REPLICA_PIN_CACHE', 'default')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -99,6 +181,29 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# PASSWORD_HASHER_PROFILE picks the algorithm for new hashes: 'pbkdf2'
+# (Django's default), 'scrypt' or 'argon2' (needs argon2-cffi). Hashes made
+# with another algorithm or cost keep working and are upgraded at the next
+# login (api/hashers.py)
+PASSWORD_HASHER_PROFILES = {
+    'pbkdf2': 'api.hashers.PBKDF2PasswordHasher',
+    'scrypt': 'api.hashers.ScryptPasswordHasher',
+    'argon2': 'api.hashers.Argon2PasswordHasher',
+}
+PASSWORD_HASHER_PROFILE = os.environ.get('PASSWORD_HASHER_PROFILE', 'pbkdf2')
+PASSWORD_HASHERS = [PASSWORD_HASHER_PROFILES[PASSWORD_HASHER_PROFILE]] + [
+    path for name, path in PASSWORD_HASHER_PROFILES.items() if name != PASSWORD_HASHER_PROFILE
+]
+PASSWORD_SCRYPT_WORK_FACTOR = 2 ** 14
+PASSWORD_ARGON2_TIME_COST = 2
+PASSWORD_ARGON2_MEMORY_COST = 19456  # KiB
+PASSWORD_ARGON2_PARALLELISM = 1
+
+# Auth views hash on PASSWORD_HASH_WORKERS threads (api/passwords.py) and
+# answer 503 once PASSWORD_HASH_QUEUE hashes are waiting
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE = 64
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
@@ -122,6 +227,61 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Note files and attachments are streamed by api/files.py. Set to 'nginx'
+# (X-Accel-Redirect) or 'sendfile' (X-Sendfile) to let the proxy send them.
+FILE_SENDFILE_BACKEND = os.environ.get('FILE_SENDFILE_BACKEND') or None
+FILE_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# Resumable chunked uploads (api/uploads.py), assembled by `manage.py runworker`
+UPLOAD_SESSION_DIR = BASE_DIR / 'upload_sessions'
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+UPLOAD_MAX_SIZE = 500 * 1024 * 1024
+
+# Note thumbnails (api/thumbnails.py), rendered by `manage.py runworker` in a
+# process pool of THUMBNAIL_WORKERS processes. Widths in pixels, 0 workers
+# turns it off.
+# PDFs need PyMuPDF installed (pip install pymupdf).
+THUMBNAIL_SIZES = {'small': 160, 'medium': 320, 'large': 640}
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+
+# Background jobs (api/jobs.py), run by `manage.py runworker`. Failed jobs
+# are retried after JOB_BACKOFF_BASE * 2^attempt seconds, up to JOB_BACKOFF_MAX
+JOB_BACKOFF_BASE = 5
+JOB_BACKOFF_MAX = 3600
+
+# Notification push (api/events.py, GET /api/notifications/stream/, served
+# under ASGI). The database backend polls every NOTIFICATION_POLL_INTERVAL
+# seconds, reading NOTIFICATION_POLL_OVERLAP seconds back for rows that
+# committed late. Use 'api.events.RedisBackend' to fan out through Redis instead
+NOTIFICATION_PUBSUB_BACKEND = os.environ.get('NOTIFICATION_PUBSUB_BACKEND', 'api.events.DatabaseBackend')
+NOTIFICATION_REDIS_URL = os.environ.get('NOTIFICATION_REDIS_URL', 'redis://localhost:6379/0')
+NOTIFICATION_POLL_INTERVAL = 2
+NOTIFICATION_POLL_OVERLAP = 30
+NOTIFICATION_HEARTBEAT_INTERVAL = 15
+
+# Rendered subject list responses are cached (api/catalog.py). Subject changes
+# invalidate them at once, notes_count may lag by up to this many seconds. The
+# cache must be shared (CACHE_REDIS_URL) for an invalidation to reach every
+# worker; without it the list is not cached, unless SUBJECT_CATALOG_LOCAL=1
+# allows the in-memory cache for a single process
+SUBJECT_CATALOG_TTL = int(os.environ.get('SUBJECT_CATALOG_TTL', 60))
+SUBJECT_CATALOG_LOCAL = os.environ.get('SUBJECT_CATALOG_LOCAL') == '1'
+
+# Most ids one batch request (notes/batch/, notes/bulk_bookmark/,
+# notifications/mark_read/) may name
+BATCH_MAX_IDS = 100
+
+# Characters of a description that ?compact=1 list responses keep
+# (api/compact.py)
+COMPACT_EXCERPT_LENGTH = 160
+
+# Hash uploads while they stream in, so the content-addressed storage
+# (api/storage.py) can deduplicate them without reading them again
+FILE_UPLOAD_HANDLERS = [
+    'api.storage.HashingMemoryUploadHandler',
+    'api.storage.HashingTemporaryUploadHandler',
+]
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -133,10 +293,28 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'api.User'
 
 
+# View and download counters are buffered in memory and written every
+# COUNTER_FLUSH_INTERVAL seconds. 0 writes through immediately, the default
+# except in server processes, which asgi.py and wsgi.py set to 5
+COUNTER_FLUSH_INTERVAL = int(os.environ.get('COUNTER_FLUSH_INTERVAL', 0))
+COUNTER_SPOOL_DIR = BASE_DIR / 'counter_spool'
+
+
+# Authenticated tokens are cached for TOKEN_CACHE_TTL seconds (api/authentication.py)
+# in TOKEN_CACHE_BACKEND, an alias of CACHES that must be shared between workers
+# so logouts and password changes reach all of them. Without a shared cache
+# tokens are not cached, unless TOKEN_CACHE_LOCAL=1 enables a per-process LRU
+# for deployments that run a single process
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_BACKEND = os.environ.get('TOKEN_CACHE_BACKEND') or ('default' if CACHE_REDIS_URL else None)
+TOKEN_CACHE_LOCAL = os.environ.get('TOKEN_CACHE_LOCAL') == '1'
+
+
 # Django REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -144,8 +322,25 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    # orjson when installed, DRF's json module renderer otherwise (api/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
+# Response compression (api/compression.py): brotli when installed, else gzip,
+# for these content types once a body reaches COMPRESSION_MIN_SIZE bytes
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_CONTENT_TYPES = ['application/json', 'text/html']
+COMPRESSION_BROTLI_QUALITY = 5
+COMPRESSION_GZIP_LEVEL = 6
+
 
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True